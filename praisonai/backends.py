@@ -0,0 +1,446 @@
+# Pool of inference backends with least-outstanding-requests routing
+import asyncio
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from contextlib import aclosing
+from typing import Any, AsyncGenerator, Dict, Iterable, List, Optional, Sequence, Set
+from urllib.parse import urlparse
+
+import httpx
+
+from circuit import CircuitBreaker, CircuitOpenError
+from http_client import (
+    OLLAMA_URL,
+    UpstreamError,
+    ollama_generate,
+    ollama_generate_stream,
+    ollama_installed_models,
+    ollama_load,
+    ollama_loaded_models,
+    openai_completion,
+    openai_completion_stream,
+    openai_models,
+)
+
+logger = logging.getLogger(__name__)
+
+# Ollama instances sharing the load, comma-separated
+OLLAMA_URLS = os.getenv("OLLAMA_URLS", OLLAMA_URL)
+# OpenAI-compatible proxies such as LiteLLM ("http://litellm:4000/v1"), comma-separated
+OPENAI_BACKEND_URLS = os.getenv("OPENAI_BACKEND_URLS", "")
+OPENAI_BACKEND_API_KEY = os.getenv("OPENAI_BACKEND_API_KEY", "")
+# Names the proxies know the Ollama models by ("llama3.1:8b=llama3.1,qwen2.5:14b=qwen2.5")
+OPENAI_BACKEND_MODELS = os.getenv("OPENAI_BACKEND_MODELS", "")
+# Active health checks, which also refresh the models each backend serves
+BACKEND_HEALTH_INTERVAL = float(os.getenv("BACKEND_HEALTH_INTERVAL", "10"))
+BACKEND_HEALTH_TIMEOUT = float(os.getenv("BACKEND_HEALTH_TIMEOUT", "3"))
+# Backends slower per token than this multiple of the fastest one on the same model are ejected
+BACKEND_SLOW_FACTOR = float(os.getenv("BACKEND_SLOW_FACTOR", "3"))
+BACKEND_EJECT_SECONDS = float(os.getenv("BACKEND_EJECT_SECONDS", "30"))
+BACKEND_MIN_SAMPLES = int(os.getenv("BACKEND_MIN_SAMPLES", "5"))
+
+# Weight of the newest sample in the per-token latency average
+_LATENCY_ALPHA = 0.2
+
+
+def model_tag(model: str) -> str:
+    """Name as Ollama lists it, with the implicit ``latest`` tag spelled out"""
+    return model if ":" in model else f"{model}:latest"
+
+
+def parse_model_map(spec: str) -> Dict[str, str]:
+    """Parse "model=alias,model=alias" into a lookup table"""
+    models: Dict[str, str] = {}
+    for item in spec.split(","):
+        model, _, alias = item.strip().partition("=")
+        if model and alias:
+            models[model] = alias
+    return models
+
+
+class NoBackendAvailable(UpstreamError):
+    """No configured backend serves the requested model"""
+
+    def __init__(self, model: str):
+        super().__init__("Model backends", 503)
+        self.args = (f"No backend serves model {model}",)
+        self.model = model
+
+
+class Backend(ABC):
+    """One inference server with its load, health and latency bookkeeping"""
+    kind = "base"
+    # Whether Ollama's KV ``context`` array can be passed back to resume a generation
+    supports_context = False
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url.rstrip("/")
+        # Requests fail fast while this backend keeps erroring or timing out
+        self.breaker = CircuitBreaker(f"{self.kind} backend {name}")
+        # None until the first health check reports what the backend serves
+        self.models: Optional[Set[str]] = None
+        self.healthy = True
+        self.outstanding = 0
+        self.picks = 0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.latency: Dict[str, float] = {}
+        self.samples: Dict[str, int] = {}
+        self.last_error: Optional[str] = None
+
+    def serves(self, model: str) -> bool:
+        return self.models is None or model_tag(model) in self.models
+
+    @property
+    def ejected(self) -> bool:
+        return time.monotonic() < self.ejected_until
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and not self.ejected
+
+    def record_success(self, model: str, elapsed_ms: float, tokens: int) -> None:
+        self.requests += 1
+        # Wall time per generated token, so long and short answers compare
+        per_token = elapsed_ms / (tokens + 1)
+        previous = self.latency.get(model)
+        self.latency[model] = per_token if previous is None else previous + _LATENCY_ALPHA * (per_token - previous)
+        self.samples[model] = self.samples.get(model, 0) + 1
+
+    def record_failure(self, error: Exception) -> None:
+        self.requests += 1
+        self.failures += 1
+        self.last_error = str(error) or type(error).__name__
+
+    def eject(self, seconds: float) -> None:
+        self.ejected_until = time.monotonic() + seconds
+        self.ejections += 1
+        # Earn its place again from fresh samples once back
+        self.latency.clear()
+        self.samples.clear()
+
+    @abstractmethod
+    async def probe(self, timeout: float) -> List[str]:
+        """Model names the backend serves; raises when it is unreachable"""
+
+    @abstractmethod
+    async def generate(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """One complete generation, as an Ollama /api/generate response"""
+
+    @abstractmethod
+    def generate_stream(self, payload: Dict[str, Any]) -> AsyncGenerator[Dict[str, Any], None]:
+        """A generation as Ollama-style stream chunks"""
+
+    async def resident(self, models: Sequence[str]) -> Set[str]:
+        """Which of ``models`` are loaded and ready to generate"""
+        return set(models)
+
+    async def load(self, model: str) -> None:
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "url": self.url,
+            "healthy": self.healthy,
+            "ejected": self.ejected,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "circuit": self.breaker.stats(),
+            "models": sorted(self.models) if self.models is not None else None,
+            "ms_per_token": {model: round(latency, 1) for model, latency in self.latency.items()},
+            "last_error": self.last_error,
+        }
+
+
+class OllamaBackend(Backend):
+    """An Ollama instance, spoken to through its native API"""
+    kind = "ollama"
+    supports_context = True
+
+    async def probe(self, timeout: float) -> List[str]:
+        return [model_tag(name) for name in await ollama_installed_models(self.url, timeout)]
+
+    async def generate(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return await ollama_generate(payload, self.url)
+
+    def generate_stream(self, payload: Dict[str, Any]) -> AsyncGenerator[Dict[str, Any], None]:
+        return ollama_generate_stream(payload, self.url)
+
+    async def resident(self, models: Sequence[str]) -> Set[str]:
+        loaded = {model_tag(name) for name in await ollama_loaded_models(self.url)}
+        return {model for model in models if model_tag(model) in loaded}
+
+    async def load(self, model: str) -> None:
+        await ollama_load(model, self.url)
+
+
+class OpenAIBackend(Backend):
+    """An OpenAI-compatible completions endpoint, answering in Ollama's response shape
+
+    Ollama model names are translated through ``model_map``; sampling options
+    that have an OpenAI equivalent are passed on and the rest are dropped.
+    """
+    kind = "openai"
+
+    def __init__(self, name: str, url: str, api_key: str = "", model_map: Optional[Dict[str, str]] = None):
+        super().__init__(name, url)
+        self.api_key = api_key
+        self.model_map = model_map or {}
+
+    def _remote_model(self, model: str) -> str:
+        return self.model_map.get(model, model)
+
+    def serves(self, model: str) -> bool:
+        return self.models is None or self._remote_model(model) in self.models
+
+    def _request(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        options = payload.get("options") or {}
+        request = {"model": self._remote_model(payload["model"]), "prompt": payload.get("prompt", "")}
+        if "num_predict" in options:
+            request["max_tokens"] = options["num_predict"]
+        for key in ("temperature", "top_p", "stop", "seed"):
+            if key in options:
+                request[key] = options[key]
+        return request
+
+    @staticmethod
+    def _counters(usage: Dict[str, Any]) -> Dict[str, Any]:
+        return {"prompt_eval_count": usage.get("prompt_tokens", 0), "eval_count": usage.get("completion_tokens", 0)}
+
+    async def probe(self, timeout: float) -> List[str]:
+        return await openai_models(self.url, self.api_key, timeout)
+
+    async def generate(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        body = await openai_completion(self.url, self.api_key, self._request(payload))
+        choice = (body.get("choices") or [{}])[0]
+        return {
+            "model": payload["model"],
+            "response": choice.get("text") or "",
+            "done": True,
+            **self._counters(body.get("usage") or {}),
+        }
+
+    async def generate_stream(self, payload: Dict[str, Any]) -> AsyncGenerator[Dict[str, Any], None]:
+        usage: Dict[str, Any] = {}
+        async with aclosing(openai_completion_stream(self.url, self.api_key, self._request(payload))) as events:
+            async for event in events:
+                if event.get("usage"):
+                    usage = event["usage"]
+                for choice in event.get("choices") or []:
+                    if choice.get("text"):
+                        yield {"model": payload["model"], "response": choice["text"], "done": False}
+        yield {"model": payload["model"], "response": "", "done": True, **self._counters(usage)}
+
+
+def _retryable(error: Exception) -> bool:
+    """Failures where the request never reached a model, so another backend can take it"""
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    return isinstance(error, UpstreamError) and (error.status_code >= 500 or error.status_code == 404)
+
+
+class BackendPool:
+    """Routes each generation to the least busy healthy backend serving its model
+
+    Ties go to the backend with the lowest latency per token, then to the one
+    picked least often. Backends are checked in the background, each sits
+    behind its own circuit breaker, and ones much slower than their peers on
+    the same model are ejected for a while. A request that could not reach its
+    backend is retried once per remaining candidate; when every candidate's
+    circuit is open it fails at once with CircuitOpenError.
+    """
+
+    def __init__(self, backends: Iterable[Backend], health_interval: float = BACKEND_HEALTH_INTERVAL,
+                 health_timeout: float = BACKEND_HEALTH_TIMEOUT):
+        self.backends: List[Backend] = list(backends)
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self._task: Optional[asyncio.Task] = None
+        self.retries = 0
+        self.unavailable = 0
+        self.fast_failed = 0
+
+    def _serving(self, model: str, exclude: Sequence[Backend], needs_context: bool) -> List[Backend]:
+        return [
+            backend for backend in self.backends
+            if backend not in exclude and backend.serves(model) and (backend.supports_context or not needs_context)
+        ]
+
+    def candidates(self, model: str, exclude: Sequence[Backend] = (), needs_context: bool = False) -> List[Backend]:
+        permitted = [backend for backend in self._serving(model, exclude, needs_context) if backend.breaker.permits()]
+        # When every backend looks down, still try one rather than fail outright
+        return [backend for backend in permitted if backend.available] or permitted
+
+    def pick(self, model: str, exclude: Sequence[Backend] = (), needs_context: bool = False) -> Backend:
+        candidates = self.candidates(model, exclude, needs_context)
+        if not candidates:
+            serving = self._serving(model, exclude, needs_context)
+            if serving:
+                self.fast_failed += 1
+                for backend in serving:
+                    backend.breaker.rejected += 1
+                raise CircuitOpenError("Model backends", min(backend.breaker.retry_after() for backend in serving))
+            self.unavailable += 1
+            raise NoBackendAvailable(model)
+        tag = model_tag(model)
+        backend = min(candidates, key=lambda b: (b.outstanding, b.latency.get(tag, 0.0), b.picks))
+        backend.picks += 1
+        return backend
+
+    def serves(self, model: str) -> bool:
+        """Whether any backend has the model, or may have it before its first health check"""
+        return any(backend.serves(model) for backend in self.backends)
+
+    def supports_context(self, model: str) -> bool:
+        """Whether every backend that may serve ``model`` accepts Ollama's KV context"""
+        serving = [backend for backend in self.backends if backend.serves(model)]
+        return bool(serving) and all(backend.supports_context for backend in serving)
+
+    def _failed(self, backend: Backend, error: Exception, model: str, tried: Sequence[Backend],
+                needs_context: bool, retry: bool = True) -> bool:
+        """Record a failed request; returns whether to retry it on another backend"""
+        if isinstance(error, UpstreamError) and error.status_code == 404:
+            # Model not pulled there; stop routing it to this backend until the next check
+            if backend.models is not None:
+                backend.models.discard(model_tag(model))
+        else:
+            backend.record_failure(error)
+        if not retry or not _retryable(error) or not self.candidates(model, tried, needs_context):
+            return False
+        self.retries += 1
+        logger.warning(f"Backend {backend.name} failed for {model} ({error}), retrying on another backend")
+        return True
+
+    def _succeeded(self, backend: Backend, model: str, started: float, tokens: int) -> None:
+        tag = model_tag(model)
+        backend.record_success(tag, (time.perf_counter() - started) * 1000, tokens)
+        peers = [b for b in self.backends if b.available and b.samples.get(tag, 0) >= BACKEND_MIN_SAMPLES]
+        if len(peers) < 2:
+            return
+        fastest = min(b.latency[tag] for b in peers)
+        for peer in peers:
+            if peer.latency[tag] > BACKEND_SLOW_FACTOR * fastest and sum(b.available for b in peers) > 1:
+                logger.warning(
+                    f"Ejecting slow backend {peer.name} for {BACKEND_EJECT_SECONDS:.0f} s "
+                    f"({peer.latency[tag]:.0f} ms/token on {tag}, fastest {fastest:.0f})"
+                )
+                peer.eject(BACKEND_EJECT_SECONDS)
+
+    async def generate(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Non-streaming generation on the best backend for the payload's model"""
+        model = payload["model"]
+        needs_context = bool(payload.get("context"))
+        tried: List[Backend] = []
+        while True:
+            backend = self.pick(model, tried, needs_context)
+            tried.append(backend)
+            started = time.perf_counter()
+            backend.outstanding += 1
+            try:
+                async with backend.breaker.guard():
+                    response = await backend.generate(payload)
+            except Exception as e:
+                if not self._failed(backend, e, model, tried, needs_context):
+                    raise
+                continue
+            finally:
+                backend.outstanding -= 1
+            self._succeeded(backend, model, started, response.get("eval_count", 0) or 0)
+            return response
+
+    async def generate_stream(self, payload: Dict[str, Any]) -> AsyncGenerator[Dict[str, Any], None]:
+        """Streaming generation; only retried elsewhere if nothing was received yet"""
+        model = payload["model"]
+        needs_context = bool(payload.get("context"))
+        tried: List[Backend] = []
+        while True:
+            backend = self.pick(model, tried, needs_context)
+            tried.append(backend)
+            started = time.perf_counter()
+            received = False
+            tokens = 0
+            backend.outstanding += 1
+            try:
+                async with backend.breaker.guard(), aclosing(backend.generate_stream(payload)) as chunks:
+                    async for chunk in chunks:
+                        received = True
+                        if chunk.get("done"):
+                            tokens = chunk.get("eval_count", 0) or 0
+                        yield chunk
+            except Exception as e:
+                if not self._failed(backend, e, model, tried, needs_context, retry=not received):
+                    raise
+                continue
+            finally:
+                backend.outstanding -= 1
+            self._succeeded(backend, model, started, tokens)
+            return
+
+    async def _probe(self, backend: Backend) -> None:
+        try:
+            models = await backend.probe(self.health_timeout)
+        except Exception as e:
+            if backend.healthy:
+                logger.warning(f"Backend {backend.name} failed its health check: {e}")
+            backend.healthy = False
+            backend.last_error = str(e) or type(e).__name__
+            return
+        if not backend.healthy:
+            logger.info(f"Backend {backend.name} is healthy again")
+        backend.healthy = True
+        backend.models = set(models)
+
+    async def check(self) -> None:
+        """Probe every backend once"""
+        await asyncio.gather(*(self._probe(backend) for backend in self.backends))
+
+    async def _run(self) -> None:
+        while True:
+            await self.check()
+            await asyncio.sleep(self.health_interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backends": {backend.name: backend.stats() for backend in self.backends},
+            "retries": self.retries,
+            "unavailable": self.unavailable,
+            "fast_failed": self.fast_failed,
+        }
+
+
+def _urls(spec: str) -> List[str]:
+    return [url.strip().rstrip("/") for url in spec.split(",") if url.strip()]
+
+
+def make_backend_pool() -> BackendPool:
+    backends: List[Backend] = [OllamaBackend(urlparse(url).netloc or url, url) for url in _urls(OLLAMA_URLS)]
+    model_map = parse_model_map(OPENAI_BACKEND_MODELS)
+    backends += [
+        OpenAIBackend(urlparse(url).netloc or url, url, OPENAI_BACKEND_API_KEY, model_map)
+        for url in _urls(OPENAI_BACKEND_URLS)
+    ]
+    return BackendPool(backends)
+
+
+backend_pool = make_backend_pool()
@@ -0,0 +1,48 @@
+# Bounded-concurrency execution of batch requests, yielding results as they finish
+import asyncio
+import os
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, Optional, Set, Tuple, TypeVar
+
+# Items accepted in one batch request
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+# Items of one batch running at once; 0 uses the scheduler's slot count
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "0"))
+
+K = TypeVar("K", bound=Hashable)
+T = TypeVar("T")
+
+
+async def run_bounded(jobs: Dict[K, Callable[[], Awaitable[T]]], limit: int
+                      ) -> AsyncIterator[Tuple[K, Optional[T], Optional[Exception]]]:
+    """Run the jobs with at most ``limit`` in flight, yielding ``(key, result, error)`` as each finishes
+
+    Jobs start in dictionary order as slots free up, so a long batch keeps
+    exactly ``limit`` of them busy. Closing the iterator early cancels the
+    jobs still running and never starts the rest.
+    """
+    queued = iter(jobs.items())
+    running: Dict[asyncio.Future, K] = {}
+
+    def fill() -> None:
+        while len(running) < max(1, limit):
+            try:
+                key, job = next(queued)
+            except StopIteration:
+                return
+            running[asyncio.ensure_future(job())] = key
+
+    try:
+        fill()
+        while running:
+            done: Set[asyncio.Future]
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                key = running.pop(task)
+                error = task.exception()
+                yield key, None if error is not None else task.result(), error
+            fill()
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
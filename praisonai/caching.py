@@ -0,0 +1,169 @@
+# In-process caches and request coalescing for the Keiken Teams API
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set, Tuple
+
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries also expire after a fixed TTL
+
+    When ``max_bytes`` is set, ``sizeof`` estimates each value's footprint and
+    least recently used entries are evicted until the total fits the budget.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, max_bytes: Optional[int] = None,
+                 sizeof: Optional[Callable[[Any], int]] = None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof or (lambda value: 0)
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return a live entry and mark it most recently used, or None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value, _ = entry
+        if expires_at <= time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Store a value, evicting least recently used entries past the bounds"""
+        size = self._sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (time.monotonic() + self.ttl, value, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self._bytes > self.max_bytes
+        ):
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, key: Hashable) -> None:
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class SharedCallCancelled(Exception):
+    """Raised to a caller whose shared call was cancelled while the caller itself was not"""
+
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into one underlying call
+
+    The call runs in its own task, so a caller that gives up (for example a
+    disconnected client) does not cancel the work other callers are waiting on.
+    With ``cancel_abandoned`` a call started by ``do()`` is cancelled once every
+    caller of ``do()`` and ``join()`` has given up; a result produced by a
+    ``lead()`` caller is never cancelled, since that caller is still producing it.
+    """
+
+    def __init__(self, cancel_abandoned: bool = False):
+        self.cancel_abandoned = cancel_abandoned
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._callers: Dict[asyncio.Future, int] = {}
+        self._led: Set[asyncio.Future] = set()
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done, key=key: self._finish(key, done))
+        else:
+            self.coalesced += 1
+        return await self._wait(key, task)
+
+    async def _wait(self, key: Hashable, task: asyncio.Future) -> Any:
+        self._callers[task] = self._callers.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # The shared call was cancelled under a caller that is itself still running
+            if task.cancelled() and not asyncio.current_task().cancelling():
+                raise SharedCallCancelled()
+            raise
+        finally:
+            self._callers[task] -= 1
+            if not self._callers[task]:
+                del self._callers[task]
+                if self.cancel_abandoned and not task.done() and task not in self._led:
+                    # Nobody is waiting any more; later callers start afresh
+                    self.abandoned += 1
+                    if self._inflight.get(key) is task:
+                        del self._inflight[key]
+                    task.cancel()
+
+    def lead(self, key: Hashable) -> Optional[asyncio.Future]:
+        """Register the caller as the producer for ``key``
+
+        Returns a future the caller must resolve (or fail) when done, or None
+        if another producer is already in flight.
+        """
+        if key in self._inflight:
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self._led.add(future)
+        future.add_done_callback(lambda done, key=key: self._finish(key, done))
+        return future
+
+    def join(self, key: Hashable) -> Optional[Awaitable[Any]]:
+        """Awaitable for the in-flight result of ``key``, or None if idle; it counts as a caller until it ends"""
+        future = self._inflight.get(key)
+        if future is None:
+            return None
+        self.coalesced += 1
+        return self._wait(key, future)
+
+    def _finish(self, key: Hashable, future: asyncio.Future) -> None:
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        self._led.discard(future)
+        # Mark the exception as retrieved when every caller has gone away
+        if not future.cancelled():
+            future.exception()
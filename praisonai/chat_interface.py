@@ -218,6 +218,32 @@ def load_conversation_messages(conversation_id):
     
     return [{"role": msg[0], "content": msg[1], "model": msg[2], "timestamp": msg[3]} for msg in messages]
 
+def team_session_reply(model, history, content):
+    """Send only the new turn to a server-side session, seeding it from history on first use"""
+    api_sessions = st.session_state.setdefault("api_sessions", {})
+    key = f"{st.session_state.current_conversation_id}:{model}"
+    response = None
+    for _ in range(2):
+        session_id = api_sessions.get(key)
+        if session_id is None:
+            created = requests.post(
+                "http://keiken-teams-api:8000/sessions",
+                json={"team": model, "messages": history},
+                timeout=10
+            )
+            created.raise_for_status()
+            session_id = api_sessions[key] = created.json()["session_id"]
+        response = requests.post(
+            f"http://keiken-teams-api:8000/sessions/{session_id}/reply",
+            json={"content": content},
+            timeout=60
+        )
+        if response.status_code != 404:
+            break
+        # Session expired on the server; recreate it from the local history
+        api_sessions.pop(key, None)
+    return response
+
 # --- SESSION STATE ---
 if "db_path" not in st.session_state:
     st.session_state.db_path = init_database()
@@ -388,11 +414,7 @@ if prompt:
         
         # Make API call
         with st.spinner(f"Keiken {selected_model} is thinking..."):
-            response = requests.post(
-                f"http://keiken-teams-api:8000/teams/{selected_model}/execute",
-                json={"messages": api_messages},
-                timeout=60
-            )
+            response = team_session_reply(selected_model, api_messages[:-1], api_messages[-1]["content"])
             
             if response.status_code == 200:
                 result = response.json()
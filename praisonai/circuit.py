@@ -0,0 +1,162 @@
+# Circuit breakers that fail fast while an upstream dependency is down
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Deque, Dict
+
+import httpx
+
+from http_client import UpstreamError
+
+logger = logging.getLogger(__name__)
+
+# Recent calls the failure rate is computed over, and the fewest needed before tripping
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", "20"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))
+# Share of failed calls in the window that opens the circuit
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))
+# Seconds an open circuit rejects calls before letting probes through
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "15"))
+# Probe calls allowed while half-open; that many successes close the circuit again
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "1"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(UpstreamError):
+    """Raised instead of calling a dependency whose circuit is open"""
+
+    def __init__(self, service: str, retry_after: float):
+        super().__init__(service, 503)
+        self.args = (f"{service} circuit is open",)
+        self.retry_after = max(1, round(retry_after))
+
+
+def dependency_failure(error: Exception) -> bool:
+    """Errors that say the dependency is unhealthy, as opposed to a bad request"""
+    if isinstance(error, httpx.TransportError):
+        return True
+    return isinstance(error, UpstreamError) and error.status_code >= 500
+
+
+class CircuitBreaker:
+    """Failure-rate circuit breaker with half-open probing
+
+    Closed, it tracks the outcome of the last ``window`` calls and opens once
+    at least ``min_calls`` were made and the failed share reaches
+    ``failure_rate``. Open, every call is rejected at once with
+    CircuitOpenError. After ``open_seconds`` it turns half-open and lets
+    ``half_open_probes`` calls through; if they all succeed it closes, and
+    any failure opens it again. Cancelled calls count as neither.
+    """
+
+    def __init__(self, service: str, window: int = CIRCUIT_WINDOW, min_calls: int = CIRCUIT_MIN_CALLS,
+                 failure_rate: float = CIRCUIT_FAILURE_RATE, open_seconds: float = CIRCUIT_OPEN_SECONDS,
+                 half_open_probes: int = CIRCUIT_HALF_OPEN_PROBES,
+                 is_failure: Callable[[Exception], bool] = dependency_failure):
+        self.service = service
+        self.min_calls = max(1, min_calls)
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = max(1, half_open_probes)
+        self.is_failure = is_failure
+        self._outcomes: Deque[bool] = deque(maxlen=max(1, window))
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes = 0
+            self._probe_successes = 0
+        return self._state
+
+    def retry_after(self) -> float:
+        return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def permits(self) -> bool:
+        """Whether a call would be let through right now"""
+        state = self.state
+        return state == CLOSED or (state == HALF_OPEN and self._probes < self.half_open_probes)
+
+    def acquire(self) -> None:
+        """Admit a call or raise CircuitOpenError; admitted calls must report their outcome"""
+        if not self.permits():
+            self.rejected += 1
+            raise CircuitOpenError(self.service, self.retry_after())
+        if self._state == HALF_OPEN:
+            self._probes += 1
+
+    def release(self) -> None:
+        """The admitted call ended without telling anything about the dependency"""
+        if self._state == HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+
+    def record_success(self) -> None:
+        if self._state == HALF_OPEN:
+            self._probe_successes += 1
+            if self._probe_successes >= self.half_open_probes:
+                self._close()
+            return
+        self._outcomes.append(True)
+
+    def record_failure(self) -> None:
+        if self._state == HALF_OPEN:
+            self._open()
+            return
+        self._outcomes.append(False)
+        failures = self._outcomes.count(False)
+        if self._state == CLOSED and len(self._outcomes) >= self.min_calls \
+                and failures / len(self._outcomes) >= self.failure_rate:
+            self._open()
+
+    def _open(self) -> None:
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self.trips += 1
+        logger.warning(f"{self.service} circuit opened; failing fast for {self.open_seconds:.0f} s")
+
+    def _close(self) -> None:
+        self._state = CLOSED
+        self._outcomes.clear()
+        logger.info(f"{self.service} circuit closed")
+
+    @asynccontextmanager
+    async def guard(self) -> AsyncIterator[None]:
+        """Run the body as one call through the breaker"""
+        self.acquire()
+        try:
+            yield
+        except Exception as e:
+            if self.is_failure(e):
+                self.record_failure()
+            else:
+                # The dependency answered; the request itself was the problem
+                self.record_success()
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.record_success()
+
+    def stats(self) -> Dict[str, Any]:
+        state = self.state
+        failures = self._outcomes.count(False)
+        return {
+            "state": state,
+            "failure_rate": round(failures / len(self._outcomes), 3) if self._outcomes else 0.0,
+            "calls_in_window": len(self._outcomes),
+            "retry_after_seconds": round(self.retry_after(), 1) if state == OPEN else 0.0,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
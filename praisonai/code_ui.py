@@ -325,7 +325,7 @@ Please analyze the provided codebase and answer the user's question with specifi
         with st.spinner("Analyzing code..."):
             response = requests.post(
                 f"http://keiken-teams-api:8000/teams/{selected_team}/execute",
-                json={"messages": api_messages},
+                json={"messages": api_messages, "priority": "interactive"},
                 timeout=120  # Longer timeout for code analysis
             )
             
@@ -0,0 +1,334 @@
+# Token-budgeted conversation context with a running summary of older turns
+import asyncio
+import hashlib
+import logging
+import math
+import os
+from dataclasses import asdict, dataclass
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from caching import SingleFlight, TTLCache
+from backends import backend_pool
+from scheduler import PRIORITY_BATCH, scheduler
+from tracing import generation_span
+from usage import GenerationUsage, usage_stats
+
+logger = logging.getLogger(__name__)
+
+# Rough characters per token used to estimate prompt sizes without a tokenizer
+CONTEXT_CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", "4"))
+# Context window assumed for models not listed in CONTEXT_WINDOWS ("model=tokens,...")
+CONTEXT_DEFAULT_WINDOW = int(os.getenv("CONTEXT_DEFAULT_WINDOW", "8192"))
+CONTEXT_WINDOWS = os.getenv("CONTEXT_WINDOWS", "")
+# Tokens kept free for the prompt template, agent notes and the response
+CONTEXT_RESERVE_TOKENS = int(os.getenv("CONTEXT_RESERVE_TOKENS", "3072"))
+# Length limit of the running summary that replaces older turns
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("CONTEXT_SUMMARY_TOKENS", "512"))
+CONTEXT_SUMMARY_MODEL = os.getenv("CONTEXT_SUMMARY_MODEL", os.getenv("TEAM_MODEL", "llama3.1:8b"))
+CONTEXT_SUMMARY_CACHE_TTL = float(os.getenv("CONTEXT_SUMMARY_CACHE_TTL", "3600"))
+CONTEXT_SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv("CONTEXT_SUMMARY_CACHE_MAX_ENTRIES", "1024"))
+
+ROLE_LABELS = {"system": "System", "user": "User", "assistant": "Assistant"}
+
+
+def parse_context_windows(spec: str) -> Dict[str, int]:
+    """Parse "model=tokens,model=tokens" into a lookup table"""
+    windows: Dict[str, int] = {}
+    for item in spec.split(","):
+        model, _, tokens = item.strip().rpartition("=")
+        if model and tokens.isdigit():
+            windows[model] = int(tokens)
+    return windows
+
+
+_windows = parse_context_windows(CONTEXT_WINDOWS)
+
+
+def context_window(model: str) -> int:
+    return _windows.get(model, CONTEXT_DEFAULT_WINDOW)
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CONTEXT_CHARS_PER_TOKEN) if text else 0
+
+
+@dataclass
+class Turn:
+    """One chat message as it appears in the prompt transcript"""
+    role: str
+    content: str
+
+    def render(self) -> str:
+        return f"{ROLE_LABELS.get(self.role, self.role.title())}: {self.content}\n"
+
+
+def render_turns(turns: List[Turn]) -> str:
+    return "".join(turn.render() for turn in turns)
+
+
+def _chain_digest(parent: str, turn: Turn) -> str:
+    return hashlib.sha256(f"{parent}\0{turn.role}\0{turn.content}".encode("utf-8")).hexdigest()
+
+
+@dataclass(frozen=True)
+class _Node:
+    """A non-system turn with its rendering, size and running totals up to it"""
+    turn: Turn
+    rendered: str
+    tokens: int
+    total_tokens: int
+    length: int
+    digest: str
+    parent: Optional["_Node"]
+
+
+class ConversationHistory:
+    """Immutable conversation transcript
+
+    Appending returns a new history that shares every earlier turn, so adding
+    a message costs O(new message) and concurrent readers keep a consistent
+    snapshot. Each turn carries a hash of the history up to it, which keys the
+    running summaries and the completion cache without rehashing old turns.
+    """
+
+    __slots__ = ("pinned", "pinned_text", "pinned_digest", "tail")
+
+    def __init__(self, pinned: Tuple[Turn, ...] = (), pinned_text: str = "", pinned_digest: str = "",
+                 tail: Optional[_Node] = None):
+        self.pinned = pinned
+        self.pinned_text = pinned_text
+        self.pinned_digest = pinned_digest
+        self.tail = tail
+
+    @classmethod
+    def from_turns(cls, turns: Iterable[Turn]) -> "ConversationHistory":
+        history = cls()
+        for turn in turns:
+            history = history.append(turn)
+        return history
+
+    def append(self, turn: Turn) -> "ConversationHistory":
+        if turn.role == "system":
+            # System messages are pinned ahead of the transcript
+            return ConversationHistory(
+                self.pinned + (turn,),
+                self.pinned_text + turn.render(),
+                _chain_digest(self.pinned_digest, turn),
+                self.tail,
+            )
+        rendered = turn.render()
+        tokens = estimate_tokens(rendered)
+        parent = self.tail
+        node = _Node(
+            turn,
+            rendered,
+            tokens,
+            tokens + (parent.total_tokens if parent else 0),
+            1 + (parent.length if parent else 0),
+            _chain_digest(parent.digest if parent else "", turn),
+            parent,
+        )
+        return ConversationHistory(self.pinned, self.pinned_text, self.pinned_digest, node)
+
+    def __len__(self) -> int:
+        return len(self.pinned) + (self.tail.length if self.tail else 0)
+
+    @property
+    def tokens(self) -> int:
+        """Estimated tokens of the non-system turns"""
+        return self.tail.total_tokens if self.tail else 0
+
+    @property
+    def digest(self) -> str:
+        """Hash of the whole conversation, including system messages"""
+        return hashlib.sha256(f"{self.pinned_digest}\0{self.tail.digest if self.tail else ''}".encode("utf-8")).hexdigest()
+
+    @property
+    def current_query(self) -> str:
+        """Content of the latest user turn"""
+        node = self.tail
+        while node is not None and node.turn.role != "user":
+            node = node.parent
+        return node.turn.content if node else ""
+
+    def recent(self, count: int) -> List[Tuple[str, Turn]]:
+        """Up to ``count`` latest non-system turns with their history digests, newest first"""
+        recent: List[Tuple[str, Turn]] = []
+        node = self.tail
+        while node is not None and len(recent) < count:
+            recent.append((node.digest, node.turn))
+            node = node.parent
+        return recent
+
+    def turns(self) -> List[Turn]:
+        """Every turn in order, system messages first"""
+        turns: List[Turn] = []
+        node = self.tail
+        while node is not None:
+            turns.append(node.turn)
+            node = node.parent
+        turns.reverse()
+        return list(self.pinned) + turns
+
+
+@dataclass
+class ContextReport:
+    """What the builder did to fit one request's history into its budget"""
+    budget_tokens: int
+    history_tokens: int
+    kept_turns: int
+    summarized_turns: int = 0
+    summarized_tokens: int = 0
+    dropped_turns: int = 0
+    dropped_tokens: int = 0
+    summary_tokens: int = 0
+
+    def summary(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+@dataclass
+class BuiltContext:
+    text: str
+    report: ContextReport
+
+
+async def summarize_with_ollama(team: str, previous_summary: str, turns: List[Turn]) -> str:
+    """Fold older turns into the running summary with one low-priority generation"""
+    prompt = f"""Summarize the conversation below for a team of assistants who will continue it.
+Keep names, numbers, decisions, open questions and the user's stated goals. Write at most {CONTEXT_SUMMARY_TOKENS * 3 // 4} words of plain prose.
+
+Summary so far:
+{previous_summary or "(none)"}
+
+New conversation turns:
+{render_turns(turns)}
+Updated summary:"""
+    async with scheduler.slot(team, PRIORITY_BATCH):
+        with generation_span(CONTEXT_SUMMARY_MODEL, call="summary") as generation:
+            response = await backend_pool.generate({
+                "model": CONTEXT_SUMMARY_MODEL,
+                "prompt": prompt,
+                "options": {"num_predict": CONTEXT_SUMMARY_TOKENS}
+            })
+            usage = GenerationUsage.from_ollama(response)
+            generation.set(**usage.span_attributes())
+    usage_stats.record(team, "summary", usage)
+    return response.get("response", "").strip()
+
+
+class ConversationContextBuilder:
+    """Fit chat history into a per-model token budget
+
+    System messages are always kept. The newest turns are kept verbatim while
+    they fit; older turns are replaced by a running summary cached under a
+    hash chain of the turns it covers. Building never waits on a summary: when
+    the cached summary does not yet cover every older turn, the uncovered turns
+    are dropped for this request and the summary is extended in the background
+    for the next one. Only the kept and newly uncovered turns are visited.
+    """
+
+    def __init__(self, summarize: Callable[[str, str, List[Turn]], Awaitable[str]] = summarize_with_ollama,
+                 cache: Optional[TTLCache] = None):
+        self._summarize = summarize
+        self.cache = cache or TTLCache(CONTEXT_SUMMARY_CACHE_MAX_ENTRIES, CONTEXT_SUMMARY_CACHE_TTL)
+        self._flight = SingleFlight()
+        self._tasks: Set[asyncio.Task] = set()
+        self.requests = 0
+        self.trimmed_requests = 0
+        self.tokens_summarized = 0
+        self.tokens_dropped = 0
+        self.summaries_generated = 0
+        self.summary_failures = 0
+
+    def build(self, team: str, history: ConversationHistory, model: str,
+              reserved_tokens: int = CONTEXT_RESERVE_TOKENS, window: Optional[int] = None) -> BuiltContext:
+        """Render the history for a prompt, walking back only as far as the budget reaches
+
+        ``window`` is the num_ctx the request asked for, if any, in place of
+        the model's configured window.
+        """
+        budget = max(0, (window or context_window(model)) - reserved_tokens - estimate_tokens(history.pinned_text))
+        self.requests += 1
+
+        # Keep the newest turns that fit; the latest turn is always kept
+        fits_whole = history.tokens <= budget
+        recent_budget = budget if fits_whole else max(0, budget - CONTEXT_SUMMARY_TOKENS)
+        kept: List[str] = []
+        used = 0
+        node = history.tail
+        while node is not None and (not kept or used + node.tokens <= recent_budget):
+            kept.append(node.rendered)
+            used += node.tokens
+            node = node.parent
+        kept.reverse()
+        report = ContextReport(budget, history.tokens, len(kept))
+
+        older = node
+        summary = ""
+        if older is not None:
+            # Find the newest older turn a cached summary already covers
+            uncovered: List[Turn] = []
+            covered = older
+            while covered is not None:
+                cached = self.cache.get(covered.digest)
+                if cached is not None:
+                    summary = cached
+                    break
+                uncovered.append(covered.turn)
+                covered = covered.parent
+
+            covered_tokens = covered.total_tokens if covered else 0
+            covered_turns = covered.length if covered else 0
+            report.summarized_turns = covered_turns
+            report.summarized_tokens = covered_tokens
+            report.dropped_turns = older.length - covered_turns
+            report.dropped_tokens = older.total_tokens - covered_tokens
+            report.summary_tokens = estimate_tokens(summary)
+            self.trimmed_requests += 1
+            self.tokens_summarized += report.summarized_tokens
+            self.tokens_dropped += report.dropped_tokens
+
+            if uncovered:
+                uncovered.reverse()
+                self._extend_summary(team, older.digest, summary, uncovered)
+
+        parts = [history.pinned_text]
+        if summary:
+            parts.append(f"Summary of earlier conversation: {summary}\n")
+        parts.extend(kept)
+        return BuiltContext("".join(parts), report)
+
+    def _extend_summary(self, team: str, key: str, previous: str, turns: List[Turn]) -> None:
+        if key in self._flight:
+            return
+
+        async def produce() -> None:
+            try:
+                summary = await self._summarize(team, previous, turns)
+            except Exception as e:
+                self.summary_failures += 1
+                logger.error(f"Conversation summary failed: {e}")
+                return
+            if summary:
+                # Cap the stored summary so it cannot outgrow its share of the budget
+                self.cache.set(key, summary[:int(CONTEXT_SUMMARY_TOKENS * CONTEXT_CHARS_PER_TOKEN)])
+                self.summaries_generated += 1
+
+        task = asyncio.ensure_future(self._flight.do(key, produce))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "trimmed_requests": self.trimmed_requests,
+            "tokens_summarized": self.tokens_summarized,
+            "tokens_dropped": self.tokens_dropped,
+            "summaries_generated": self.summaries_generated,
+            "summary_failures": self.summary_failures,
+            "summary_cache": self.cache.stats(),
+        }
+
+
+context_builder = ConversationContextBuilder()
@@ -0,0 +1,127 @@
+# Client disconnect detection and accounting for abandoned Ollama generations
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Dict, TypeVar
+
+from starlette.requests import Request
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ClientDisconnected(Exception):
+    """Raised when the caller went away before a non-streaming result was ready"""
+
+
+class CancellationStats:
+    """Counts generations abandoned by their callers and the tokens that were not generated
+
+    Savings are estimated per generation kind from a moving average of how many
+    tokens completed generations of that kind produce.
+    """
+
+    def __init__(self):
+        self.disconnects: Dict[str, int] = {}
+        self.cancelled: Dict[str, int] = {}
+        self.completed: Dict[str, int] = {}
+        self._avg_tokens: Dict[str, float] = {}
+        self.tokens_generated = 0
+        self.tokens_saved = 0.0
+
+    def record_completed(self, kind: str, tokens: int) -> None:
+        self.completed[kind] = self.completed.get(kind, 0) + 1
+        avg = self._avg_tokens.get(kind)
+        self._avg_tokens[kind] = float(tokens) if avg is None else 0.9 * avg + 0.1 * tokens
+
+    def record_cancelled(self, kind: str, tokens: int = 0) -> None:
+        """Record a generation aborted after producing ``tokens`` tokens (0 if still queued)"""
+        self.cancelled[kind] = self.cancelled.get(kind, 0) + 1
+        self.tokens_generated += tokens
+        self.tokens_saved += max(0.0, self._avg_tokens.get(kind, 0.0) - tokens)
+
+    def record_disconnect(self, endpoint: str) -> None:
+        self.disconnects[endpoint] = self.disconnects.get(endpoint, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "client_disconnects": dict(self.disconnects),
+            "cancelled_generations": dict(self.cancelled),
+            "tokens_generated_before_cancel": self.tokens_generated,
+            "tokens_saved_estimate": round(self.tokens_saved),
+            "avg_completion_tokens": {kind: round(avg, 1) for kind, avg in self._avg_tokens.items()},
+        }
+
+
+cancellation_stats = CancellationStats()
+
+
+async def wait_for_disconnect(request: Request) -> None:
+    """Return once the client has closed the connection"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def run_until_disconnect(request: Request, awaitable: Awaitable[T], endpoint: str) -> T:
+    """Await a result, cancelling the work if the client disconnects first"""
+    work = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        done, _ = await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        work.cancel()
+        watcher.cancel()
+        raise
+    watcher.cancel()
+    if work in done:
+        return work.result()
+
+    work.cancel()
+    await asyncio.gather(work, return_exceptions=True)
+    cancellation_stats.record_disconnect(endpoint)
+    logger.info(f"Client disconnected from {endpoint}, generation cancelled")
+    raise ClientDisconnected()
+
+
+async def stream_until_disconnect(request: Request, body: AsyncIterator[str], endpoint: str) -> AsyncIterator[str]:
+    """Relay a response body, stopping it as soon as the client disconnects
+
+    A disconnect while the body is producing its next chunk cancels that work
+    where it waits (queue slot, agent calls or the Ollama stream). A disconnect
+    noticed between chunks stops the relay before the next one is pulled.
+    Either way the body is closed, which releases the scheduler slot and the
+    upstream connection.
+    """
+    task = asyncio.current_task()
+    iterator = body.__aiter__()
+    state = {"pulling": False, "disconnected": False}
+
+    async def watch() -> None:
+        await wait_for_disconnect(request)
+        state["disconnected"] = True
+        if state["pulling"]:
+            task.cancel()
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+        while not state["disconnected"]:
+            state["pulling"] = True
+            try:
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                state["pulling"] = False
+            yield chunk
+    except asyncio.CancelledError:
+        if not state["disconnected"]:
+            raise
+        task.uncancel()
+    finally:
+        watcher.cancel()
+        if state["disconnected"]:
+            cancellation_stats.record_disconnect(endpoint)
+            logger.info(f"Client disconnected from {endpoint} stream, generation cancelled")
+        await iterator.aclose()
@@ -0,0 +1,95 @@
+# Ollama generation options from the request, the team's defaults and the server's caps
+import os
+from typing import Any, Dict, Mapping, Optional
+
+# Output tokens any one generation may produce, whatever the request or team asks for
+GENERATION_MAX_TOKENS = int(os.getenv("GENERATION_MAX_TOKENS", "2048"))
+# Largest context window a request may ask for; every distinct num_ctx makes Ollama reload the model
+GENERATION_MAX_CTX = int(os.getenv("GENERATION_MAX_CTX", "16384"))
+# Stop sequences accepted per request
+GENERATION_MAX_STOP = 4
+
+# Request field -> Ollama option; max_tokens is the OpenAI name for num_predict
+REQUEST_FIELDS = {
+    "temperature": "temperature",
+    "top_p": "top_p",
+    "max_tokens": "num_predict",
+    "num_predict": "num_predict",
+    "num_ctx": "num_ctx",
+    "stop": "stop",
+    "seed": "seed",
+}
+
+
+class GenerationOptionsError(ValueError):
+    """Raised for a generation option with the wrong type or an out-of-range value"""
+
+
+def _number(field: str, value: Any, low: float, high: float) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not low <= value <= high:
+        raise GenerationOptionsError(f"{field} must be a number from {low:g} to {high:g}")
+    return float(value)
+
+
+def _count(field: str, value: Any, low: int) -> int:
+    if isinstance(value, bool) or not isinstance(value, int) or value < low:
+        raise GenerationOptionsError(f"{field} must be an integer of at least {low}")
+    return value
+
+
+def _option(field: str, name: str, value: Any) -> Any:
+    if name == "temperature":
+        return _number(field, value, 0, 2)
+    if name == "top_p":
+        return _number(field, value, 0, 1)
+    if name == "num_predict":
+        return _count(field, value, 1)
+    if name == "num_ctx":
+        return _count(field, value, 256)
+    if name == "seed":
+        return _count(field, value, 0)
+    stops = [value] if isinstance(value, str) else value
+    if not isinstance(stops, list) or not all(isinstance(stop, str) and stop for stop in stops):
+        raise GenerationOptionsError(f"{field} must be a string or a list of strings")
+    if len(stops) > GENERATION_MAX_STOP:
+        raise GenerationOptionsError(f"{field} accepts at most {GENERATION_MAX_STOP} sequences")
+    return stops
+
+
+def requested_options(data: Mapping[str, Any]) -> Dict[str, Any]:
+    """Ollama options named in a request body; absent and null fields are left to the team's defaults"""
+    options: Dict[str, Any] = {}
+    for field, name in REQUEST_FIELDS.items():
+        if data.get(field) is not None:
+            options[name] = _option(field, name, data[field])
+    return options
+
+
+def team_options(data: Mapping[str, Any]) -> Dict[str, Any]:
+    """A team's default options, given under their Ollama names"""
+    options = {}
+    for name, value in data.items():
+        if name not in REQUEST_FIELDS.values():
+            raise GenerationOptionsError(f"unknown option {name!r} (supported: {', '.join(sorted(set(REQUEST_FIELDS.values())))})")
+        options[name] = _option(name, name, value)
+    return options
+
+
+def resolve_options(team_config: Mapping[str, Any], requested: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Request options over the team's defaults, with output length and context capped
+
+    ``num_predict`` is always set, so every generation of the request has a
+    bounded length: the team's ``max_output_tokens`` if lower than
+    GENERATION_MAX_TOKENS, else that.
+    """
+    options = {**team_config.get("options", {}), **(requested or {})}
+    cap = min(team_config.get("max_output_tokens") or GENERATION_MAX_TOKENS, GENERATION_MAX_TOKENS)
+    options["num_predict"] = min(options.get("num_predict", cap), cap)
+    if "num_ctx" in options:
+        options["num_ctx"] = min(options["num_ctx"], GENERATION_MAX_CTX)
+    return options
+
+
+def note_options(options: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Options for intermediate generations, whose text the caller never sees: no stop sequences"""
+    return {name: value for name, value in (options or {}).items() if name != "stop"}
@@ -0,0 +1,446 @@
+# Grounding: fetch the top search result pages, extract their main text and cache it on disk
+import asyncio
+import hashlib
+import ipaddress
+import json
+import logging
+import os
+import threading
+import time
+from html.parser import HTMLParser
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+import httpx
+
+from caching import SingleFlight
+from context_builder import CONTEXT_CHARS_PER_TOKEN
+from http_client import get_http_client
+
+logger = logging.getLogger(__name__)
+
+# Result pages fetched per search; 0 leaves the agents with SearxNG's snippets only
+GROUNDING_PAGES = int(os.getenv("GROUNDING_PAGES", "0"))
+# Seconds one page may take, redirects included, before the research goes ahead without it
+GROUNDING_FETCH_TIMEOUT = float(os.getenv("GROUNDING_FETCH_TIMEOUT", "3"))
+# Bytes read per page; longer pages are extracted from their first part
+GROUNDING_MAX_BYTES = int(os.getenv("GROUNDING_MAX_BYTES", str(1024 * 1024)))
+# Tokens of extracted text given to the agents per page
+GROUNDING_PAGE_TOKENS = int(os.getenv("GROUNDING_PAGE_TOKENS", "400"))
+# Extracted text on disk, shared by workers and kept across restarts
+GROUNDING_CACHE_DIR = os.getenv("GROUNDING_CACHE_DIR", "/app/data/pages")
+GROUNDING_CACHE_MAX_BYTES = int(os.getenv("GROUNDING_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Seconds a cached page is used without asking the site whether it changed
+GROUNDING_FRESH_SECONDS = float(os.getenv("GROUNDING_FRESH_SECONDS", "3600"))
+# Allow fetching pages on loopback and private networks (local test stand-ins)
+GROUNDING_ALLOW_PRIVATE = os.getenv("GROUNDING_ALLOW_PRIVATE", "false").lower() == "true"
+GROUNDING_USER_AGENT = os.getenv("GROUNDING_USER_AGENT", "KeikenTeams/1.0 (+grounding)")
+
+GROUNDING_MAX_REDIRECTS = 3
+_CONTENT_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+
+# Elements whose text is never page content
+_SKIP_TAGS = {"script", "style", "noscript", "svg", "nav", "header", "footer", "aside", "form",
+              "template", "iframe", "button", "select", "head"}
+# Elements that end the running block of text
+_BLOCK_TAGS = {"p", "li", "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote", "td", "th", "dd",
+               "dt", "figcaption", "div", "section", "tr", "br", "table", "ul", "ol"}
+_MAIN_TAGS = {"article", "main"}
+# Text inside <article>/<main> is used alone once there is at least this much of it
+_MIN_MAIN_CHARS = 300
+# Shorter blocks are menus, bylines and buttons rather than prose
+_MIN_BLOCK_WORDS = 4
+
+
+class PageFetchError(Exception):
+    """Raised for a page that cannot or may not be fetched"""
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks: List[Tuple[bool, str]] = []
+        self._parts: List[str] = []
+        self._skip = 0
+        self._main = 0
+
+    def _flush(self) -> None:
+        text = " ".join("".join(self._parts).split())
+        if text:
+            self.blocks.append((self._main > 0, text))
+        self._parts = []
+
+    def handle_starttag(self, tag: str, attrs) -> None:
+        if tag in _SKIP_TAGS:
+            self._skip += 1
+        elif tag in _MAIN_TAGS:
+            self._flush()
+            self._main += 1
+        elif tag in _BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in _SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in _MAIN_TAGS:
+            self._flush()
+            self._main = max(0, self._main - 1)
+        elif tag in _BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data: str) -> None:
+        if not self._skip:
+            self._parts.append(data)
+
+
+def extract_text(html: str) -> str:
+    """The prose of a page: its <article>/<main> text when it has enough, else every substantial block"""
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    parser._flush()
+    main = [text for in_main, text in parser.blocks if in_main]
+    blocks = main if sum(len(text) for text in main) >= _MIN_MAIN_CHARS else [text for _, text in parser.blocks]
+    return "\n".join(text for text in blocks if len(text.split()) >= _MIN_BLOCK_WORDS)
+
+
+def excerpt(text: str, tokens: int = GROUNDING_PAGE_TOKENS) -> str:
+    limit = int(tokens * CONTEXT_CHARS_PER_TOKEN)
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + "…"
+
+
+def decode_body(body: bytes, encoding: Optional[str]) -> str:
+    """Page bytes as text in their declared charset, or UTF-8 when it is missing or unknown"""
+    try:
+        return body.decode(encoding or "utf-8", errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
+
+
+def _digest(data: str) -> str:
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class PageCache:
+    """Extracted page text on disk, content-addressed and bounded in size
+
+    Text lives in ``objects/<sha256 of the text>``, so mirrors and unchanged
+    refetches share one file; ``index/<sha256 of the url>.json`` maps a URL to
+    its text and the validators needed to revalidate it. The least recently
+    read URLs are dropped once the text exceeds ``max_bytes``, together with
+    any text no other URL refers to. The directory is scanned on first use.
+    """
+
+    def __init__(self, directory: str = GROUNDING_CACHE_DIR, max_bytes: int = GROUNDING_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: Optional[Dict[str, Dict[str, Any]]] = None
+        self._used: Dict[str, float] = {}
+        self._objects: Dict[str, int] = {}
+        self.evictions = 0
+
+    def _index_path(self, key: str) -> str:
+        return os.path.join(self.directory, "index", f"{key}.json")
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def _write(self, path: str, data: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if self._entries is not None:
+            return self._entries
+        self._entries = {}
+        index = os.path.join(self.directory, "index")
+        for name in os.listdir(index) if os.path.isdir(index) else ():
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(index, name)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    entry = json.load(f)
+                size = os.path.getsize(self._object_path(entry["digest"]))
+            except (OSError, ValueError, KeyError):
+                # Half-written or orphaned; the URL is fetched again when needed
+                continue
+            key = name[:-len(".json")]
+            self._entries[key] = entry
+            self._used[key] = os.path.getmtime(path)
+            self._objects[entry["digest"]] = size
+        return self._entries
+
+    def lookup(self, url: str) -> Optional[Dict[str, Any]]:
+        """The index entry for ``url``: its text's digest, validators and when it was last checked"""
+        with self._lock:
+            entry = self._load().get(_digest(url))
+            return dict(entry) if entry is not None else None
+
+    def read(self, entry: Dict[str, Any]) -> Optional[str]:
+        """The cached text of an entry, marking it recently used; None if its file has gone"""
+        key = _digest(entry["url"])
+        try:
+            with open(self._object_path(entry["digest"]), encoding="utf-8") as f:
+                text = f.read()
+        except OSError:
+            return None
+        with self._lock:
+            self._used[key] = time.time()
+        try:
+            os.utime(self._index_path(key))
+        except OSError:
+            pass
+        return text
+
+    def store(self, url: str, text: str, etag: Optional[str], last_modified: Optional[str]) -> Dict[str, Any]:
+        """Save a page's text and validators; returns its index entry"""
+        digest = _digest(text)
+        key = _digest(url)
+        now = time.time()
+        entry = {"url": url, "digest": digest, "etag": etag, "last_modified": last_modified,
+                 "fetched_at": now, "checked_at": now}
+        with self._lock:
+            entries = self._load()
+            if digest not in self._objects:
+                self._write(self._object_path(digest), text)
+                self._objects[digest] = len(text.encode("utf-8"))
+            previous = entries.get(key)
+            try:
+                self._write(self._index_path(key), json.dumps(entry))
+            except OSError:
+                # Do not keep text no entry points to
+                self._release(digest)
+                raise
+            entries[key] = entry
+            self._used[key] = now
+            if previous is not None and previous["digest"] != digest:
+                self._release(previous["digest"])
+            self._evict()
+        return entry
+
+    def revalidated(self, entry: Dict[str, Any]) -> None:
+        """Record that the site confirmed the cached text is current"""
+        key = _digest(entry["url"])
+        with self._lock:
+            current = self._load().get(key)
+            if current is None or current["digest"] != entry["digest"]:
+                return
+            current["checked_at"] = time.time()
+            self._used[key] = current["checked_at"]
+            self._write(self._index_path(key), json.dumps(current))
+
+    def _release(self, digest: str) -> None:
+        if any(entry["digest"] == digest for entry in self._entries.values()):
+            return
+        self._objects.pop(digest, None)
+        try:
+            os.remove(self._object_path(digest))
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        while self.bytes > self.max_bytes and len(self._entries) > 1:
+            key = min(self._used, key=self._used.get)
+            entry = self._entries.pop(key)
+            del self._used[key]
+            try:
+                os.remove(self._index_path(key))
+            except OSError:
+                pass
+            self._release(entry["digest"])
+            self.evictions += 1
+
+    @property
+    def bytes(self) -> int:
+        return sum(self._objects.values())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._load()
+            return {
+                "directory": self.directory,
+                "entries": len(self._entries),
+                "objects": len(self._objects),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
+
+
+async def resolve_public(url: str) -> Optional[str]:
+    """The checked address to connect to for ``url``; None when private addresses are allowed
+
+    Refuses URLs that are not http(s) or whose host resolves to any loopback,
+    private or link-local address.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise PageFetchError(f"not an http(s) URL: {url}")
+    if GROUNDING_ALLOW_PRIVATE:
+        return None
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(parts.hostname, port)
+    except OSError as e:
+        raise PageFetchError(f"cannot resolve {parts.hostname}: {e}")
+    checked = [ipaddress.ip_address(address[4][0]) for address in addresses]
+    if not checked or not all(address.is_global for address in checked):
+        raise PageFetchError(f"{parts.hostname} is not a public address")
+    return str(checked[0])
+
+
+def pinned_request(url: str, address: Optional[str]) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+    """URL, headers and extensions that connect to ``address`` while still naming the original host
+
+    Connecting to the address that was checked, rather than letting the
+    client resolve the name again, keeps a host that re-resolves to a
+    private address (DNS rebinding) from slipping past the check. The Host
+    header and TLS server name stay the original host, so virtual hosting and
+    certificate verification work as before.
+    """
+    if address is None:
+        return url, {}, {}
+    parts = urlsplit(url)
+    host = f"[{parts.hostname}]" if ":" in parts.hostname else parts.hostname
+    ip = f"[{address}]" if ":" in address else address
+    port = f":{parts.port}" if parts.port else ""
+    extensions = {"sni_hostname": parts.hostname} if parts.scheme == "https" else {}
+    return urlunsplit(parts._replace(netloc=ip + port)), {"Host": host + port}, extensions
+
+
+class Grounder:
+    """Main text of search result pages, fetched concurrently and served from disk when cached
+
+    A page checked within GROUNDING_FRESH_SECONDS is read from disk; an older
+    one is revalidated with If-None-Match / If-Modified-Since, so an unchanged
+    page costs a 304 instead of a download. Each fetch is bounded by
+    GROUNDING_FETCH_TIMEOUT and GROUNDING_MAX_BYTES, and concurrent requests
+    for one URL share a single fetch. Pages that fail are left out, and a
+    cache that cannot be read or written only costs the caching.
+    """
+
+    def __init__(self, cache: PageCache, client: Callable[[], httpx.AsyncClient] = get_http_client):
+        self.cache = cache
+        self._client = client
+        self._flight = SingleFlight()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.truncated = 0
+        self.cache_errors = 0
+
+    async def page_text(self, url: str) -> Optional[str]:
+        """Extracted text of the page, or None if it could not be fetched in time"""
+        try:
+            return await asyncio.wait_for(self._flight.do(url, lambda: self._page_text(url)), GROUNDING_FETCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.warning(f"Fetching {url} took over {GROUNDING_FETCH_TIMEOUT:g}s, grounding without it")
+        except Exception as e:
+            # One bad page must not cost the research its other pages and snippets
+            self.failures += 1
+            logger.warning(f"Could not ground on {url}: {type(e).__name__}: {e}")
+        return None
+
+    async def _cache_call(self, method: Callable[..., Any], *args: Any) -> Any:
+        """Run a cache operation off the event loop; None if the cache directory is unusable"""
+        try:
+            return await asyncio.to_thread(method, *args)
+        except OSError as e:
+            self.cache_errors += 1
+            logger.warning(f"Page cache at {self.cache.directory} is unusable: {e}")
+            return None
+
+    async def _page_text(self, url: str) -> Optional[str]:
+        entry = await self._cache_call(self.cache.lookup, url)
+        if entry is not None and time.time() - entry["checked_at"] < GROUNDING_FRESH_SECONDS:
+            text = await self._cache_call(self.cache.read, entry)
+            if text is not None:
+                self.hits += 1
+                return text
+        headers = {"User-Agent": GROUNDING_USER_AGENT, "Accept": "text/html,text/plain;q=0.8"}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        status, response_headers, body, encoding = await self._fetch(url, headers)
+        if status == 304 and entry is not None:
+            text = await self._cache_call(self.cache.read, entry)
+            if text is not None:
+                await self._cache_call(self.cache.revalidated, entry)
+                self.revalidations += 1
+                return text
+            # The text was evicted meanwhile; fetch it unconditionally
+            status, response_headers, body, encoding = await self._fetch(
+                url, {name: value for name, value in headers.items() if not name.startswith("If-")})
+        if status != 200:
+            raise PageFetchError(f"HTTP {status}")
+        self.misses += 1
+        content = decode_body(body, encoding)
+        is_html = "html" in response_headers.get("content-type", "")
+        text = await asyncio.to_thread(extract_text, content) if is_html else " ".join(content.split())
+        if not text:
+            return None
+        await self._cache_call(self.cache.store, url, text, response_headers.get("etag"),
+                               response_headers.get("last-modified"))
+        return text
+
+    async def _fetch(self, url: str, headers: Dict[str, str]) -> Tuple[int, httpx.Headers, bytes, Optional[str]]:
+        """Status, headers, body and charset of a GET, following redirects only to public addresses"""
+        for _ in range(GROUNDING_MAX_REDIRECTS + 1):
+            target, pinned_headers, extensions = pinned_request(url, await resolve_public(url))
+            async with self._client().stream("GET", target, headers={**headers, **pinned_headers},
+                                             timeout=GROUNDING_FETCH_TIMEOUT, extensions=extensions) as response:
+                if response.is_redirect and "location" in response.headers:
+                    url = urljoin(url, response.headers["location"])
+                    continue
+                if response.status_code != 200:
+                    return response.status_code, response.headers, b"", None
+                if not response.headers.get("content-type", "text/html").startswith(_CONTENT_TYPES):
+                    raise PageFetchError(f"unsupported content type {response.headers['content-type']}")
+                body = bytearray()
+                async for chunk in response.aiter_bytes():
+                    body += chunk
+                    if len(body) >= GROUNDING_MAX_BYTES:
+                        # Extract from what arrived; the connection is closed on leaving the block
+                        self.truncated += 1
+                        del body[GROUNDING_MAX_BYTES:]
+                        break
+                return response.status_code, response.headers, bytes(body), response.charset_encoding
+        raise PageFetchError(f"more than {GROUNDING_MAX_REDIRECTS} redirects")
+
+    async def ground(self, results: List[Dict[str, Any]], pages: int = GROUNDING_PAGES) -> List[Dict[str, Any]]:
+        """The results with an ``excerpt`` of the page text added to the top ``pages`` that could be fetched"""
+        top = [index for index, result in enumerate(results) if result.get("url")][:pages]
+        texts = await asyncio.gather(*[self.page_text(results[index]["url"]) for index in top])
+        grounded = list(results)
+        for index, text in zip(top, texts):
+            if text:
+                grounded[index] = {**results[index], "excerpt": excerpt(text)}
+        return grounded
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pages": GROUNDING_PAGES,
+            "hits": self.hits,
+            "revalidations": self.revalidations,
+            "misses": self.misses,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "truncated": self.truncated,
+            "cache_errors": self.cache_errors,
+            "cache": self.cache.stats(),
+        }
+
+
+grounder = Grounder(PageCache())
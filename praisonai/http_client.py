@@ -0,0 +1,202 @@
+# Shared async HTTP client for outbound calls from the Keiken Teams API
+import json
+import logging
+import os
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Upstream service locations
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://ollama:11434").rstrip("/")
+SEARXNG_URL = os.getenv("SEARXNG_URL", "http://searxng:8080").rstrip("/")
+
+# Connection pool limits
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+
+# Per-phase timeouts in seconds. Read timeouts apply between received bytes,
+# so the streaming value bounds the gap between two tokens, not the whole reply.
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_WRITE_TIMEOUT = float(os.getenv("HTTP_WRITE_TIMEOUT", "10"))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "10"))
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "30"))
+OLLAMA_STREAM_READ_TIMEOUT = float(os.getenv("OLLAMA_STREAM_READ_TIMEOUT", "60"))
+SEARXNG_READ_TIMEOUT = float(os.getenv("SEARXNG_READ_TIMEOUT", "10"))
+# Loading a model from disk can take minutes on a cold node
+OLLAMA_LOAD_TIMEOUT = float(os.getenv("OLLAMA_LOAD_TIMEOUT", "300"))
+
+# How long Ollama keeps a model loaded after each request ("30m", "-1" for forever)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+class UpstreamError(Exception):
+    """Raised when an upstream service answers with a non-200 status"""
+
+    def __init__(self, service: str, status_code: int):
+        super().__init__(f"{service} returned status {status_code}")
+        self.service = service
+        self.status_code = status_code
+
+
+def _timeout(read: float) -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=HTTP_CONNECT_TIMEOUT,
+        read=read,
+        write=HTTP_WRITE_TIMEOUT,
+        pool=HTTP_POOL_TIMEOUT,
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the process-wide client, creating it on first use"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=_timeout(OLLAMA_READ_TIMEOUT),
+        )
+        logger.info(
+            f"HTTP client pool created (max_connections={HTTP_MAX_CONNECTIONS}, "
+            f"max_keepalive={HTTP_MAX_KEEPALIVE_CONNECTIONS})"
+        )
+    return _client
+
+
+async def close_http_client() -> None:
+    """Close the shared client and release pooled connections"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def ollama_generate(payload: Dict[str, Any], base_url: str = OLLAMA_URL) -> Dict[str, Any]:
+    """Run a non-streaming Ollama /api/generate call and return the JSON body"""
+    response = await get_http_client().post(
+        f"{base_url}/api/generate",
+        json={"keep_alive": OLLAMA_KEEP_ALIVE, **payload, "stream": False},
+        timeout=_timeout(OLLAMA_READ_TIMEOUT),
+    )
+    if response.status_code != 200:
+        raise UpstreamError("Ollama", response.status_code)
+    return response.json()
+
+
+async def ollama_generate_stream(payload: Dict[str, Any], base_url: str = OLLAMA_URL) -> AsyncGenerator[Dict[str, Any], None]:
+    """Stream an Ollama /api/generate call, yielding each decoded JSON line"""
+    async with get_http_client().stream(
+        "POST",
+        f"{base_url}/api/generate",
+        json={"keep_alive": OLLAMA_KEEP_ALIVE, **payload, "stream": True},
+        timeout=_timeout(OLLAMA_STREAM_READ_TIMEOUT),
+    ) as response:
+        if response.status_code != 200:
+            raise UpstreamError("Ollama", response.status_code)
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            try:
+                chunk_data = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            yield chunk_data
+            if chunk_data.get("done", False):
+                break
+
+
+async def ollama_load(model: str, base_url: str = OLLAMA_URL) -> None:
+    """Load a model into memory without generating (an empty prompt only loads it)"""
+    response = await get_http_client().post(
+        f"{base_url}/api/generate",
+        json={"model": model, "prompt": "", "keep_alive": OLLAMA_KEEP_ALIVE, "stream": False},
+        timeout=_timeout(OLLAMA_LOAD_TIMEOUT),
+    )
+    if response.status_code != 200:
+        raise UpstreamError("Ollama", response.status_code)
+
+
+async def ollama_loaded_models(base_url: str = OLLAMA_URL) -> List[str]:
+    """Names of the models Ollama currently holds in memory"""
+    response = await get_http_client().get(f"{base_url}/api/ps", timeout=_timeout(OLLAMA_READ_TIMEOUT))
+    if response.status_code != 200:
+        raise UpstreamError("Ollama", response.status_code)
+    return [model.get("name", "") for model in response.json().get("models", [])]
+
+
+async def ollama_installed_models(base_url: str = OLLAMA_URL, timeout: float = OLLAMA_READ_TIMEOUT) -> List[str]:
+    """Names of the models pulled on an Ollama instance"""
+    response = await get_http_client().get(f"{base_url}/api/tags", timeout=_timeout(timeout))
+    if response.status_code != 200:
+        raise UpstreamError("Ollama", response.status_code)
+    return [model.get("name", "") for model in response.json().get("models", [])]
+
+
+def _openai_headers(api_key: str) -> Dict[str, str]:
+    return {"Authorization": f"Bearer {api_key}"} if api_key else {}
+
+
+async def openai_completion(base_url: str, api_key: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Run a non-streaming OpenAI-compatible /completions call and return the JSON body"""
+    response = await get_http_client().post(
+        f"{base_url}/completions",
+        json={**payload, "stream": False},
+        headers=_openai_headers(api_key),
+        timeout=_timeout(OLLAMA_READ_TIMEOUT),
+    )
+    if response.status_code != 200:
+        raise UpstreamError("OpenAI-compatible backend", response.status_code)
+    return response.json()
+
+
+async def openai_completion_stream(base_url: str, api_key: str,
+                                   payload: Dict[str, Any]) -> AsyncGenerator[Dict[str, Any], None]:
+    """Stream an OpenAI-compatible /completions call, yielding each decoded SSE event"""
+    async with get_http_client().stream(
+        "POST",
+        f"{base_url}/completions",
+        json={**payload, "stream": True, "stream_options": {"include_usage": True}},
+        headers=_openai_headers(api_key),
+        timeout=_timeout(OLLAMA_STREAM_READ_TIMEOUT),
+    ) as response:
+        if response.status_code != 200:
+            raise UpstreamError("OpenAI-compatible backend", response.status_code)
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                yield json.loads(data)
+            except json.JSONDecodeError:
+                continue
+
+
+async def openai_models(base_url: str, api_key: str, timeout: float = OLLAMA_READ_TIMEOUT) -> List[str]:
+    """Model ids an OpenAI-compatible backend serves"""
+    response = await get_http_client().get(f"{base_url}/models", headers=_openai_headers(api_key),
+                                           timeout=_timeout(timeout))
+    if response.status_code != 200:
+        raise UpstreamError("OpenAI-compatible backend", response.status_code)
+    return [model.get("id", "") for model in response.json().get("data", [])]
+
+
+async def searxng_search(query: str) -> Dict[str, Any]:
+    """Query SearxNG and return the decoded JSON body"""
+    response = await get_http_client().get(
+        f"{SEARXNG_URL}/search",
+        params={"q": query, "format": "json", "categories": "general"},
+        timeout=_timeout(SEARXNG_READ_TIMEOUT),
+    )
+    if response.status_code != 200:
+        raise UpstreamError("SearxNG", response.status_code)
+    return response.json()
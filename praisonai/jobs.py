@@ -0,0 +1,576 @@
+# Durable background jobs for team runs that outlive an HTTP request
+import asyncio
+import fnmatch
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Persistence backend: "sqlite" (on the data volume), "valkey" or "memory" (jobs are lost on restart)
+JOB_BACKEND = os.getenv("JOB_BACKEND", "sqlite")
+JOB_SQLITE_PATH = os.getenv("JOB_SQLITE_PATH", "/app/data/jobs.sqlite3")
+# Valkey (or Redis) URL; "local" uses an in-process stand-in with the same data layout
+VALKEY_URL = os.getenv("VALKEY_URL", "redis://redis:6379/0")
+# Team runs executing at once; further jobs wait in the queued state
+JOB_MAX_CONCURRENCY = int(os.getenv("JOB_MAX_CONCURRENCY", "4"))
+# Unfinished jobs accepted before new submissions are rejected
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "1000"))
+# Finished jobs are kept this many seconds, and at most this many of them
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "86400"))
+JOB_MAX_RETAINED = int(os.getenv("JOB_MAX_RETAINED", "1000"))
+# Longest a poll may wait for a job to finish
+JOB_MAX_WAIT = float(os.getenv("JOB_MAX_WAIT", "60"))
+# Seconds between retention sweeps
+JOB_SWEEP_INTERVAL = float(os.getenv("JOB_SWEEP_INTERVAL", "60"))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TERMINAL = (SUCCEEDED, FAILED, CANCELLED)
+
+_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class JobQueueFullError(Exception):
+    """Raised when too many jobs are waiting to run"""
+
+
+@dataclass
+class Job:
+    """One team run and the status events it went through"""
+    id: str
+    team: str
+    request: Dict[str, Any]
+    status: str = QUEUED
+    created_at: float = 0.0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    attempts: int = 0
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    events: List[Dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def terminal(self) -> bool:
+        return self.status in TERMINAL
+
+    def add_event(self, **fields: Any) -> Dict[str, Any]:
+        event = {"seq": len(self.events) + 1, "type": "status", "status": self.status, "time": time.time(), **fields}
+        self.events.append(event)
+        return event
+
+    def summary(self) -> Dict[str, Any]:
+        summary = {
+            "job_id": self.id,
+            "team": self.team,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "attempts": self.attempts,
+        }
+        if self.result is not None:
+            summary["result"] = self.result
+        if self.error is not None:
+            summary["error"] = self.error
+        return summary
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, data: str) -> "Job":
+        return cls(**json.loads(data))
+
+
+class JobBackend:
+    """Persistence interface for jobs; this base class keeps nothing"""
+
+    async def save(self, job: Job) -> None:
+        pass
+
+    async def load(self, job_id: str) -> Optional[Job]:
+        return None
+
+    async def delete(self, job_id: str) -> None:
+        pass
+
+    async def unfinished(self) -> List[Job]:
+        """Jobs that were queued or running, for recovery after a restart"""
+        return []
+
+    async def purge(self, finished_before: float, keep: int) -> List[str]:
+        """Delete finished jobs older than the cutoff or beyond the newest ``keep``; returns their ids"""
+        return []
+
+
+class SQLiteJobBackend(JobBackend):
+    """One row per job holding its JSON document, written from a worker thread"""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT NOT NULL, finished_at REAL, data TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at)")
+        self._db.commit()
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+            self._db.commit()
+            return rows
+
+    async def save(self, job: Job) -> None:
+        await asyncio.to_thread(
+            self._query,
+            "INSERT OR REPLACE INTO jobs (id, status, finished_at, data) VALUES (?, ?, ?, ?)",
+            (job.id, job.status, job.finished_at, job.to_json())
+        )
+
+    async def load(self, job_id: str) -> Optional[Job]:
+        rows = await asyncio.to_thread(self._query, "SELECT data FROM jobs WHERE id = ?", (job_id,))
+        return Job.from_json(rows[0][0]) if rows else None
+
+    async def delete(self, job_id: str) -> None:
+        await asyncio.to_thread(self._query, "DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    async def unfinished(self) -> List[Job]:
+        rows = await asyncio.to_thread(
+            self._query, "SELECT data FROM jobs WHERE status IN (?, ?) ORDER BY rowid", (QUEUED, RUNNING)
+        )
+        return [Job.from_json(row[0]) for row in rows]
+
+    def _purge(self, finished_before: float, keep: int) -> List[str]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id FROM jobs WHERE finished_at IS NOT NULL AND (finished_at < ? OR id NOT IN "
+                "(SELECT id FROM jobs WHERE finished_at IS NOT NULL ORDER BY finished_at DESC LIMIT ?))",
+                (finished_before, keep)
+            ).fetchall()
+            self._db.executemany("DELETE FROM jobs WHERE id = ?", rows)
+            self._db.commit()
+        return [row[0] for row in rows]
+
+    async def purge(self, finished_before: float, keep: int) -> List[str]:
+        return await asyncio.to_thread(self._purge, finished_before, keep)
+
+
+class LocalValkey:
+    """In-process stand-in for the few Valkey commands the job backend uses"""
+
+    def __init__(self):
+        self._strings: Dict[str, tuple] = {}
+        self._sets: Dict[str, Set[str]] = {}
+        self._zsets: Dict[str, Dict[str, float]] = {}
+
+    async def get(self, name: str) -> Optional[str]:
+        value, expires = self._strings.get(name, (None, None))
+        if expires is not None and time.time() >= expires:
+            del self._strings[name]
+            return None
+        return value
+
+    async def set(self, name: str, value: str, ex: Optional[float] = None) -> None:
+        self._strings[name] = (value, time.time() + ex if ex else None)
+
+    async def delete(self, *names: str) -> None:
+        for name in names:
+            self._strings.pop(name, None)
+            self._sets.pop(name, None)
+            self._zsets.pop(name, None)
+
+    async def sadd(self, name: str, *values: str) -> None:
+        self._sets.setdefault(name, set()).update(values)
+
+    async def srem(self, name: str, *values: str) -> None:
+        self._sets.get(name, set()).difference_update(values)
+
+    async def smembers(self, name: str) -> Set[str]:
+        return set(self._sets.get(name, set()))
+
+    async def zadd(self, name: str, mapping: Dict[str, float]) -> None:
+        self._zsets.setdefault(name, {}).update(mapping)
+
+    async def zrem(self, name: str, *values: str) -> None:
+        for value in values:
+            self._zsets.get(name, {}).pop(value, None)
+
+    async def zrangebyscore(self, name: str, low: Any, high: float) -> List[str]:
+        members = sorted(self._zsets.get(name, {}).items(), key=lambda item: item[1])
+        return [member for member, score in members if score <= high]
+
+    async def zrange(self, name: str, start: int, end: int) -> List[str]:
+        members = sorted(self._zsets.get(name, {}).items(), key=lambda item: item[1])
+        return [member for member, _ in members][start:None if end == -1 else end + 1]
+
+    async def zcard(self, name: str) -> int:
+        return len(self._zsets.get(name, {}))
+
+    async def keys(self, pattern: str) -> List[str]:
+        return [name for name in self._strings if fnmatch.fnmatchcase(name, pattern)]
+
+    async def aclose(self) -> None:
+        pass
+
+
+class ValkeyJobBackend(JobBackend):
+    """Job documents under ``keiken:job:<id>`` plus indexes of unfinished and finished ids
+
+    Finished documents carry an expiry of the retention TTL, so Valkey drops
+    them even if this service is down when they age out.
+    """
+
+    PREFIX = "keiken:job:"
+    UNFINISHED = "keiken:jobs:unfinished"
+    FINISHED = "keiken:jobs:finished"
+
+    def __init__(self, client, result_ttl: float = JOB_RESULT_TTL):
+        self.client = client
+        self.result_ttl = result_ttl
+
+    async def save(self, job: Job) -> None:
+        key = self.PREFIX + job.id
+        if job.terminal:
+            await self.client.set(key, job.to_json(), ex=max(1, int(self.result_ttl)))
+            await self.client.srem(self.UNFINISHED, job.id)
+            await self.client.zadd(self.FINISHED, {job.id: job.finished_at or time.time()})
+        else:
+            await self.client.set(key, job.to_json())
+            await self.client.sadd(self.UNFINISHED, job.id)
+
+    async def load(self, job_id: str) -> Optional[Job]:
+        data = await self.client.get(self.PREFIX + job_id)
+        return Job.from_json(data) if data else None
+
+    async def delete(self, job_id: str) -> None:
+        await self.client.delete(self.PREFIX + job_id)
+        await self.client.srem(self.UNFINISHED, job_id)
+        await self.client.zrem(self.FINISHED, job_id)
+
+    async def unfinished(self) -> List[Job]:
+        jobs = []
+        for job_id in await self.client.smembers(self.UNFINISHED):
+            job = await self.load(job_id)
+            if job is not None:
+                jobs.append(job)
+        return sorted(jobs, key=lambda job: job.created_at)
+
+    async def purge(self, finished_before: float, keep: int) -> List[str]:
+        purged = list(await self.client.zrangebyscore(self.FINISHED, "-inf", finished_before))
+        excess = await self.client.zcard(self.FINISHED) - len(purged) - keep
+        if excess > 0:
+            oldest = await self.client.zrange(self.FINISHED, len(purged), len(purged) + excess - 1)
+            purged += list(oldest)
+        if purged:
+            await self.client.delete(*(self.PREFIX + job_id for job_id in purged))
+            await self.client.zrem(self.FINISHED, *purged)
+        return purged
+
+
+def make_valkey_client(url: str):
+    if url == "local":
+        return LocalValkey()
+    try:
+        # Valkey speaks the Redis protocol, so the redis client talks to it unchanged
+        import redis.asyncio as redis_asyncio
+    except ImportError:
+        logger.warning("The redis package is not installed; using the in-process Valkey stand-in")
+        return LocalValkey()
+    return redis_asyncio.from_url(url, decode_responses=True)
+
+
+def make_job_backend(name: str) -> JobBackend:
+    if name == "sqlite":
+        try:
+            return SQLiteJobBackend(JOB_SQLITE_PATH)
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Cannot open the job database at {JOB_SQLITE_PATH} ({e}); keeping jobs in memory only")
+            return JobBackend()
+    if name == "valkey":
+        return ValkeyJobBackend(make_valkey_client(VALKEY_URL))
+    if name != "memory":
+        logger.warning(f"Unknown JOB_BACKEND {name!r}, keeping jobs in memory only")
+    return JobBackend()
+
+
+# Runs a job's team request; the callback publishes live events to anyone streaming the job
+JobRunner = Callable[[Job, Callable[[Dict[str, Any]], None]], Awaitable[Dict[str, Any]]]
+
+
+class JobStore:
+    """Runs submitted jobs in the background and keeps their state in a backend
+
+    Jobs still queued or running when the worker stopped are picked up again
+    from the backend at startup and run from the beginning. Status changes
+    are persisted as events; generated text is only relayed live to callers
+    streaming the job's events.
+    """
+
+    def __init__(self, backend: JobBackend, max_concurrency: int = JOB_MAX_CONCURRENCY,
+                 max_pending: int = JOB_MAX_PENDING, result_ttl: float = JOB_RESULT_TTL,
+                 max_retained: int = JOB_MAX_RETAINED):
+        self.backend = backend
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.max_retained = max_retained
+        self._slots = asyncio.Semaphore(max(1, max_concurrency))
+        self.max_concurrency = max(1, max_concurrency)
+        self._jobs: Dict[str, Job] = {}
+        self._finished: "OrderedDict[str, float]" = OrderedDict()
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._cancelling: Set[str] = set()
+        self._changed: Dict[str, asyncio.Event] = {}
+        self._listeners: Dict[str, Set[asyncio.Queue]] = {}
+        self._run: Optional[JobRunner] = None
+        self._sweeper: Optional[asyncio.Task] = None
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.recovered = 0
+        self.purged = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    async def start(self, run: JobRunner) -> None:
+        """Begin running jobs, resuming those the previous worker left unfinished"""
+        self._run = run
+        try:
+            unfinished = await self.backend.unfinished()
+        except Exception as e:
+            logger.error(f"Could not recover unfinished jobs: {e}")
+            unfinished = []
+        for job in unfinished:
+            job.status = QUEUED
+            job.add_event(recovered=True)
+            self._jobs[job.id] = job
+            self._launch(job)
+            self.recovered += 1
+        if unfinished:
+            logger.info(f"Resumed {len(unfinished)} unfinished jobs")
+        if self._sweeper is None:
+            self._sweeper = asyncio.ensure_future(self._sweep_periodically())
+
+    async def stop(self) -> None:
+        """Stop running jobs; they stay unfinished in the backend and are resumed on the next start"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        close = getattr(getattr(self.backend, "client", None), "aclose", None)
+        if close is not None:
+            await close()
+
+    async def submit(self, team: str, request: Dict[str, Any]) -> Job:
+        if self.pending >= self.max_pending:
+            raise JobQueueFullError(f"{self.pending} jobs are already waiting")
+        now = time.time()
+        job = Job(uuid.uuid4().hex, team, request, created_at=now)
+        job.add_event()
+        await self.backend.save(job)
+        self._jobs[job.id] = job
+        self.submitted += 1
+        self._launch(job)
+        return job
+
+    def _launch(self, job: Job) -> None:
+        self._tasks[job.id] = asyncio.ensure_future(self._execute(job))
+
+    async def _execute(self, job: Job) -> None:
+        try:
+            async with self._slots:
+                job.status = RUNNING
+                job.started_at = time.time()
+                job.attempts += 1
+                await self._update(job, attempt=job.attempts)
+                try:
+                    job.result = await self._run(job, lambda event: self._publish(job.id, event))
+                    job.status = SUCCEEDED if job.result.get("ok", True) else FAILED
+                except asyncio.CancelledError:
+                    if job.id not in self._cancelling:
+                        # Worker shutdown: leave the job unfinished for the next start
+                        raise
+                    job.status = CANCELLED
+                except Exception as e:
+                    logger.error(f"Job {job.id} failed: {e}")
+                    job.status = FAILED
+                    job.error = str(e)
+                await self._finish(job)
+        except asyncio.CancelledError:
+            if job.id in self._cancelling and not job.terminal:
+                # Cancelled while still waiting for a slot
+                job.status = CANCELLED
+                await self._finish(job)
+            elif job.id not in self._cancelling:
+                raise
+        finally:
+            self._tasks.pop(job.id, None)
+            self._cancelling.discard(job.id)
+
+    async def _finish(self, job: Job) -> None:
+        job.finished_at = time.time()
+        if job.status == SUCCEEDED:
+            self.succeeded += 1
+        elif job.status == FAILED:
+            self.failed += 1
+        else:
+            self.cancelled += 1
+        self._finished[job.id] = job.finished_at
+        await self._update(job, **({"result": job.result} if job.result is not None else {}),
+                           **({"error": job.error} if job.error else {}))
+
+    async def _update(self, job: Job, **fields: Any) -> None:
+        event = job.add_event(**fields)
+        try:
+            await self.backend.save(job)
+        except Exception as e:
+            logger.error(f"Could not persist job {job.id}: {e}")
+        self._publish(job.id, event)
+        changed = self._changed.pop(job.id, None)
+        if changed is not None:
+            changed.set()
+
+    def _publish(self, job_id: str, event: Dict[str, Any]) -> None:
+        for queue in self._listeners.get(job_id, ()):
+            queue.put_nowait(event)
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        if not _JOB_ID.match(job_id):
+            return None
+        job = self._jobs.get(job_id)
+        if job is None:
+            job = await self.backend.load(job_id)
+            if job is not None and job.terminal:
+                self._jobs[job_id] = job
+                self._finished[job_id] = job.finished_at or time.time()
+        return job
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Job]:
+        """The job once it has finished, or as it stands after ``timeout`` seconds"""
+        deadline = time.monotonic() + min(timeout, JOB_MAX_WAIT)
+        while True:
+            job = await self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job.terminal or remaining <= 0 or job_id not in self._tasks:
+                return job
+            changed = self._changed.setdefault(job_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def events(self, job_id: str, after: int = 0) -> AsyncIterator[Dict[str, Any]]:
+        """Recorded status events after ``after``, then live ones until the job finishes"""
+        queue: asyncio.Queue = asyncio.Queue()
+        self._listeners.setdefault(job_id, set()).add(queue)
+        try:
+            job = await self.get(job_id)
+            if job is None:
+                return
+            last = after
+            for event in list(job.events):
+                if event["seq"] > last:
+                    last = event["seq"]
+                    yield event
+            if job.terminal or job_id not in self._tasks:
+                return
+            while True:
+                event = await queue.get()
+                if "seq" in event:
+                    if event["seq"] <= last:
+                        continue
+                    last = event["seq"]
+                yield event
+                if event.get("type") == "status" and event["status"] in TERMINAL:
+                    return
+        finally:
+            listeners = self._listeners.get(job_id)
+            if listeners is not None:
+                listeners.discard(queue)
+                if not listeners:
+                    del self._listeners[job_id]
+
+    async def cancel(self, job_id: str) -> Optional[Job]:
+        """Stop a queued or running job; finished jobs are returned unchanged"""
+        job = await self.get(job_id)
+        task = self._tasks.get(job_id)
+        if job is None or job.terminal or task is None:
+            return job
+        self._cancelling.add(job_id)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return job
+
+    async def delete(self, job_id: str) -> bool:
+        job = await self.cancel(job_id)
+        if job is None:
+            return False
+        self._jobs.pop(job_id, None)
+        self._finished.pop(job_id, None)
+        await self.backend.delete(job_id)
+        return True
+
+    async def sweep(self) -> int:
+        """Apply the retention limits to finished jobs; returns how many were removed"""
+        cutoff = time.time() - self.result_ttl
+        expired = [job_id for job_id, finished_at in self._finished.items() if finished_at < cutoff]
+        expired += list(self._finished)[len(expired):max(len(expired), len(self._finished) - self.max_retained)]
+        for job_id in expired:
+            self._finished.pop(job_id, None)
+            self._jobs.pop(job_id, None)
+        try:
+            removed = set(await self.backend.purge(cutoff, self.max_retained)) | set(expired)
+        except Exception as e:
+            logger.error(f"Could not purge finished jobs: {e}")
+            removed = set(expired)
+        self.purged += len(removed)
+        return len(removed)
+
+    async def _sweep_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(JOB_SWEEP_INTERVAL)
+            await self.sweep()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": type(self.backend).__name__,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "max_concurrency": self.max_concurrency,
+            "finished_in_memory": len(self._finished),
+            "result_ttl_seconds": self.result_ttl,
+            "max_retained": self.max_retained,
+            "submitted": self.submitted,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "recovered": self.recovered,
+            "purged": self.purged,
+        }
+
+
+job_store = JobStore(make_job_backend(JOB_BACKEND))
@@ -0,0 +1,138 @@
+# Resume Ollama generations from the KV context of a conversation's previous turn
+import array
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+
+from backends import backend_pool
+from caching import TTLCache
+from context_builder import ConversationHistory, Turn, context_window, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Set to false to always send the full prompt
+KV_REUSE_ENABLED = os.getenv("KV_REUSE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Stored context arrays (4 bytes per token) are bounded by count, bytes and age
+KV_CONTEXT_TTL = float(os.getenv("KV_CONTEXT_TTL", "1800"))
+KV_CONTEXT_MAX_ENTRIES = int(os.getenv("KV_CONTEXT_MAX_ENTRIES", "2048"))
+KV_CONTEXT_MAX_BYTES = int(os.getenv("KV_CONTEXT_MAX_BYTES", str(64 * 1024 * 1024)))
+# Turns searched back for a generation the conversation can resume from
+KV_REUSE_LOOKBACK = int(os.getenv("KV_REUSE_LOOKBACK", "6"))
+# Window space kept free for the response when resuming; otherwise the full prompt is rebuilt
+KV_REUSE_RESPONSE_TOKENS = int(os.getenv("KV_REUSE_RESPONSE_TOKENS", "1024"))
+
+
+@dataclass
+class _StoredContext:
+    tokens: array.array
+    reply: str
+
+
+@dataclass
+class Resumption:
+    """A stored context a generation can continue from, and the turns it has not seen"""
+    context: List[int]
+    new_turns: List[Turn]
+    model: str
+
+
+class KVContextStore:
+    """Ollama ``context`` arrays keyed by the conversation state they end at
+
+    After each generation the returned token array is stored under the hash of
+    the history the prompt was built from. A later request whose history extends
+    that one sends only a continuation prompt together with the stored tokens,
+    so Ollama skips re-evaluating the team prompt and earlier turns. When the
+    history diverged (an edited or regenerated answer, a changed system
+    prompt), nothing matches and the caller sends the full prompt as before.
+    """
+
+    def __init__(self, cache: Optional[TTLCache] = None, enabled: bool = KV_REUSE_ENABLED):
+        self.enabled = enabled
+        self.cache = cache or TTLCache(
+            KV_CONTEXT_MAX_ENTRIES,
+            KV_CONTEXT_TTL,
+            max_bytes=KV_CONTEXT_MAX_BYTES,
+            sizeof=lambda stored: stored.tokens.itemsize * len(stored.tokens) + len(stored.reply)
+        )
+        self.lookups = 0
+        self.resumed = 0
+        self.not_found = 0
+        self.diverged = 0
+        self.overflowed = 0
+        self.stored = 0
+        self.tokens_reused = 0
+
+    @staticmethod
+    def _key(team: str, call: str, model: str, history: ConversationHistory, digest: str) -> tuple:
+        return (team, call, model, history.pinned_digest, digest)
+
+    def find(self, team: str, call: str, model: str, history: Optional[ConversationHistory],
+             own_reply: bool = False) -> Optional[Resumption]:
+        """Newest stored context this history extends, or None
+
+        With ``own_reply`` the generation's answer must come back unchanged as
+        the next assistant turn; it is already in the context, so it is left
+        out of the new turns.
+        """
+        if not self.enabled or history is None or not backend_pool.supports_context(model):
+            return None
+        self.lookups += 1
+        recent = history.recent(KV_REUSE_LOOKBACK + 1)
+        # The newest turn is this request's own; a context stored for it already holds an answer
+        for index in range(1, len(recent)):
+            stored = self.cache.get(self._key(team, call, model, history, recent[index][0]))
+            if stored is None:
+                continue
+            new_turns = [turn for _, turn in reversed(recent[:index])]
+            if own_reply:
+                if new_turns[0].role != "assistant" or new_turns[0].content.strip() != stored.reply:
+                    self.diverged += 1
+                    return None
+                new_turns = new_turns[1:]
+            return Resumption(stored.tokens.tolist(), new_turns, model)
+        self.not_found += 1
+        return None
+
+    def fits(self, resumption: Resumption, prompt: str, window: Optional[int] = None) -> bool:
+        """Whether the continuation still leaves room for a response in the model's window, or in ``window``"""
+        if len(resumption.context) + estimate_tokens(prompt) + KV_REUSE_RESPONSE_TOKENS > (window or context_window(resumption.model)):
+            # Start over from a freshly budgeted prompt, which also resets the stored context
+            self.overflowed += 1
+            return False
+        self.resumed += 1
+        self.tokens_reused += len(resumption.context)
+        return True
+
+    def remember(self, team: str, call: str, model: str, history: Optional[ConversationHistory],
+                 context: Optional[Sequence[int]], reply: str = "") -> None:
+        """Store the context a generation returned for the history its prompt was built from"""
+        if not self.enabled or history is None or not context:
+            return
+        recent = history.recent(1)
+        if not recent:
+            return
+        try:
+            tokens = array.array("i", context)
+        except (TypeError, OverflowError) as e:
+            logger.warning(f"Ignoring unusable Ollama context: {e}")
+            return
+        self.cache.set(self._key(team, call, model, history, recent[0][0]), _StoredContext(tokens, reply.strip()))
+        self.stored += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "lookups": self.lookups,
+            "resumed": self.resumed,
+            "not_found": self.not_found,
+            "diverged": self.diverged,
+            "overflowed": self.overflowed,
+            "stored": self.stored,
+            "tokens_reused": self.tokens_reused,
+            "contexts": self.cache.stats(),
+        }
+
+
+kv_contexts = KVContextStore()
@@ -0,0 +1,285 @@
+# Prometheus metrics for the Keiken Teams API
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, Metric
+
+from streaming import StreamSummary
+
+# Request phases timed per team
+PHASE_CONTEXT_BUILD = "context_build"
+PHASE_SEARCH = "search"
+PHASE_QUEUE_WAIT = "queue_wait"
+PHASE_AGENT_GENERATION = "agent_generation"
+PHASE_AGGREGATION_GENERATION = "aggregation_generation"
+PHASE_SERIALIZATION = "serialization"
+
+REQUESTS = Counter(
+    "keiken_requests_total",
+    "Team requests by endpoint, streaming and outcome",
+    ["team", "endpoint", "stream", "status"]
+)
+REQUEST_SECONDS = Histogram(
+    "keiken_request_duration_seconds",
+    "Time from receiving a team request to sending the last byte of its response",
+    ["team", "endpoint", "stream"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+)
+FIRST_TOKEN_SECONDS = Histogram(
+    "keiken_time_to_first_token_seconds",
+    "Time from receiving a streaming team request to sending its first content frame",
+    ["team", "endpoint"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60)
+)
+PHASE_SECONDS = Histogram(
+    "keiken_phase_duration_seconds",
+    "Time spent in each phase of a team request",
+    ["team", "phase"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+PROMPT_TOKENS = Counter(
+    "keiken_prompt_tokens_total",
+    "Prompt tokens sent to the model, including those served from the KV cache",
+    ["team", "kind"]
+)
+CACHED_PROMPT_TOKENS = Counter(
+    "keiken_cached_prompt_tokens_total",
+    "Prompt tokens the model skipped evaluating because they were in its KV cache",
+    ["team", "kind"]
+)
+COMPLETION_TOKENS = Counter(
+    "keiken_completion_tokens_total",
+    "Tokens generated by the model",
+    ["team", "kind"]
+)
+TOKENS_PER_SECOND = Histogram(
+    "keiken_generation_tokens_per_second",
+    "Decode throughput of each generation as reported by the model",
+    ["team", "kind"],
+    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 250)
+)
+SEARCHES = Counter(
+    "keiken_search_requests_total",
+    "Internet searches by outcome",
+    ["outcome"]
+)
+
+
+@dataclass
+class RequestMetrics:
+    """Labels an endpoint attaches to its request once the team is known
+
+    ``summary`` is the stream's summary for streaming responses; a stream
+    that did not complete, or a non-streaming result with ``ok`` unset, is
+    counted as degraded rather than ok.
+    """
+    team: str
+    endpoint: str
+    stream: bool
+    summary: Optional[StreamSummary] = None
+    ok: bool = True
+
+
+def label_request(request: Any, team: str, endpoint: str, stream: bool,
+                  summary: Optional[StreamSummary] = None) -> RequestMetrics:
+    """Mark a request for the metrics middleware; unlabelled requests are not counted"""
+    labels = RequestMetrics(team, endpoint, stream, summary)
+    request.state.metrics = labels
+    return labels
+
+
+def observe_phase(team: str, phase: str, seconds: float) -> None:
+    PHASE_SECONDS.labels(team, phase).observe(seconds)
+
+
+@contextmanager
+def timed_phase(team: str, phase: str) -> Iterator[None]:
+    """Time the body as one phase of a team request"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASE_SECONDS.labels(team, phase).observe(time.perf_counter() - started)
+
+
+def observe_usage(team: str, kind: str, usage: Any) -> None:
+    """Token counters for one finished generation"""
+    PROMPT_TOKENS.labels(team, kind).inc(usage.prompt_tokens)
+    CACHED_PROMPT_TOKENS.labels(team, kind).inc(usage.cached_tokens)
+    COMPLETION_TOKENS.labels(team, kind).inc(usage.completion_tokens)
+    if usage.eval_ms:
+        TOKENS_PER_SECOND.labels(team, kind).observe(usage.tokens_per_second())
+
+
+def observe_search(outcome: str) -> None:
+    SEARCHES.labels(outcome).inc()
+
+
+def _status(labels: RequestMetrics, status_code: int, disconnected: bool) -> str:
+    if disconnected or status_code == 499:
+        return "disconnected"
+    if status_code >= 500:
+        return "error"
+    if status_code == 429:
+        return "rejected"
+    if status_code >= 400:
+        return "client_error"
+    if not labels.ok or (labels.summary is not None and not labels.summary.completed):
+        return "degraded"
+    return "ok"
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording duration, time to first token and outcome of labelled requests
+
+    It only looks at the messages passing through: per streamed frame that is
+    one extra call and a couple of comparisons, and everything is observed
+    once when the response ends.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        state = scope.setdefault("state", {})
+        status_code = 500
+        first_body = 0.0
+        finished = False
+        disconnected = False
+
+        async def receive_wrapper():
+            nonlocal disconnected
+            message = await receive()
+            if message["type"] == "http.disconnect" and not finished:
+                disconnected = True
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status_code, first_body, finished
+            if message["type"] == "http.response.body":
+                if not first_body and message.get("body"):
+                    first_body = time.perf_counter()
+                if not message.get("more_body", False):
+                    finished = True
+            elif message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        except BaseException:
+            if not finished:
+                status_code = 500
+            raise
+        finally:
+            labels = state.get("metrics")
+            if labels is not None:
+                self._record(labels, started, first_body, status_code, disconnected)
+
+    @staticmethod
+    def _record(labels: RequestMetrics, started: float, first_body: float,
+                status_code: int, disconnected: bool) -> None:
+        stream = "true" if labels.stream else "false"
+        ended = time.perf_counter()
+        REQUESTS.labels(labels.team, labels.endpoint, stream, _status(labels, status_code, disconnected)).inc()
+        REQUEST_SECONDS.labels(labels.team, labels.endpoint, stream).observe(ended - started)
+        if labels.stream and first_body and status_code < 400:
+            FIRST_TOKEN_SECONDS.labels(labels.team, labels.endpoint).observe(first_body - started)
+        if labels.summary is not None and labels.summary.serialize_seconds:
+            PHASE_SECONDS.labels(labels.team, PHASE_SERIALIZATION).observe(labels.summary.serialize_seconds)
+
+
+class _CallbackCollector:
+    def __init__(self, collect: Callable[[], Iterable[Metric]]):
+        self._collect = collect
+
+    def collect(self) -> Iterable[Metric]:
+        return self._collect()
+
+
+def register_collector(collect: Callable[[], Iterable[Metric]]) -> None:
+    """Export metric families built from existing stats at scrape time"""
+    REGISTRY.register(_CallbackCollector(collect))
+
+
+class RuntimeCollector:
+    """Scheduler, circuit, backend, cache and job figures read from their stats at scrape time
+
+    It is given the objects server.py builds rather than importing them, as
+    most of their modules import this one for their own metrics. Nothing is
+    computed on the request path; each scrape reads the current counters.
+    """
+
+    def __init__(self, model_warmer: Any, scheduler: Any, backend_pool: Any,
+                 circuits: Callable[[], Dict[str, Dict[str, Any]]], caches: Sequence[Tuple[str, Any]],
+                 job_store: Any):
+        self.model_warmer = model_warmer
+        self.scheduler = scheduler
+        self.backend_pool = backend_pool
+        self.circuits = circuits
+        # (name, object with hits and misses counters)
+        self.caches = caches
+        self.job_store = job_store
+
+    def collect(self) -> Iterator[Metric]:
+        models_ready = GaugeMetricFamily("keiken_models_ready", "Whether every team model is loaded on a backend")
+        models_ready.add_metric([], 1 if self.model_warmer.ready else 0)
+        yield models_ready
+
+        running = GaugeMetricFamily("keiken_generations_running", "Generations holding a scheduler slot")
+        running.add_metric([], self.scheduler.running)
+        yield running
+        queued = GaugeMetricFamily("keiken_generation_queue_depth", "Generations waiting for a scheduler slot",
+                                   labels=["priority"])
+        for priority, depth in self.scheduler.stats()["queue_depth_by_priority"].items():
+            queued.add_metric([priority], depth)
+        yield queued
+
+        circuits = GaugeMetricFamily("keiken_circuit_state",
+                                     "Circuit breaker state per upstream dependency (1 for the current state)",
+                                     labels=["service", "state"])
+        trips = CounterMetricFamily("keiken_circuit_trips", "Times each circuit has opened", labels=["service"])
+        for service, circuit in self.circuits().items():
+            for state in ("closed", "open", "half_open"):
+                circuits.add_metric([service, state], 1 if circuit["state"] == state else 0)
+            trips.add_metric([service], circuit["trips"])
+        yield circuits
+        yield trips
+
+        outstanding = GaugeMetricFamily("keiken_backend_outstanding_requests",
+                                        "Generations in flight on each model backend", labels=["backend"])
+        available = GaugeMetricFamily("keiken_backend_available",
+                                      "Whether each model backend is healthy and not ejected", labels=["backend"])
+        for backend in self.backend_pool.backends:
+            outstanding.add_metric([backend.name], backend.outstanding)
+            available.add_metric([backend.name], 1 if backend.available else 0)
+        yield outstanding
+        yield available
+
+        hits = CounterMetricFamily("keiken_cache_hits", "Lookups served from each in-process cache", labels=["cache"])
+        misses = CounterMetricFamily("keiken_cache_misses", "Lookups that missed each in-process cache",
+                                     labels=["cache"])
+        for name, cache in self.caches:
+            hits.add_metric([name], cache.hits)
+            misses.add_metric([name], cache.misses)
+        yield hits
+        yield misses
+
+        jobs = GaugeMetricFamily("keiken_jobs_pending", "Background jobs queued or running")
+        jobs.add_metric([], self.job_store.pending)
+        yield jobs
+
+
+def render_metrics() -> bytes:
+    return generate_latest(REGISTRY)
+
+
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
@@ -0,0 +1,303 @@
+# Staged team workflows: each stage has its own prompt, model and token limit and runs once its inputs are ready
+import asyncio
+import logging
+import os
+import time
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from backends import backend_pool
+from disconnect import cancellation_stats
+from generation import note_options
+from http_client import UpstreamError
+from metrics import observe_phase
+from scheduler import PRIORITY_INTERACTIVE, scheduler
+from streaming import StreamSanitizer
+from team_engine import AgentResult, agent_model, research_section
+from tracing import generation_span, span
+from usage import GenerationUsage, usage_stats
+
+logger = logging.getLogger(__name__)
+
+# Model for stages marked "tier: small" (routing, scoring); stages fall back to their
+# agent's model when no backend serves it
+PIPELINE_SMALL_MODEL = os.getenv("PIPELINE_SMALL_MODEL", "llama3.2:3b")
+# Token limit for stages that do not set max_tokens
+PIPELINE_STAGE_MAX_TOKENS = int(os.getenv("PIPELINE_STAGE_MAX_TOKENS", "1024"))
+
+_STAGE_FIELDS = {"name": str, "agent": str, "task": str, "title": str, "after": list, "when": dict,
+                 "choices": list, "model": str, "tier": str, "max_tokens": int}
+_TIERS = ("default", "small")
+
+
+class PipelineError(ValueError):
+    """Raised when a team's pipeline definition is invalid"""
+
+
+@dataclass(frozen=True)
+class Stage:
+    """One compiled pipeline step; stages without a title run but are not shown"""
+    name: str
+    agent: Dict[str, Any]
+    # The agent's persona, the team's instructions and the stage's task
+    prefix: str
+    after: Tuple[str, ...]
+    title: Optional[str]
+    max_tokens: int
+    model: str
+    small: bool
+    choices: Tuple[str, ...] = ()
+    # (router stage, choice) that must have been picked for this stage to run
+    when: Optional[Tuple[str, str]] = None
+
+    def resolve_model(self) -> str:
+        if self.small and PIPELINE_SMALL_MODEL and backend_pool.serves(PIPELINE_SMALL_MODEL):
+            return PIPELINE_SMALL_MODEL
+        return self.model
+
+
+def stage_prompt_prefix(team_config: Dict, agent: Dict, team_instructions: str, task: str) -> str:
+    return f"""You are {agent['name']}, a {agent['role']} on the {team_config['name']}.
+
+Your goal: {agent['goal']}
+Your background: {agent['backstory']}
+
+TEAM WORKFLOW INSTRUCTIONS:
+{team_instructions}
+
+Your step in this workflow: {task}"""
+
+
+def build_stage_prompt(stage: Stage, conversation_context: str, current_query: str,
+                       inputs: List[Tuple[str, str]], search_results: Optional[str] = None) -> str:
+    """Prompt for one stage, followed by the outputs of the stages it depends on"""
+    prompt = f"""{stage.prefix}
+
+Conversation history:
+{conversation_context}
+
+Current question: {current_query}"""
+    for title, output in inputs:
+        prompt += f"\n\nOutput of the \"{title}\" step:\n{output}"
+    return prompt + research_section(stage.agent, search_results)
+
+
+def compile_pipeline(team_id: str, team_config: Dict, team_instructions: str) -> Tuple[Stage, ...]:
+    """Validate ``team_config["pipeline"]`` and render each stage's static prompt once"""
+    where = f"teams.{team_id}.pipeline"
+    agents = {agent["name"]: agent for agent in team_config["agents"]}
+    stages: Dict[str, Stage] = {}
+    for index, data in enumerate(team_config["pipeline"]):
+        stage_where = f"{where}[{index}]"
+        if not isinstance(data, dict):
+            raise PipelineError(f"{stage_where}: must be a mapping")
+        for key, value in data.items():
+            if key not in _STAGE_FIELDS:
+                raise PipelineError(f"{stage_where}: unknown field {key!r}")
+            if not isinstance(value, _STAGE_FIELDS[key]):
+                raise PipelineError(f"{stage_where}.{key}: must be a {_STAGE_FIELDS[key].__name__}")
+        for key in ("name", "agent", "task"):
+            if not data.get(key):
+                raise PipelineError(f"{stage_where}: {key!r} is required")
+        name = data["name"]
+        if name in stages:
+            raise PipelineError(f"{stage_where}: duplicate stage name {name!r}")
+        agent = agents.get(data["agent"])
+        if agent is None:
+            raise PipelineError(f"{stage_where}.agent: no agent named {data['agent']!r} in the team")
+        after = tuple(data.get("after", []))
+        for dependency in after:
+            # Only earlier stages may be inputs, which also rules out cycles
+            if dependency not in stages:
+                raise PipelineError(f"{stage_where}.after: {dependency!r} is not an earlier stage")
+        when = None
+        if "when" in data:
+            if len(data["when"]) != 1:
+                raise PipelineError(f"{stage_where}.when: must name exactly one router stage")
+            router, choice = next(iter(data["when"].items()))
+            if router not in after:
+                raise PipelineError(f"{stage_where}.when: {router!r} must also be listed in after")
+            if choice not in stages[router].choices:
+                raise PipelineError(f"{stage_where}.when: {choice!r} is not one of {router!r}'s choices")
+            when = (router, choice)
+        tier = data.get("tier", "default")
+        if tier not in _TIERS:
+            raise PipelineError(f"{stage_where}.tier: must be one of {', '.join(_TIERS)}")
+        max_tokens = data.get("max_tokens", PIPELINE_STAGE_MAX_TOKENS)
+        if max_tokens <= 0:
+            raise PipelineError(f"{stage_where}.max_tokens: must be positive")
+        stages[name] = Stage(
+            name=name,
+            agent=agent,
+            prefix=stage_prompt_prefix(team_config, agent, team_instructions, data["task"].strip()),
+            after=after,
+            title=data.get("title"),
+            max_tokens=max_tokens,
+            model=data.get("model") or agent_model(team_id, team_config, agent),
+            small=tier == "small",
+            choices=tuple(str(choice) for choice in data.get("choices", [])),
+            when=when,
+        )
+    if not stages:
+        raise PipelineError(f"{where}: at least one stage is required")
+    if not any(stage.title for stage in stages.values()):
+        raise PipelineError(f"{where}: at least one stage needs a title to be shown")
+    return tuple(stages.values())
+
+
+def pick_choice(output: str, choices: Tuple[str, ...]) -> str:
+    """The choice named earliest in a router's output; the first choice if it named none"""
+    text = output.lower().replace(" ", "_").replace("-", "_")
+    found = [(text.find(choice.lower()), choice) for choice in choices if choice.lower() in text]
+    return min(found)[1] if found else choices[0]
+
+
+class PipelineRun:
+    """One execution of a team pipeline
+
+    Every stage starts as its own task and waits for the stages listed in its
+    ``after``, so independent branches generate in parallel, each holding a
+    scheduler slot only while it generates. ``tokens()`` relays the titled
+    stages in declaration order: the stage being shown streams live while
+    later ones buffer, and each is introduced by a ``### title`` line.
+    """
+
+    def __init__(self, team_id: str, stages: Tuple[Stage, ...], conversation_context: str,
+                 current_query: str, priority: int = PRIORITY_INTERACTIVE,
+                 search_results: Optional[str] = None, options: Optional[Dict[str, Any]] = None):
+        self.team_id = team_id
+        self.stages = stages
+        self.conversation_context = conversation_context
+        self.current_query = current_query
+        self.priority = priority
+        self.search_results = search_results
+        # The request's resolved options; stop sequences only reach the stages that are shown
+        self.options = options or {}
+        self.started = time.perf_counter()
+        self.outputs: Dict[str, str] = {}
+        self.choices: Dict[str, str] = {}
+        self._results: Dict[str, AgentResult] = {}
+        self._titles = {stage.name: stage.title or stage.name for stage in stages}
+        self._done = {stage.name: asyncio.Event() for stage in stages}
+        # Per titled stage: cleaned chunks, ended by None; empty if the stage was skipped
+        self._queues: Dict[str, asyncio.Queue] = {stage.name: asyncio.Queue() for stage in stages if stage.title}
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def results(self) -> List[AgentResult]:
+        """Per-stage outcome and latency in declaration order, for the response's ``agents``"""
+        return [self._results[stage.name] for stage in self.stages if stage.name in self._results]
+
+    @property
+    def ok(self) -> bool:
+        """Whether the last stage that ran produced its output"""
+        ran = [result for result in self.results if result.status != "skipped"]
+        return bool(ran) and ran[-1].status == "ok"
+
+    async def tokens(self) -> AsyncIterator[str]:
+        self._tasks = [asyncio.ensure_future(self._run_stage(stage)) for stage in self.stages]
+        try:
+            shown = 0
+            for stage in self.stages:
+                if not stage.title:
+                    continue
+                queue = self._queues[stage.name]
+                header = f"### {stage.title}\n\n" if shown == 0 else f"\n\n### {stage.title}\n\n"
+                while True:
+                    chunk = await queue.get()
+                    if chunk is None:
+                        break
+                    if header:
+                        yield header
+                        header = ""
+                        shown += 1
+                    yield chunk
+            # Surface a failure in the stage tasks rather than end silently
+            await asyncio.gather(*self._tasks)
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _run_stage(self, stage: Stage) -> None:
+        queue = self._queues.get(stage.name)
+        try:
+            for dependency in stage.after:
+                await self._done[dependency].wait()
+            if stage.when is not None and self.choices.get(stage.when[0]) != stage.when[1]:
+                self._results[stage.name] = AgentResult(stage.name, stage.agent["role"], "", 0.0, "skipped")
+                return
+            self._results[stage.name] = await self._generate(stage, queue)
+        finally:
+            if queue is not None:
+                queue.put_nowait(None)
+            self._done[stage.name].set()
+
+    async def _generate(self, stage: Stage, queue: Optional[asyncio.Queue]) -> AgentResult:
+        started = time.perf_counter()
+        model = stage.resolve_model()
+        options = self.options if stage.title else note_options(self.options)
+        max_tokens = min(stage.max_tokens, options.get("num_predict", stage.max_tokens))
+        inputs = [
+            (self._titles[name], self.outputs[name]) for name in stage.after if self.outputs.get(name)
+        ]
+        payload = {
+            "model": model,
+            "prompt": build_stage_prompt(stage, self.conversation_context, self.current_query, inputs,
+                                         self.search_results),
+            "options": {**options, "num_predict": max_tokens},
+        }
+        sanitizer = StreamSanitizer()
+        parts: List[str] = []
+        usage = GenerationUsage()
+        generated = 0
+        queue_ms = 0.0
+        status = "ok"
+        try:
+            with span(f"stage:{stage.name}", agent=stage.agent["name"], model=model) as stage_span:
+                async with scheduler.slot(self.team_id, self.priority) as waited:
+                    queue_ms = waited * 1000
+                    with generation_span(model, max_tokens=max_tokens) as generation:
+                        async with aclosing(backend_pool.generate_stream(payload)) as chunks:
+                            async for chunk in chunks:
+                                if chunk.get("done"):
+                                    usage = GenerationUsage.from_ollama(chunk)
+                                text = sanitizer.feed(chunk.get("response", ""))
+                                if chunk.get("response"):
+                                    generated += 1
+                                if text:
+                                    parts.append(text)
+                                    if queue is not None:
+                                        queue.put_nowait(text)
+                        tail = sanitizer.flush()
+                        if tail:
+                            parts.append(tail)
+                            if queue is not None:
+                                queue.put_nowait(tail)
+                        generation.set(**usage.span_attributes())
+                if not usage.completion_tokens:
+                    usage.completion_tokens = generated
+                content = "".join(parts).strip()
+                status = "ok" if content else "empty"
+                stage_span.set(status=status)
+            usage_stats.record(self.team_id, "stage", usage)
+            cancellation_stats.record_completed("stage", usage.completion_tokens)
+        except asyncio.CancelledError:
+            cancellation_stats.record_cancelled("stage", generated)
+            raise
+        except UpstreamError as e:
+            logger.error(f"Stage {stage.name} failed: {e}")
+            content, status = "", "unavailable"
+        except Exception as e:
+            logger.error(f"Stage {stage.name} failed: {e}")
+            content, status = "", "error"
+        if status != "ok" and queue is not None:
+            queue.put_nowait(f"_{stage.title} is unavailable right now._")
+        self.outputs[stage.name] = content
+        if stage.choices:
+            self.choices[stage.name] = pick_choice(content, stage.choices)
+        latency_ms = (time.perf_counter() - started) * 1000
+        observe_phase(self.team_id, f"stage:{stage.name}", latency_ms / 1000)
+        logger.info(f"Stage {stage.name} finished with status {status} in {latency_ms:.0f} ms")
+        return AgentResult(stage.name, stage.agent["role"], content, latency_ms, status, queue_ms, usage)
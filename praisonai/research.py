@@ -0,0 +1,248 @@
+# Research stage: split a question into web searches, run them together and pack the best results
+import asyncio
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+from backends import backend_pool
+from caching import TTLCache
+from context_builder import estimate_tokens
+from pipeline import PIPELINE_SMALL_MODEL
+from scheduler import PRIORITY_INTERACTIVE, scheduler
+from tracing import generation_span, span
+from usage import GenerationUsage, usage_stats
+
+logger = logging.getLogger(__name__)
+
+# Searches per request, the user's own query included; 1 searches only the query as asked
+RESEARCH_MAX_QUERIES = int(os.getenv("RESEARCH_MAX_QUERIES", "4"))
+# Model that writes the sub-queries; the team's model is used where no backend serves it
+RESEARCH_DECOMPOSE_MODEL = os.getenv("RESEARCH_DECOMPOSE_MODEL", PIPELINE_SMALL_MODEL)
+RESEARCH_DECOMPOSE_TOKENS = int(os.getenv("RESEARCH_DECOMPOSE_TOKENS", "96"))
+# Seconds to wait for the sub-queries before searching with the user's query alone
+RESEARCH_DECOMPOSE_TIMEOUT = float(os.getenv("RESEARCH_DECOMPOSE_TIMEOUT", "5"))
+# Seconds one search may take before the research goes ahead without it
+RESEARCH_QUERY_TIMEOUT = float(os.getenv("RESEARCH_QUERY_TIMEOUT", "4"))
+# Token budget of the packed results handed to the agents
+RESEARCH_CONTEXT_TOKENS = int(os.getenv("RESEARCH_CONTEXT_TOKENS", "1200"))
+RESEARCH_SNIPPET_CHARS = int(os.getenv("RESEARCH_SNIPPET_CHARS", "400"))
+RESEARCH_CACHE_TTL = float(os.getenv("RESEARCH_CACHE_TTL", "3600"))
+RESEARCH_CACHE_MAX_ENTRIES = int(os.getenv("RESEARCH_CACHE_MAX_ENTRIES", "1024"))
+
+# Reciprocal rank fusion constant: higher values flatten the advantage of top ranks
+RRF_K = 60
+
+_LIST_MARKER = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s*")
+
+
+def decompose_model(fallback: str) -> str:
+    if RESEARCH_DECOMPOSE_MODEL and backend_pool.serves(RESEARCH_DECOMPOSE_MODEL):
+        return RESEARCH_DECOMPOSE_MODEL
+    return fallback
+
+
+def normalize_query(query: str) -> str:
+    """Collapse case and whitespace so trivially different queries share a cache entry"""
+    return " ".join(query.lower().split())
+
+
+def normalize_url(url: str) -> str:
+    """Key under which the same page found by several queries is merged"""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    return urlunsplit(("", host, parts.path.rstrip("/"), parts.query, ""))
+
+
+def parse_subqueries(text: str, query: str, limit: int) -> List[str]:
+    """Search queries from the model's reply, one per line, without repeats of each other or the query"""
+    seen = {normalize_query(query)}
+    subqueries = []
+    for line in text.splitlines():
+        line = _LIST_MARKER.sub("", line).strip().strip("\"'").strip()
+        key = normalize_query(line)
+        if not line or key in seen or line.endswith(":"):
+            continue
+        seen.add(key)
+        subqueries.append(line)
+        if len(subqueries) == limit:
+            break
+    return subqueries
+
+
+def rank_results(result_lists: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Merge per-query result lists by URL with reciprocal rank fusion
+
+    A page scores ``1 / (RRF_K + rank)`` for every query that found it, so
+    pages several sub-queries agree on rise above any single list's top hit.
+    """
+    merged: Dict[str, Dict[str, Any]] = {}
+    scores: Dict[str, float] = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, 1):
+            url = result.get("url") or ""
+            key = normalize_url(url) if url else f"untitled:{result.get('title', '')}"
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank)
+            kept = merged.setdefault(key, result)
+            # Keep the most informative snippet of the copies
+            if len(result.get("content") or "") > len(kept.get("content") or ""):
+                merged[key] = result
+    return [merged[key] for key in sorted(merged, key=lambda key: scores[key], reverse=True)]
+
+
+def format_result(result: Dict[str, Any]) -> str:
+    title = result.get("title") or "No Title"
+    if result.get("excerpt"):
+        # Text of the page itself, already cut to its grounding budget
+        return f"**{title}**\n{result['excerpt']}\nURL: {result.get('url', '')}\n"
+    content = (result.get("content") or "No description").strip()
+    if len(content) > RESEARCH_SNIPPET_CHARS:
+        content = content[:RESEARCH_SNIPPET_CHARS].rsplit(" ", 1)[0] + "…"
+    return f"**{title}**\n{content}\nURL: {result.get('url', '')}\n"
+
+
+def pack_results(ranked: List[Dict[str, Any]], budget: int = RESEARCH_CONTEXT_TOKENS) -> Tuple[str, int]:
+    """The best results that fit the token budget, and how many that is; the top result is always kept"""
+    entries: List[str] = []
+    used = 0
+    for result in ranked:
+        entry = format_result(result)
+        tokens = estimate_tokens(entry)
+        if entries and used + tokens > budget:
+            # A shorter result further down may still fit
+            continue
+        entries.append(entry)
+        used += tokens
+    return "\n".join(entries), len(entries)
+
+
+@dataclass
+class ResearchOutcome:
+    """Ranked results of one research lookup and the tokens spent writing its sub-queries"""
+    results: List[Dict[str, Any]]
+    usage: GenerationUsage = field(default_factory=GenerationUsage)
+    # Set, with no results, when every search failed
+    error: Optional[BaseException] = None
+
+
+class Researcher:
+    """Search the web for several angles of a question at once
+
+    The user's query is searched straight away while a small model writes up
+    to RESEARCH_MAX_QUERIES - 1 sub-queries, which are then searched
+    concurrently, so the wall time is the decomposition plus the slowest
+    search rather than the sum of all searches. A search that fails or
+    outlasts RESEARCH_QUERY_TIMEOUT is left out; only when every search fails
+    is its error reported, in the outcome's ``error``.
+    """
+
+    def __init__(self, search: Callable[[str], Awaitable[List[Dict[str, Any]]]],
+                 cache: Optional[TTLCache] = None):
+        self._search = search
+        # Sub-queries per normalized question, so a repeated question costs no generation
+        self.cache = cache or TTLCache(RESEARCH_CACHE_MAX_ENTRIES, RESEARCH_CACHE_TTL)
+        self.requests = 0
+        self.decompositions = 0
+        self.decompose_failures = 0
+        self.searches = 0
+        self.search_timeouts = 0
+        self.search_failures = 0
+        self.duplicates_merged = 0
+
+    async def decompose(self, team: str, query: str, model: str,
+                        priority: int = PRIORITY_INTERACTIVE) -> Tuple[List[str], GenerationUsage]:
+        """Sub-queries for the question and the usage of writing them; none when decomposition is off, slow or failing"""
+        limit = RESEARCH_MAX_QUERIES - 1
+        if limit <= 0:
+            return [], GenerationUsage()
+        key = normalize_query(query)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached, GenerationUsage()
+        prompt = f"""Write up to {limit} web search queries that together cover what is needed to answer the question below. Give each query a different angle, such as facts and figures, competitors or alternatives, recent trends, and risks or criticism.
+Reply with one query per line and nothing else.
+
+Question: {query}
+Queries:"""
+
+        async def generate() -> Tuple[Dict[str, Any], GenerationUsage]:
+            async with scheduler.slot(team, priority):
+                with generation_span(model, call="decompose") as generation:
+                    response = await backend_pool.generate({
+                        "model": model,
+                        "prompt": prompt,
+                        "options": {"num_predict": RESEARCH_DECOMPOSE_TOKENS, "temperature": 0}
+                    })
+                    usage = GenerationUsage.from_ollama(response)
+                    generation.set(**usage.span_attributes())
+            return response, usage
+
+        try:
+            # The timeout covers the wait for a generation slot as well
+            response, usage = await asyncio.wait_for(generate(), RESEARCH_DECOMPOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Query decomposition took over {RESEARCH_DECOMPOSE_TIMEOUT:g}s, searching the query alone")
+            self.decompose_failures += 1
+            return [], GenerationUsage()
+        except Exception as e:
+            logger.warning(f"Query decomposition failed, searching the query alone: {e}")
+            self.decompose_failures += 1
+            return [], GenerationUsage()
+        usage_stats.record(team, "decompose", usage)
+        self.decompositions += 1
+        subqueries = parse_subqueries(response.get("response", ""), query, limit)
+        self.cache.set(key, subqueries)
+        return subqueries, usage
+
+    async def _bounded_search(self, query: str) -> List[Dict[str, Any]]:
+        self.searches += 1
+        try:
+            return await asyncio.wait_for(self._search(query), RESEARCH_QUERY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.search_timeouts += 1
+            logger.warning(f"Search for {query!r} took over {RESEARCH_QUERY_TIMEOUT:g}s, continuing without it")
+            raise
+        except Exception:
+            self.search_failures += 1
+            raise
+
+    async def research(self, team: str, query: str, model: str,
+                       priority: int = PRIORITY_INTERACTIVE) -> ResearchOutcome:
+        """Ranked, de-duplicated results of the question and its sub-queries"""
+        self.requests += 1
+        with span("research", query=normalize_query(query)) as research_span:
+            tasks = [asyncio.ensure_future(self._bounded_search(query))]
+            try:
+                subqueries, usage = await self.decompose(team, query, model, priority)
+                tasks += [asyncio.ensure_future(self._bounded_search(subquery)) for subquery in subqueries]
+                outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+            finally:
+                for task in tasks:
+                    task.cancel()
+            result_lists = [outcome for outcome in outcomes if not isinstance(outcome, BaseException)]
+            if not result_lists:
+                return ResearchOutcome([], usage, outcomes[0])
+            ranked = rank_results(result_lists)
+            found = sum(len(results) for results in result_lists)
+            self.duplicates_merged += found - len(ranked)
+            research_span.set(queries=len(tasks), failed=len(tasks) - len(result_lists),
+                              results=found, unique=len(ranked))
+            return ResearchOutcome(ranked, usage)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_queries": RESEARCH_MAX_QUERIES,
+            "context_tokens": RESEARCH_CONTEXT_TOKENS,
+            "requests": self.requests,
+            "decompositions": self.decompositions,
+            "decompose_failures": self.decompose_failures,
+            "cached_decompositions": len(self.cache),
+            "searches": self.searches,
+            "search_timeouts": self.search_timeouts,
+            "search_failures": self.search_failures,
+            "duplicates_merged": self.duplicates_merged,
+        }
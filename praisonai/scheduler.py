@@ -0,0 +1,281 @@
+# Admission control and fair scheduling of Ollama generations
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+
+from backends import backend_pool
+from metrics import PHASE_QUEUE_WAIT, observe_phase
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Generations allowed in flight at once; defaults to Ollama's OLLAMA_NUM_PARALLEL for every backend
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv(
+    "SCHEDULER_MAX_CONCURRENCY",
+    str(int(os.getenv("OLLAMA_NUM_PARALLEL", "4")) * max(1, len(backend_pool.backends)))
+))
+# Generations allowed to wait for a slot before new requests are rejected with 429
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "64"))
+
+# Priority classes, lower value is served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BATCH: "batch"}
+
+
+def parse_priority(value: Optional[str], default: int) -> int:
+    """Map a priority name from a request onto a priority class"""
+    if not value:
+        return default
+    for priority, name in PRIORITY_NAMES.items():
+        if name == str(value).lower():
+            return priority
+    return default
+
+
+class QueueFullError(Exception):
+    """Raised when the wait queue is full and a request must be shed"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Generation queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Reservation:
+    """Queue capacity held for the generations an admitted request has yet to start
+
+    Each generation the request starts through ``slot`` takes one unit, as it
+    is then counted as waiting or running instead; whatever is left is given
+    back by ``release`` once the request is over.
+    """
+
+    def __init__(self, scheduler: "GenerationScheduler", priority: int, generations: int):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.remaining = generations
+
+    def consume(self) -> None:
+        if self.remaining > 0:
+            self.remaining -= 1
+            self.scheduler._reserved[self.priority] -= 1
+
+    def release(self, *_: Any) -> None:
+        self.scheduler._reserved[self.priority] -= self.remaining
+        self.remaining = 0
+
+
+# Reservation of the request the current task works for, inherited by the tasks it starts
+_reservation: ContextVar[Optional[Reservation]] = ContextVar("scheduler_reservation", default=None)
+
+
+class GenerationScheduler:
+    """Concurrency limiter with priority classes and per-team round-robin
+
+    Waiters are grouped by priority class and then by team. When a slot frees
+    up the highest class with waiters is served, rotating between its teams so
+    one busy team cannot starve the others. Admitted requests reserve queue
+    capacity for the generations they will fan out into, so the queue limit
+    bounds generations rather than requests.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.running = 0
+        self._waiters: Dict[int, "OrderedDict[str, Deque[asyncio.Future]]"] = {
+            priority: OrderedDict() for priority in PRIORITY_NAMES
+        }
+        self._waiting = 0
+        # Generations admitted requests are expected to start but have not yet
+        self._reserved: Dict[int, int] = {priority: 0 for priority in PRIORITY_NAMES}
+        # Counters and recent samples for sizing hardware
+        self.admitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self._wait_samples: Deque[float] = deque(maxlen=1000)
+        self._max_wait = 0.0
+        self._avg_hold = 0.0
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    def waiting_ahead(self, priority: int) -> int:
+        """Queued generations that would be served before a new one of this class"""
+        return sum(
+            len(queue)
+            for waiter_priority, teams in self._waiters.items()
+            if waiter_priority <= priority
+            for queue in teams.values()
+        )
+
+    def backlog_ahead(self, priority: int) -> int:
+        """Generations queued or reserved that would be served before new ones of this class"""
+        reserved = sum(count for reserved_priority, count in self._reserved.items() if reserved_priority <= priority)
+        return self.waiting_ahead(priority) + reserved
+
+    def retry_after(self, priority: int = PRIORITY_BATCH) -> int:
+        """Seconds until the backlog ahead of this class is likely to drain"""
+        hold = self._avg_hold or 10.0
+        return max(1, math.ceil(hold * (self.backlog_ahead(priority) + 1) / self.max_concurrency))
+
+    def admit(self, priority: int = PRIORITY_INTERACTIVE, generations: int = 1) -> Reservation:
+        """Reserve room for a new request's generations, or reject it up front when the queue is full
+
+        The request's generations and the backlog ahead of it must fit in the
+        free slots plus ``max_queue``; a request with nothing ahead is always
+        admitted. Only work of the same or a higher class counts, so a backlog
+        of batch work never causes interactive requests to be shed. The
+        reservation is released when the calling task finishes.
+        """
+        generations = max(1, generations)
+        ahead = self.backlog_ahead(priority)
+        free = max(0, self.max_concurrency - self.running)
+        if ahead and ahead + generations > free + self.max_queue:
+            self.rejected += 1
+            retry_after = self.retry_after(priority)
+            logger.warning(
+                f"Rejecting {PRIORITY_NAMES.get(priority, priority)} request of {generations} generations: "
+                f"{ahead} generations queued or reserved ahead, retry after {retry_after}s"
+            )
+            raise QueueFullError(retry_after)
+        self.admitted += 1
+        reservation = Reservation(self, priority, generations)
+        self._reserved[priority] += generations
+        _reservation.set(reservation)
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is not None:
+            task.add_done_callback(reservation.release)
+        # Outside a task the caller releases the reservation itself
+        return reservation
+
+    async def acquire(self, team: str, priority: int = PRIORITY_INTERACTIVE) -> float:
+        """Wait for a generation slot and return the time spent waiting"""
+        started = time.perf_counter()
+        if self.running < self.max_concurrency and self._waiting == 0:
+            self.running += 1
+            self._record_wait(0.0)
+            return 0.0
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self._waiters[priority].setdefault(team, deque())
+        queue.append(future)
+        self._waiting += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we were cancelled
+                self.release()
+            else:
+                self._remove_waiter(priority, team, future)
+            raise
+
+        waited = time.perf_counter() - started
+        self._record_wait(waited)
+        return waited
+
+    def release(self, held: Optional[float] = None) -> None:
+        """Free a slot and hand it to the next waiter in fair order"""
+        if held is not None:
+            self.completed += 1
+            self._avg_hold = held if not self._avg_hold else 0.9 * self._avg_hold + 0.1 * held
+        self.running -= 1
+        while self.running < self.max_concurrency:
+            future = self._next_waiter()
+            if future is None:
+                break
+            if not future.done():
+                self.running += 1
+                future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, team: str, priority: int = PRIORITY_INTERACTIVE) -> AsyncIterator[float]:
+        """Hold a generation slot for the duration of the block"""
+        reservation = _reservation.get()
+        if reservation is not None:
+            reservation.consume()
+        with span("queue_wait", priority=PRIORITY_NAMES[priority]):
+            waited = await self.acquire(team, priority)
+        observe_phase(team, PHASE_QUEUE_WAIT, waited)
+        started = time.perf_counter()
+        try:
+            yield waited
+        finally:
+            self.release(time.perf_counter() - started)
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        for priority in sorted(self._waiters):
+            teams = self._waiters[priority]
+            while teams:
+                team, queue = next(iter(teams.items()))
+                future = queue.popleft()
+                self._waiting -= 1
+                if queue:
+                    teams.move_to_end(team)
+                else:
+                    del teams[team]
+                return future
+        return None
+
+    def _remove_waiter(self, priority: int, team: str, future: asyncio.Future) -> None:
+        queue = self._waiters[priority].get(team)
+        if queue is None or future not in queue:
+            return
+        queue.remove(future)
+        self._waiting -= 1
+        if not queue:
+            del self._waiters[priority][team]
+
+    def _record_wait(self, waited: float) -> None:
+        self._wait_samples.append(waited)
+        self._max_wait = max(self._max_wait, waited)
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and wait-time figures for capacity planning"""
+        samples = sorted(self._wait_samples)
+
+        def percentile(fraction: float) -> float:
+            if not samples:
+                return 0.0
+            return round(samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000, 1)
+
+        by_team: Dict[str, int] = {}
+        for teams in self._waiters.values():
+            for team, queue in teams.items():
+                by_team[team] = by_team.get(team, 0) + len(queue)
+
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "running": self.running,
+            "queue_depth": self._waiting,
+            "queue_depth_by_priority": {
+                PRIORITY_NAMES[priority]: sum(len(queue) for queue in teams.values())
+                for priority, teams in self._waiters.items()
+            },
+            "queue_depth_by_team": by_team,
+            "reserved_by_priority": {PRIORITY_NAMES[priority]: count for priority, count in self._reserved.items()},
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "wait_ms": {
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "max": round(self._max_wait * 1000, 1),
+                "samples": len(samples),
+            },
+            "avg_generation_ms": round(self._avg_hold * 1000, 1),
+        }
+
+
+scheduler = GenerationScheduler(SCHEDULER_MAX_CONCURRENCY, SCHEDULER_MAX_QUEUE)
@@ -1,27 +1,126 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any, Union, AsyncGenerator
+from typing import List, Optional, Dict, Any, Callable, Set, Tuple, Union, AsyncGenerator
+from contextlib import aclosing, asynccontextmanager
 import asyncio
 import json
 import logging
 import os
+import time
+import hashlib
+from dataclasses import replace
 from datetime import datetime
 import uuid
-import requests
+import httpx
 
 # PraisonAI imports
 from praisonai import PraisonAI
 
+from backends import backend_pool
+from batch import BATCH_MAX_CONCURRENCY, BATCH_MAX_ITEMS, run_bounded
+from caching import SharedCallCancelled, SingleFlight, TTLCache
+from circuit import CircuitBreaker, CircuitOpenError
+from context_builder import (
+    CONTEXT_RESERVE_TOKENS,
+    CONTEXT_SUMMARY_MODEL,
+    ConversationHistory,
+    Turn,
+    context_builder,
+)
+from disconnect import (
+    ClientDisconnected,
+    cancellation_stats,
+    run_until_disconnect,
+    stream_until_disconnect,
+)
+from generation import GenerationOptionsError, requested_options, resolve_options
+from grounding import GROUNDING_PAGES, grounder
+from http_client import (
+    UpstreamError,
+    close_http_client,
+    get_http_client,
+    searxng_search,
+)
+from jobs import Job, JobQueueFullError, job_store
+from kv_reuse import kv_contexts
+from metrics import (
+    METRICS_CONTENT_TYPE,
+    PHASE_AGGREGATION_GENERATION,
+    PHASE_CONTEXT_BUILD,
+    PHASE_SEARCH,
+    MetricsMiddleware,
+    RuntimeCollector,
+    label_request,
+    observe_search,
+    register_collector,
+    render_metrics,
+    timed_phase,
+)
+from pipeline import PIPELINE_SMALL_MODEL, PipelineRun
+from research import RESEARCH_DECOMPOSE_MODEL, RESEARCH_MAX_QUERIES, Researcher, decompose_model, normalize_query, pack_results
+from scheduler import (
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    QueueFullError,
+    parse_priority,
+    scheduler,
+)
+from sessions import Session, session_store
+from streaming import (
+    NDJSON_MODE_DELTA,
+    NDJSON_MODE_FULL,
+    StreamSummary,
+    TokenStream,
+    coalesce_tokens,
+    render_ndjson,
+    render_sse,
+    sanitize_stream,
+    sanitize_text,
+)
+from team_engine import (
+    AgentResult,
+    TeamRunResult,
+    build_aggregation_continuation,
+    build_aggregation_prompt,
+    run_agents,
+)
+from team_registry import TeamConfig, team_registry
+from tracing import TracingMiddleware, generation_span, span, tracer
+from usage import GenerationUsage, usage_stats
+from warmup import ModelWarmer
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the shared upstream connection pool, health-check the model backends, keep the team models loaded, run background jobs and export spans for the lifetime of the worker"""
+    get_http_client()
+    tracer.start()
+    backend_pool.start()
+    model_warmer.start()
+    await job_store.start(run_job)
+    team_registry.start()
+    try:
+        yield
+    finally:
+        await team_registry.stop()
+        # Unfinished jobs stay in the job backend and resume on the next start
+        await job_store.stop()
+        await model_warmer.stop()
+        await backend_pool.stop()
+        await close_http_client()
+        # Last, so spans of requests that just finished are still sent
+        await tracer.stop()
+
 app = FastAPI(
     title="Keiken Multi-Agent Teams API",
     description="OpenWebUI-compatible API for Keiken intelligent agent teams - Powered by Nebari Software",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -31,6 +130,10 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Request rate, latency, time to first token and outcome per team, served on /metrics
+app.add_middleware(MetricsMiddleware)
+# Spans per request phase, exported in the background; Server-Timing on every response
+app.add_middleware(TracingMiddleware, tracer=tracer)
 
 # OpenWebUI-compatible models
 class ChatMessage(BaseModel):
@@ -40,8 +143,12 @@ class ChatMessage(BaseModel):
 class ChatCompletionRequest(BaseModel):
     model: str
     messages: List[ChatMessage]
-    temperature: Optional[float] = 0.7
-    max_tokens: Optional[int] = 2000
+    # Unset options fall back to the team's defaults in agents.yaml, then Ollama's
+    temperature: Optional[float] = None
+    max_tokens: Optional[int] = None
+    top_p: Optional[float] = None
+    stop: Optional[Union[str, List[str]]] = None
+    seed: Optional[int] = None
     stream: Optional[bool] = False
 
 class ChatCompletionResponse(BaseModel):
@@ -50,7 +157,26 @@ class ChatCompletionResponse(BaseModel):
     created: int
     model: str
     choices: List[Dict[str, Any]]
-    usage: Dict[str, int]
+    usage: Dict[str, Any]
+    agents: Optional[List[Dict[str, Any]]] = None
+    context: Optional[Dict[str, Any]] = None
+
+class SessionCreateRequest(BaseModel):
+    team: str
+    messages: List[ChatMessage] = []
+
+class SessionReplyRequest(BaseModel):
+    content: str
+    stream: bool = False
+    stream_mode: str = NDJSON_MODE_FULL
+    snapshot_every: int = Field(0, ge=0)
+    priority: Optional[str] = None
+    temperature: Optional[float] = None
+    max_tokens: Optional[int] = None
+    top_p: Optional[float] = None
+    num_ctx: Optional[int] = None
+    stop: Optional[Union[str, List[str]]] = None
+    seed: Optional[int] = None
 
 class ModelInfo(BaseModel):
     id: str
@@ -58,458 +184,490 @@ class ModelInfo(BaseModel):
     created: int
     owned_by: str = "praisonai"
 
-# Available agent teams configuration  
-AGENT_TEAMS = {
-    "Research": {
-        "name": "Research Team", 
-        "description": "Multi-agent research team with internet search capabilities",
-        "framework": "praisonai",
-        "agents": [
-            {
-                "name": "Researcher",
-                "role": "Senior Research Analyst", 
-                "goal": "Conduct thorough research on given topics",
-                "backstory": "Expert researcher with access to web search and analysis tools",
-                "tools": ["internet_search"]
-            },
-            {
-                "name": "Analyst",
-                "role": "Data Analyst",
-                "goal": "Analyze and synthesize research findings",
-                "backstory": "Skilled at turning raw data into actionable insights",
-                "tools": []
-            },
-            {
-                "name": "Writer",
-                "role": "Content Writer", 
-                "goal": "Create comprehensive reports from research",
-                "backstory": "Expert at creating clear, engaging content from complex data",
-                "tools": []
-            }
-        ]
-    },
-    "coding-team": {
-        "name": "Software Development Team",
-        "description": "Team of coding specialists for development tasks", 
-        "framework": "praisonai",
-        "agents": [
-            {
-                "name": "Architect",
-                "role": "Solution Architect",
-                "goal": "Design system architecture and technical solutions",
-                "backstory": "Senior architect with expertise in system design",
-                "tools": []
-            },
-            {
-                "name": "Developer",
-                "role": "Senior Developer", 
-                "goal": "Implement code solutions and best practices",
-                "backstory": "Full-stack developer with years of experience",
-                "tools": []
-            },
-            {
-                "name": "Tester",
-                "role": "QA Engineer",
-                "goal": "Test and validate code quality",
-                "backstory": "Quality assurance expert focused on robust testing",
-                "tools": []
-            }
-        ]
-    },
-    "business-team": {
-        "name": "Business Analysis Team", 
-        "description": "Business-focused team for strategy and analysis",
-        "framework": "praisonai",
-        "agents": [
-            {
-                "name": "BusinessAnalyst",
-                "role": "Senior Business Analyst",
-                "goal": "Analyze business requirements and opportunities", 
-                "backstory": "Expert in business process analysis and strategy",
-                "tools": ["internet_search"]
-            },
-            {
-                "name": "FinancialAnalyst", 
-                "role": "Financial Analyst",
-                "goal": "Provide financial analysis and projections",
-                "backstory": "Financial expert with market analysis skills",
-                "tools": []
-            },
-            {
-                "name": "Strategist",
-                "role": "Business Strategist",
-                "goal": "Develop strategic recommendations",
-                "backstory": "Strategic planning expert with industry knowledge",
-                "tools": []
-            }
-        ]
-    },
-    "CreativeStudio": {
-        "name": "Creative Studio", 
-        "description": "Creative team for content generation and marketing",
-        "framework": "praisonai", 
-        "agents": [
-            {
-                "name": "CreativeDirector",
-                "role": "Creative Director",
-                "goal": "Lead creative vision and strategy",
-                "backstory": "Experienced creative leader with brand expertise",
-                "tools": []
-            },
-            {
-                "name": "Copywriter",
-                "role": "Senior Copywriter", 
-                "goal": "Create compelling marketing copy",
-                "backstory": "Expert copywriter with marketing background",
-                "tools": []
-            },
-            {
-                "name": "ContentStrategist",
-                "role": "Content Strategist",
-                "goal": "Plan and optimize content strategy",
-                "backstory": "Content marketing expert with analytics focus",
-                "tools": ["internet_search"]
-            }
-        ]
-    },
-    "SalesOps": {
-        "name": "Sales Operations",
-        "description": "Sales operations team for proposals, renewals, and strategic sales support",
-        "framework": "praisonai",
-        "agents": [
-            {
-                "name": "SalesRouter",
-                "role": "Sales Operations Router",
-                "goal": "Route sales scenarios to appropriate specialists",
-                "backstory": "Expert at analyzing sales scenarios and directing to the right team member",
-                "tools": []
-            },
-            {
-                "name": "NewBusinessSpecialist", 
-                "role": "New Business Specialist",
-                "goal": "Handle new business development and upsell opportunities",
-                "backstory": "Experienced in crafting compelling proposals and identifying growth opportunities",
-                "tools": ["internet_search"]
-            },
-            {
-                "name": "RenewalSpecialist",
-                "role": "Renewal and Retention Specialist", 
-                "goal": "Manage renewals and customer retention strategies",
-                "backstory": "Expert at customer relationship management and renewal optimization",
-                "tools": []
-            }
-        ]
-    }
-}
-
-# Team-specific workflow instructions
-def get_team_specific_instructions(team_name: str) -> str:
-    """Get team-specific workflow instructions based on the plan"""
-    instructions = {
-        "Research": """
-You are a Research Team Agent whose job is to efficiently gather, analyse and summarise high-impact insights for business decisions.
-Begin by breaking down the user's query into separate research sub-tasks, then execute those tasks in parallel (e.g., data gathering, competitor benchmarking, trend identification).
-For each sub-task produce a short reasoning trace that shows your thought process.
-Then aggregate the results into a concise, actionable summary, emphasising what a generic zero-shot model would miss (for example: source gaps, contradictory evidence, recommendation risks).
-        """,
-        "CreativeStudio": """
-You are a Creative Studio Agent operating in a structured chain of work.
-Step 1: Ideation – generate at least 5 distinct creative directions based on the user query.
-Step 2: Drafting – select the most promising direction and build a detailed draft.
-Step 3: Review and polish – refine the draft for clarity, style, and brand consistency.
-        """,
-        "SalesOps": """
-You are a Sales Operations Agent tasked with routing the user's scenario to the appropriate sub-team and then producing the output.
-First: analyse the user's query to decide whether it fits "New Business / Upsell" or "Renewal / Retention".
-Then hand off to the chosen sub-team workflow and generate the final deliverable (proposal, strategy, etc.).
-        """
-    }
-    return instructions.get(team_name, "Follow standard workflow procedures for your team.")
+# Agent teams from agents.yaml, reloaded when the file changes
+AGENT_TEAMS = team_registry
 
-# Internet search tool implementation
-def internet_search_tool(query: str) -> str:
-    """Internet search tool using SearxNG service"""
-    try:
-        # Use SearxNG service for web search
-        response = requests.get(
-            "http://searxng:8080/search",
-            params={"q": query, "format": "json", "categories": "general"},
-            timeout=10
-        )
+def team_models() -> List[str]:
+    """Every model a team request can generate with, including the history summarizer"""
+    models = {CONTEXT_SUMMARY_MODEL}
+    for team_config in AGENT_TEAMS.values():
+        models.add(team_config.model)
+        models.update(team_config.agent_models)
+        models.update(team_config.stage_models)
+    return sorted(models)
+
+def optional_team_models() -> List[str]:
+    """Small models for cheap pipeline stages and query decomposition, which fall back to the team's models where not pulled"""
+    models = set()
+    if PIPELINE_SMALL_MODEL and any(team_config.uses_small_model for team_config in AGENT_TEAMS.values()):
+        models.add(PIPELINE_SMALL_MODEL)
+    if RESEARCH_DECOMPOSE_MODEL and RESEARCH_MAX_QUERIES > 1 and any(team_config.needs_search for team_config in AGENT_TEAMS.values()):
+        models.add(RESEARCH_DECOMPOSE_MODEL)
+    return sorted(models)
+
+# Preloads the team models at startup and reloads them after an Ollama restart or idle unload
+model_warmer = ModelWarmer(backend_pool, team_models(), optional=optional_team_models())
+
+def teams_reloaded(changed: Set[str]) -> None:
+    """Warm the models of edited teams and stop resuming KV contexts built from their old prompts"""
+    model_warmer.set_models(team_models(), optional_team_models())
+    kv_contexts.cache.clear()
+
+team_registry.subscribe(teams_reloaded)
+
+# Search results cache, keyed by normalized query
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "900"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1024"))
+search_cache = TTLCache(SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL)
+search_flight = SingleFlight()
+# While SearxNG keeps failing, searches are skipped at once instead of waiting out the timeout
+search_breaker = CircuitBreaker("SearxNG")
+
+async def fetch_search_results(query: str) -> List[Dict[str, Any]]:
+    """Return SearxNG results for a query, served from cache when fresh"""
+    key = normalize_query(query)
+    with span("search", query=key) as search_span:
+        cached = search_cache.get(key)
+        if cached is not None:
+            search_span.set(cache="hit", results=len(cached))
+            return cached
         
-        if response.status_code != 200:
-            logger.error(f"SearxNG returned status {response.status_code}")
-            return f"Search service error: HTTP {response.status_code}"
+        async def fetch() -> List[Dict[str, Any]]:
+            async with search_breaker.guard():
+                data = await searxng_search(key)
+            results = data.get("results", [])
+            search_cache.set(key, results)
+            return results
         
-        data = response.json()
-        results = data.get("results", [])
+        # Identical lookups already in flight wait for that single SearxNG call
+        search_span.set(cache="coalesced" if key in search_flight else "miss")
+        results = await search_flight.do(key, fetch)
+        search_span.set(results=len(results))
+        return results
+
+# Fans each question out into several searches and packs the merged results
+researcher = Researcher(fetch_search_results)
+
+# Internet search tool implementation
+async def internet_search_tool(query: str, team_name: str, model: str, priority: int = PRIORITY_INTERACTIVE) -> Tuple[Optional[str], GenerationUsage]:
+    """Internet search tool using SearxNG service, with the usage of writing its sub-queries
+
+    The text is None while the search circuit is open.
+    """
+    usage = GenerationUsage()
+    try:
+        # Search the query and the sub-queries derived from it concurrently
+        outcome = await researcher.research(team_name, query, decompose_model(model), priority)
+        usage = outcome.usage
+        if outcome.error is not None:
+            raise outcome.error
+        results = outcome.results
         
         if not results:
-            return "No search results found."
+            observe_search("empty")
+            return "No search results found.", usage
+        observe_search("ok")
         
-        # Format top 5 results
-        formatted_results = []
-        for result in results[:5]:
-            title = result.get('title', 'No Title')
-            content = result.get('content', 'No description')
-            url = result.get('url', '')
-            formatted_results.append(f"**{title}**\n{content}\nURL: {url}\n")
+        if GROUNDING_PAGES > 0:
+            # Read the top pages themselves rather than only their snippets
+            with span("grounding", pages=GROUNDING_PAGES) as grounding_span:
+                results = await grounder.ground(results)
+                grounding_span.set(grounded=sum(1 for result in results if result.get("excerpt")))
         
-        return "\n".join(formatted_results)
+        # The best results across every search, within the research token budget
+        packed, _ = pack_results(results)
+        return packed, usage
         
-    except requests.exceptions.RequestException as e:
+    except CircuitOpenError:
+        # Degrade to answering without research data rather than stalling the team
+        observe_search("circuit_open")
+        return None, usage
+    except UpstreamError as e:
+        logger.error(str(e))
+        observe_search("error")
+        return f"Search service error: HTTP {e.status_code}", usage
+    except httpx.HTTPError as e:
         logger.error(f"SearxNG connection error: {e}")
-        return f"Search service unavailable: {str(e)}"
+        observe_search("error")
+        return f"Search service unavailable: {str(e)}", usage
     except Exception as e:
         logger.error(f"Search error: {e}")
-        return f"Search failed: {str(e)}"
+        observe_search("error")
+        return f"Search failed: {str(e)}", usage
+
+async def team_search_results(team_name: str, team_config: TeamConfig, current_query: str, priority: int = PRIORITY_INTERACTIVE) -> Tuple[Optional[str], GenerationUsage]:
+    """One research lookup per request, shared by every agent equipped with the tool, and its generation usage"""
+    if not team_config.needs_search:
+        return None, GenerationUsage()
+    with timed_phase(team_name, PHASE_SEARCH):
+        return await internet_search_tool(current_query, team_name, team_config.model, priority)
+
+async def run_team_agents(team_name: str, team_config: TeamConfig, conversation_context: str, current_query: str, priority: int = PRIORITY_INTERACTIVE, history: Optional[ConversationHistory] = None, options: Optional[Dict[str, Any]] = None) -> Tuple[List[AgentResult], GenerationUsage]:
+    """Run the team's agents concurrently, sharing one search lookup between them; also returns the research usage"""
+    search_results, research_usage = await team_search_results(team_name, team_config, current_query, priority)
+    
+    return await run_agents(
+        team_name,
+        team_config,
+        team_config.prompts,
+        conversation_context,
+        current_query,
+        search_results,
+        priority,
+        history,
+        options
+    ), research_usage
+
+def aggregation_request(team_name: str, team_config: TeamConfig, conversation_context: str, current_query: str, agent_results: List[AgentResult], history: Optional[ConversationHistory] = None, options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Ollama request for the merge call, resuming from the lead's previous answer when the history extends it"""
+    model = team_config.model
+    # The merged answer is what the caller sees, so it gets every requested option
+    options = options or {}
+    resumption = kv_contexts.find(team_name, "aggregation", model, history, own_reply=True)
+    if resumption is not None:
+        prompt = build_aggregation_continuation(resumption.new_turns, current_query, agent_results)
+        if kv_contexts.fits(resumption, prompt, options.get("num_ctx")):
+            return {"model": model, "prompt": prompt, "context": resumption.context, "options": options}
+    
+    return {
+        "model": model,
+        "prompt": build_aggregation_prompt(
+            team_config.prompts.aggregation,
+            conversation_context,
+            current_query,
+            agent_results
+        ),
+        "options": options
+    }
 
-async def create_agent_team(team_name: str, team_config: Dict, messages: List[ChatMessage], stream: bool = False) -> Union[str, AsyncGenerator[str, None]]:
-    """Create and run a PraisonAI agent team with real AI responses and conversation context"""
+def run_generations(team_config: TeamConfig) -> int:
+    """Generations one run of the team queues, the research sub-queries included"""
+    return team_config.generations + (1 if team_config.needs_search and RESEARCH_MAX_QUERIES > 1 else 0)
+
+def admit_request(priority: int, generations: int) -> None:
+    """Shed load with 429 before any work starts when the generation queue cannot take the request's generations"""
     try:
-        import requests
+        scheduler.admit(priority, generations)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+def client_closed_response() -> Response:
+    """Response for a caller that disconnected before the answer was ready (nginx's 499)"""
+    return Response(status_code=499)
+
+# Optional merging of streamed tokens into larger SSE frames (0 disables each limit)
+SSE_COALESCE_CHARS = int(os.getenv("SSE_COALESCE_CHARS", "0"))
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", "0"))
+
+# Completion cache, keyed by a canonical hash of the rendered team request
+COMPLETION_CACHE_TTL = float(os.getenv("COMPLETION_CACHE_TTL", "300"))
+COMPLETION_CACHE_MAX_ENTRIES = int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", "512"))
+COMPLETION_CACHE_MAX_BYTES = int(os.getenv("COMPLETION_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+completion_cache = TTLCache(
+    COMPLETION_CACHE_MAX_ENTRIES,
+    COMPLETION_CACHE_TTL,
+    max_bytes=COMPLETION_CACHE_MAX_BYTES,
+    sizeof=lambda result: len(result.content.encode("utf-8")) + 512
+)
+# A shared generation is cancelled once every caller waiting on it has disconnected
+completion_flight = SingleFlight(cancel_abandoned=True)
+
+class CompletionAborted(Exception):
+    """Signals coalesced waiters that the producing generation did not finish"""
+
+def generation_options(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Generation options named in a request body, as Ollama options; 400 for an invalid one"""
+    try:
+        return requested_options(data)
+    except GenerationOptionsError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def count_field(data: Dict[str, Any], field: str, default: int, low: int) -> int:
+    """Whole-number field of a request body, such as ``concurrency``; 400 unless it is at least ``low``"""
+    value = data.get(field)
+    if value is None:
+        return default
+    if isinstance(value, str) and value.strip().isdigit():
+        # n8n expressions often render numbers as strings
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or value < low:
+        raise HTTPException(status_code=400, detail=f"{field} must be an integer of at least {low}")
+    return value
+
+def cache_bypassed(headers) -> bool:
+    """Callers opt out of the completion cache with Cache-Control: no-cache or no-store"""
+    directives = headers.get("cache-control", "").lower()
+    return "no-cache" in directives or "no-store" in directives
+
+def conversation_history(messages: List[ChatMessage]) -> ConversationHistory:
+    """Prompt history for a client-supplied message list"""
+    return ConversationHistory.from_turns(
+        Turn(msg.role, msg.content) for msg in messages if msg.role in ("system", "user", "assistant")
+    )
+
+def build_conversation_context(team_name: str, team_config: TeamConfig, history: ConversationHistory, options: Optional[Dict[str, Any]] = None):
+    """Fit the history into the model's budget next to the team's own prompt text"""
+    reserved = CONTEXT_RESERVE_TOKENS + team_config.instruction_tokens
+    # A requested num_ctx is the window Ollama will actually load the model with
+    return context_builder.build(team_name, history, team_config.model, reserved, (options or {}).get("num_ctx"))
+
+def completion_cache_key(team_name: str, team_config: TeamConfig, history: ConversationHistory, options: Optional[Dict[str, Any]] = None) -> str:
+    """Canonical hash of everything that shapes the rendered prompts for a request"""
+    canonical = json.dumps({
+        # The team digest covers its definition, instructions and models
+        "team": team_config.digest,
+        # The history digest covers every turn without rehashing the transcript
+        "conversation": history.digest,
+        "options": options or {}
+    }, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+async def create_agent_team(team_name: str, team_config: TeamConfig, history: ConversationHistory, stream: bool = False, priority: int = PRIORITY_INTERACTIVE, use_cache: bool = True, options: Optional[Dict[str, Any]] = None) -> Union[TeamRunResult, TokenStream]:
+    """Create and run a PraisonAI agent team with real AI responses and conversation context
+
+    With stream=True the result is a TokenStream that callers render as SSE or NDJSON.
+    ``options`` are the request's validated generation options, applied over the team's
+    defaults and within its output cap.
+    """
+    summary = StreamSummary()
+    try:
+        current_query = history.current_query
+        options = resolve_options(team_config, options)
         
-        # Use Ollama for actual AI responses
-        ollama_url = "http://ollama:11434/api/generate"
+        logger.info(f"Executing PraisonAI workflow for query: {current_query}")
         
-        # Build conversation context from message history
-        conversation_context = ""
-        current_query = ""
+        cache_key = None
+        if use_cache:
+            cache_key = completion_cache_key(team_name, team_config, history, options)
+            cached = completion_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Completion cache hit for team {team_name}")
+                if stream:
+                    return TokenStream(replay_tokens(cached, "hit", summary), summary)
+                return replace(cached, cache_status="hit")
         
-        for msg in messages:
-            if msg.role == "user":
-                current_query = msg.content
-                conversation_context += f"User: {msg.content}\n"
-            elif msg.role == "assistant":
-                conversation_context += f"Assistant: {msg.content}\n"
+        # Long histories are fitted to the model's budget, older turns rolled into a summary
+        with timed_phase(team_name, PHASE_CONTEXT_BUILD), span("prompt_assembly") as assembly:
+            built = build_conversation_context(team_name, team_config, history, options)
+            assembly.set(**built.report.summary())
+        conversation_context = built.text
+        summary.context = built.report.summary()
         
-        logger.info(f"Executing PraisonAI workflow for query: {current_query}")
+        if stream and cache_key is not None and cache_key in completion_flight:
+            return TokenStream(coalesced_tokens(team_name, team_config, conversation_context, current_query, priority, cache_key, summary, history, options), summary)
         
         if stream:
-            return create_streaming_response(team_config, conversation_context, current_query)
-        
-        # Remove complex response headers that were causing HTML display issues
+            return TokenStream(stream_team_tokens(team_name, team_config, conversation_context, current_query, priority, cache_key, summary, history, options), summary)
         
-        # Use only the primary agent (first in the team) to avoid duplicate responses
-        primary_agent = team_config["agents"][0]
-        agent_name = primary_agent['name']
-        agent_role = primary_agent['role']
-        agent_goal = primary_agent['goal']
-        agent_backstory = primary_agent['backstory']
+        if cache_key is None:
+            result = await run_team_completion(team_name, team_config, conversation_context, current_query, priority, history, options)
+            return replace(result, context=summary.context)
         
-        # Create team-specific prompt with conversation context and thinking tags
-        team_specific_instructions = get_team_specific_instructions(team_name)
+        async def produce() -> TeamRunResult:
+            result = await run_team_completion(team_name, team_config, conversation_context, current_query, priority, history, options)
+            if result.ok:
+                completion_cache.set(cache_key, result)
+            return result
         
-        agent_prompt = f"""You are {agent_name}, a {agent_role} representing the {team_config['name']}.
+        # Identical requests already in flight share that generation instead of starting another
+        coalesced = cache_key in completion_flight
+        try:
+            result = await completion_flight.do(cache_key, produce)
+        except (CompletionAborted, SharedCallCancelled):
+            # The shared generation failed or was abandoned by its other callers; run our own
+            result = await run_team_completion(team_name, team_config, conversation_context, current_query, priority, history, options)
+        return replace(result, cache_status="coalesced" if coalesced else result.cache_status, context=summary.context)
         
-Your goal: {agent_goal}
-Your background: {agent_backstory}
-
-TEAM WORKFLOW INSTRUCTIONS:
-{team_specific_instructions}
-
-You are working with a team of experts including other specialists, but you should provide a comprehensive response that represents the collective expertise of the entire team following your team's specific workflow.
-
-Conversation history:
-{conversation_context}
-
-Current question: {current_query}
-
-IMPORTANT: Structure your response with your reasoning process wrapped in <thinking> tags, followed by your final answer:
-
-<thinking>
-[Your analysis process here - follow your team's workflow instructions, break down the question, consider different perspectives from your team expertise, evaluate options, research findings if applicable]
-</thinking>
-
-[Your final comprehensive response here]
-
-Please provide a detailed, professional response to the current question, taking into account the conversation history. Show your reasoning process in the thinking section, then provide a clear final answer following your team's specific workflow approach."""
+    except Exception as e:
+        logger.error(f"Team execution error: {e}")
+        result = TeamRunResult(f"Error executing agent team: {str(e)}", [], ok=False)
+        if stream:
+            return TokenStream(replay_tokens(result, "miss", summary), summary)
+        return result
 
-        # Get search results if agent has internet search tool
-        search_context = ""
-        if "internet_search" in primary_agent.get("tools", []):
-            search_results = internet_search_tool(current_query)
-            search_context = f"\n\nAvailable research data:\n{search_results[:1000]}\n\nUse this research to inform your response."
-            agent_prompt += search_context
+async def run_team_completion(team_name: str, team_config: TeamConfig, conversation_context: str, current_query: str, priority: int = PRIORITY_INTERACTIVE, history: Optional[ConversationHistory] = None, options: Optional[Dict[str, Any]] = None) -> TeamRunResult:
+    """Run the agents and the aggregation call without streaming"""
+    if team_config.pipeline:
+        return await run_pipeline_completion(team_name, team_config, conversation_context, current_query, priority, options)
+    started = time.perf_counter()
+    lead_agent = team_config["agents"][0]
+    agent_results: List[AgentResult] = []
+    usage = GenerationUsage()
+    research_usage = GenerationUsage()
+    ok = True
+    try:
+        # Every agent works on the question in parallel, then the lead merges their notes
+        agent_results, research_usage = await run_team_agents(team_name, team_config, conversation_context, current_query, priority, history, options)
+        aggregation = aggregation_request(team_name, team_config, conversation_context, current_query, agent_results, history, options)
 
         try:
-            # Get AI response from Ollama
-            ollama_response = requests.post(ollama_url, json={
-                "model": "llama3.1:8b",
-                "prompt": agent_prompt,
-                "stream": False
-            }, timeout=30)
+            # Get AI response from Ollama once a generation slot is free
+            with span("aggregation", resumed="context" in aggregation):
+                async with scheduler.slot(team_name, priority):
+                    with timed_phase(team_name, PHASE_AGGREGATION_GENERATION), generation_span(aggregation["model"]) as generation:
+                        ollama_response = await backend_pool.generate(aggregation)
+                        usage = GenerationUsage.from_ollama(ollama_response)
+                        generation.set(**usage.span_attributes())
+            usage_stats.record(team_name, "aggregation", usage)
+            cancellation_stats.record_completed("aggregation", usage.completion_tokens)
             
-            if ollama_response.status_code == 200:
-                ai_response = ollama_response.json().get('response', 'No response generated')
-                # Clean the response to remove any internal formatting
-                import re
-                ai_response = re.sub(r'<[^>]+>', '', ai_response)  # Remove HTML tags
-                ai_response = re.sub(r'\*\*.*?\*\*:', '', ai_response)  # Remove bold headers like "**Research Team Response:**"
-                ai_response = ai_response.strip()
-            else:
-                ai_response = f"AI model unavailable. Using fallback analysis for {agent_role}."
+            ai_response = ollama_response.get('response', 'No response generated')
+            # Clean the response: remove HTML tags and bold headers like "**Research Team Response:**"
+            ai_response = sanitize_text(ai_response).strip()
+            kv_contexts.remember(team_name, "aggregation", aggregation["model"], history, ollama_response.get("context"), ai_response)
                 
+        except asyncio.CancelledError:
+            cancellation_stats.record_cancelled("aggregation")
+            raise
+        except UpstreamError as e:
+            logger.error(f"Ollama request failed: {e}")
+            ai_response = f"AI model unavailable. Using fallback analysis for {lead_agent['role']}."
+            ok = False
         except Exception as e:
             logger.error(f"Ollama request failed: {e}")
-            ai_response = f"As a {agent_role}, I would focus on {agent_goal.lower()} regarding '{current_query}'. However, the AI model is currently unavailable for detailed analysis."
-        
-        # Return clean response without multiple agent headers
-        response = ai_response
-        
-        return response
+            ai_response = f"As a {lead_agent['role']}, I would focus on {lead_agent['goal'].lower()} regarding '{current_query}'. However, the AI model is currently unavailable for detailed analysis."
+            ok = False
         
     except Exception as e:
         logger.error(f"Team execution error: {e}")
-        return f"Error executing agent team: {str(e)}"
+        ai_response = f"Error executing agent team: {str(e)}"
+        ok = False
 
-async def create_streaming_response(team_config: Dict, conversation_context: str, current_query: str) -> AsyncGenerator[str, None]:
-    """Create streaming response for agent team execution"""
-    try:
-        ollama_url = "http://ollama:11434/api/generate"
-        
-        # Skip complex initial headers to avoid HTML formatting issues
-        
-        # Use only the primary agent for streaming to avoid duplicates
-        primary_agent = team_config["agents"][0]
-        agent_name = primary_agent['name']
-        agent_role = primary_agent['role']
-        agent_goal = primary_agent['goal']
-        agent_backstory = primary_agent['backstory']
-        
-        # Create agent-specific prompt with conversation context and thinking tags
-        agent_prompt = f"""You are {agent_name}, a {agent_role} representing the {team_config['name']}.
-        
-Your goal: {agent_goal}
-Your background: {agent_backstory}
-
-You are working with a team of experts, but you should provide a comprehensive response that represents the collective expertise of the entire team.
-
-Conversation history:
-{conversation_context}
+    return TeamRunResult(ai_response, agent_results, (time.perf_counter() - started) * 1000, ok, usage=usage, research_usage=research_usage)
 
-Current question: {current_query}
+def pipeline_run(team_name: str, team_config: TeamConfig, conversation_context: str, current_query: str, priority: int, search_results: Optional[str], options: Optional[Dict[str, Any]] = None) -> PipelineRun:
+    return PipelineRun(team_name, team_config.pipeline, conversation_context, current_query, priority, search_results, options)
 
-IMPORTANT: Structure your response with your reasoning process wrapped in <thinking> tags, followed by your final answer:
+async def run_pipeline_completion(team_name: str, team_config: TeamConfig, conversation_context: str, current_query: str, priority: int = PRIORITY_INTERACTIVE, options: Optional[Dict[str, Any]] = None) -> TeamRunResult:
+    """Run a staged team to the end; the answer is the same transcript of titled stages that streaming sends"""
+    started = time.perf_counter()
+    search_results, research_usage = await team_search_results(team_name, team_config, current_query, priority)
+    run = pipeline_run(team_name, team_config, conversation_context, current_query, priority, search_results, options)
+    async with aclosing(run.tokens()) as tokens:
+        content = "".join([token async for token in tokens])
+    return TeamRunResult(content.strip(), run.results, (time.perf_counter() - started) * 1000, run.ok, research_usage=research_usage)
 
-<thinking>
-[Your analysis process here - break down the question, consider different perspectives from your team expertise, evaluate options, research findings if applicable]
-</thinking>
+async def replay_tokens(result: TeamRunResult, cache_status: str, summary: StreamSummary) -> AsyncGenerator[str, None]:
+    """Replay a finished completion as a single-token stream"""
+    summary.agents = result.agent_summaries()
+    summary.cache_status = cache_status
+    summary.usage = result.total_usage().to_openai()
+    summary.completed = result.ok
+    yield result.content
 
-[Your final comprehensive response here]
-
-Please provide a detailed, professional response to the current question, taking into account the conversation history. Show your reasoning process in the thinking section, then provide a clear final answer."""
+async def coalesced_tokens(team_name: str, team_config: TeamConfig, conversation_context: str, current_query: str, priority: int, cache_key: str, summary: StreamSummary, history: Optional[ConversationHistory] = None, options: Optional[Dict[str, Any]] = None) -> AsyncGenerator[str, None]:
+    """Wait for an identical in-flight generation and replay it, or run our own if it aborts"""
+    waiter = completion_flight.join(cache_key)
+    try:
+        if waiter is not None:
+            result = await waiter
+            if result.ok:
+                async for token in replay_tokens(result, "coalesced", summary):
+                    yield token
+                return
+    except (CompletionAborted, SharedCallCancelled):
+        pass
+    
+    async with aclosing(stream_team_tokens(team_name, team_config, conversation_context, current_query, priority, cache_key, summary, history, options)) as tokens:
+        async for token in tokens:
+            yield token
 
-        # Get search results if agent has internet search tool
-        if "internet_search" in primary_agent.get("tools", []):
-            search_results = internet_search_tool(current_query)
-            agent_prompt += f"\n\nAvailable research data:\n{search_results[:1000]}\n\nUse this research to inform your response."
+async def stream_team_tokens(team_name: str, team_config: TeamConfig, conversation_context: str, current_query: str, priority: int = PRIORITY_INTERACTIVE, cache_key: Optional[str] = None, summary: Optional[StreamSummary] = None, history: Optional[ConversationHistory] = None, options: Optional[Dict[str, Any]] = None) -> AsyncGenerator[str, None]:
+    """Run the team and yield the cleaned tokens of the merged answer as they arrive"""
+    started = time.perf_counter()
+    summary = summary or StreamSummary()
+    # Identical requests arriving meanwhile wait for this generation and replay it
+    producer = completion_flight.lead(cache_key) if cache_key else None
+    full_content = ""
+    completed = False
+    generated = 0
+    usage = GenerationUsage()
+    research_usage = GenerationUsage()
+    kv_context = None
+    agent_results: List[AgentResult] = []
+    try:
+        if team_config.pipeline:
+            # Staged teams stream each titled stage in turn instead of merging agent notes
+            search_results, research_usage = await team_search_results(team_name, team_config, current_query, priority)
+            run = pipeline_run(team_name, team_config, conversation_context, current_query, priority, search_results, options)
+            async with aclosing(run.tokens()) as tokens:
+                async for content in coalesce_tokens(tokens, SSE_COALESCE_CHARS, SSE_COALESCE_MS / 1000):
+                    full_content += content
+                    yield content
+            agent_results = run.results
+            summary.agents = [result.summary() for result in agent_results]
+            completed = run.ok
+            return
+        
+        lead_agent = team_config["agents"][0]
+        agent_role = lead_agent['role']
+        
+        # Agents run to completion first; only the merged answer is streamed
+        agent_results, research_usage = await run_team_agents(team_name, team_config, conversation_context, current_query, priority, history, options)
+        summary.agents = [result.summary() for result in agent_results]
+        aggregation = aggregation_request(team_name, team_config, conversation_context, current_query, agent_results, history, options)
 
         try:
-            # Stream AI response from Ollama
-            ollama_stream_response = requests.post(ollama_url, json={
-                "model": "llama3.1:8b",
-                "prompt": agent_prompt,
-                "stream": True
-            }, timeout=60, stream=True)
-            
-            if ollama_stream_response.status_code == 200:
-                for line in ollama_stream_response.iter_lines():
-                    if line:
-                        try:
-                            chunk_data = json.loads(line.decode('utf-8'))
-                            if 'response' in chunk_data:
-                                # Clean the response content
-                                content = chunk_data['response']
-                                # Remove any HTML tags or formatting markers
-                                import re
-                                content = re.sub(r'<[^>]+>', '', content)
-                                content = re.sub(r'\*\*.*?\*\*:', '', content)
-                                
-                                content_chunk = {
-                                    "id": f"chatcmpl-{uuid.uuid4()}",
-                                    "object": "chat.completion.chunk",
-                                    "created": int(datetime.now().timestamp()),
-                                    "model": "multi-agent-team",
-                                    "choices": [{
-                                        "index": 0,
-                                        "delta": {
-                                            "content": content
-                                        },
-                                        "finish_reason": None
-                                    }]
-                                }
-                                yield f"data: {json.dumps(content_chunk)}\n\n"
-                                
-                            if chunk_data.get('done', False):
-                                break
-                        except json.JSONDecodeError:
-                            continue
-            else:
-                error_chunk = {
-                    "id": f"chatcmpl-{uuid.uuid4()}",
-                    "object": "chat.completion.chunk",
-                    "created": int(datetime.now().timestamp()),
-                    "model": "multi-agent-team",
-                    "choices": [{
-                        "index": 0,
-                        "delta": {
-                            "content": f"AI model unavailable for {agent_role}.\n"
-                        },
-                        "finish_reason": None
-                    }]
-                }
-                yield f"data: {json.dumps(error_chunk)}\n\n"
+            # Stream AI response from Ollama, holding a generation slot until done
+            # Closing the Ollama stream early (client disconnect) aborts the generation upstream
+            with span("aggregation", resumed="context" in aggregation):
+                async with scheduler.slot(team_name, priority), aclosing(backend_pool.generate_stream(aggregation)) as ollama_stream:
+                    async def response_tokens() -> AsyncGenerator[str, None]:
+                        nonlocal generated, usage, kv_context
+                        async for chunk_data in ollama_stream:
+                            if chunk_data.get('done'):
+                                # The final chunk carries the eval counters and KV context for the whole generation
+                                usage = GenerationUsage.from_ollama(chunk_data)
+                                kv_context = chunk_data.get('context')
+                            if chunk_data.get('response'):
+                                generated += 1
+                                yield chunk_data['response']
+                    
+                    # Markup can be split across tokens, so cleaning carries state between chunks
+                    tokens = sanitize_stream(response_tokens())
+                    with timed_phase(team_name, PHASE_AGGREGATION_GENERATION), generation_span(aggregation["model"]) as generation:
+                        async for content in coalesce_tokens(tokens, SSE_COALESCE_CHARS, SSE_COALESCE_MS / 1000):
+                            full_content += content
+                            yield content
+                        generation.set(**usage.span_attributes())
+            completed = True
+            kv_contexts.remember(team_name, "aggregation", aggregation["model"], history, kv_context, full_content)
+            if not usage.completion_tokens:
+                usage.completion_tokens = generated
+            usage_stats.record(team_name, "aggregation", usage)
+            cancellation_stats.record_completed("aggregation", usage.completion_tokens)
+        
+        except (asyncio.CancelledError, GeneratorExit):
+            # Client disconnected while queued or mid-stream
+            cancellation_stats.record_cancelled("aggregation", generated)
+            raise
+                
+        except UpstreamError as e:
+            logger.error(f"Ollama streaming failed: {e}")
+            yield f"AI model unavailable for {agent_role}.\n"
                 
         except Exception as e:
             logger.error(f"Ollama streaming failed: {e}")
-            error_chunk = {
-                "id": f"chatcmpl-{uuid.uuid4()}",
-                "object": "chat.completion.chunk",
-                "created": int(datetime.now().timestamp()),
-                "model": "multi-agent-team",
-                "choices": [{
-                    "index": 0,
-                    "delta": {
-                        "content": f"Error getting response from {agent_role}: {str(e)}\n"
-                    },
-                    "finish_reason": None
-                }]
-            }
-            yield f"data: {json.dumps(error_chunk)}\n\n"
-        
-        # Send final chunk
-        final_chunk = {
-            "id": f"chatcmpl-{uuid.uuid4()}",
-            "object": "chat.completion.chunk",
-            "created": int(datetime.now().timestamp()),
-            "model": "multi-agent-team",
-            "choices": [{
-                "index": 0,
-                "delta": {},
-                "finish_reason": "stop"
-            }]
-        }
-        yield f"data: {json.dumps(final_chunk)}\n\n"
-        yield "data: [DONE]\n\n"
+            yield f"Error getting response from {agent_role}: {str(e)}\n"
         
     except Exception as e:
         logger.error(f"Streaming error: {e}")
-        error_chunk = {
-            "id": f"chatcmpl-{uuid.uuid4()}",
-            "object": "chat.completion.chunk",
-            "created": int(datetime.now().timestamp()),
-            "model": "multi-agent-team",
-            "choices": [{
-                "index": 0,
-                "delta": {
-                    "content": f"Error in streaming response: {str(e)}"
-                },
-                "finish_reason": "stop"
-            }]
-        }
-        yield f"data: {json.dumps(error_chunk)}\n\n"
-        yield "data: [DONE]\n\n"
+        yield f"Error in streaming response: {str(e)}"
+    finally:
+        if completed:
+            result = TeamRunResult(full_content.strip(), agent_results, (time.perf_counter() - started) * 1000, usage=usage, research_usage=research_usage)
+            summary.usage = result.total_usage().to_openai()
+            summary.completed = True
+            if cache_key:
+                completion_cache.set(cache_key, result)
+            if producer is not None and not producer.done():
+                producer.set_result(result)
+        elif producer is not None and not producer.done():
+            producer.set_exception(CompletionAborted())
 
 @app.get("/v1/models")
 async def list_models():
@@ -527,7 +685,7 @@ async def list_models():
     return {"object": "list", "data": models}
 
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
+async def chat_completions(request: ChatCompletionRequest, http_request: Request, http_response: Response):
     """Handle chat completions using PraisonAI agent teams with conversation context and streaming support"""
     try:
         # Validate messages
@@ -540,27 +698,33 @@ async def chat_completions(request: ChatCompletionRequest):
             raise HTTPException(status_code=400, detail=f"Unknown model: {request.model}")
         
         logger.info(f"Processing request with team: {team_config['name']}, streaming: {request.stream}")
+        request_metrics = label_request(http_request, request.model, "chat_completions", bool(request.stream))
+        
+        # OpenWebUI traffic is interactive and is served ahead of batch work
+        admit_request(PRIORITY_INTERACTIVE, run_generations(team_config))
+        use_cache = not cache_bypassed(http_request.headers)
+        options = generation_options(request.model_dump(include={"temperature", "max_tokens", "top_p", "stop", "seed"}))
         
         # Execute the agent team with full conversation context
         if request.stream:
             # Return streaming response
-            async def stream_generator():
-                async for chunk in await create_agent_team(request.model, team_config, request.messages, stream=True):
-                    yield chunk
+            token_stream = await create_agent_team(request.model, team_config, conversation_history(request.messages), stream=True, priority=PRIORITY_INTERACTIVE, use_cache=use_cache, options=options)
+            request_metrics.summary = token_stream.summary
             
             return StreamingResponse(
-                stream_generator(),
+                stream_until_disconnect(http_request, render_sse(token_stream), "chat_completions"),
                 media_type="text/plain",
                 headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
             )
         else:
-            # Non-streaming response
-            result = await create_agent_team(request.model, team_config, request.messages, stream=False)
-            
-            # Calculate token usage based on full conversation
-            full_conversation = " ".join([msg.content for msg in request.messages])
-            prompt_tokens = len(full_conversation.split())
-            completion_tokens = len(str(result).split())
+            # Non-streaming response; the generation is cancelled if the caller gives up waiting
+            result = await run_until_disconnect(
+                http_request,
+                create_agent_team(request.model, team_config, conversation_history(request.messages), stream=False, priority=PRIORITY_INTERACTIVE, use_cache=use_cache, options=options),
+                "chat_completions"
+            )
+            request_metrics.ok = result.ok
+            http_response.headers["X-Cache"] = result.cache_status if use_cache else "bypass"
             
             # Format response for OpenWebUI compatibility
             response = ChatCompletionResponse(
@@ -571,19 +735,22 @@ async def chat_completions(request: ChatCompletionRequest):
                     "index": 0,
                     "message": {
                         "role": "assistant",
-                        "content": str(result)
+                        "content": result.content
                     },
                     "finish_reason": "stop"
                 }],
-                usage={
-                    "prompt_tokens": prompt_tokens,
-                    "completion_tokens": completion_tokens,
-                    "total_tokens": prompt_tokens + completion_tokens
-                }
+                # Ollama's token counts summed over every agent call and the aggregation
+                usage=result.total_usage().to_openai(),
+                agents=result.agent_summaries(),
+                context=result.context
             )
             
             return response
         
+    except HTTPException:
+        raise
+    except ClientDisconnected:
+        return client_closed_response()
     except Exception as e:
         logger.error(f"Chat completion error: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
@@ -617,64 +784,441 @@ async def list_teams():
         }
     }
 
-@app.post("/teams/{team_id}/execute")
-async def execute_team(team_id: str, request_data: Dict[str, Any]):
-    """Direct team execution endpoint for n8n integration with conversation context support"""
-    team_config = AGENT_TEAMS.get(team_id)
-    if not team_config:
-        raise HTTPException(status_code=404, detail="Team not found")
-    
+def request_messages(request_data: Dict[str, Any]) -> List[ChatMessage]:
+    """Conversation of an execute request, given as a single query or a message list"""
     # Support both simple query and conversation format
     if "query" in request_data:
         # Simple query format (backward compatibility)
         user_query = request_data.get("query", "")
         if not user_query:
             raise HTTPException(status_code=400, detail="Query is required")
-        messages = [ChatMessage(role="user", content=user_query)]
-    elif "messages" in request_data:
+        return [ChatMessage(role="user", content=user_query)]
+    if "messages" in request_data:
         # Conversation format
         messages = [ChatMessage(**msg) for msg in request_data["messages"]]
         if not messages:
             raise HTTPException(status_code=400, detail="Messages are required")
-        user_query = messages[-1].content
-    else:
-        raise HTTPException(status_code=400, detail="Either 'query' or 'messages' is required")
+        return messages
+    raise HTTPException(status_code=400, detail="Either 'query' or 'messages' is required")
+
+@app.post("/teams/{team_id}/execute")
+async def execute_team(team_id: str, request_data: Dict[str, Any], http_request: Request, http_response: Response):
+    """Direct team execution endpoint for n8n integration with conversation context support"""
+    team_config = AGENT_TEAMS.get(team_id)
+    if not team_config:
+        raise HTTPException(status_code=404, detail="Team not found")
+    
+    messages = request_messages(request_data)
+    user_query = messages[-1].content
     
     stream = request_data.get("stream", False)
+    # "delta" sends only new text per line plus periodic/final snapshots;
+    # "full" repeats the whole response on every line for older workflows
+    stream_mode = request_data.get("stream_mode", NDJSON_MODE_FULL)
+    if stream_mode not in (NDJSON_MODE_FULL, NDJSON_MODE_DELTA):
+        raise HTTPException(status_code=400, detail=f"Unknown stream_mode: {stream_mode}")
+    snapshot_every = count_field(request_data, "snapshot_every", 0, 0)
+    # n8n calls default to the batch class; interactive UIs can opt in explicitly
+    priority = parse_priority(request_data.get("priority"), PRIORITY_BATCH)
+    request_metrics = label_request(http_request, team_id, "execute_team", bool(stream))
+    admit_request(priority, run_generations(team_config))
+    use_cache = not cache_bypassed(http_request.headers)
+    options = generation_options(request_data)
     
     if stream:
         # Return streaming response for n8n
-        async def stream_generator():
-            full_response = ""
-            async for chunk in await create_agent_team(team_id, team_config, messages, stream=True):
-                if chunk.startswith("data: ") and not chunk.startswith("data: [DONE]"):
-                    try:
-                        chunk_data = json.loads(chunk[6:])  # Remove "data: " prefix
-                        if chunk_data.get("choices") and chunk_data["choices"][0].get("delta", {}).get("content"):
-                            content = chunk_data["choices"][0]["delta"]["content"]
-                            full_response += content
-                            yield json.dumps({"partial_result": content, "full_result": full_response}) + "\n"
-                    except json.JSONDecodeError:
-                        continue
+        token_stream = await create_agent_team(team_id, team_config, conversation_history(messages), stream=True, priority=priority, use_cache=use_cache, options=options)
+        request_metrics.summary = token_stream.summary
         
         return StreamingResponse(
-            stream_generator(),
+            stream_until_disconnect(http_request, render_ndjson(token_stream, stream_mode, snapshot_every), "execute_team"),
             media_type="application/x-ndjson",
             headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
         )
     else:
-        # Non-streaming response
-        result = await create_agent_team(team_id, team_config, messages, stream=False)
+        # Non-streaming response; the generation is cancelled if the caller gives up waiting
+        try:
+            result = await run_until_disconnect(
+                http_request,
+                create_agent_team(team_id, team_config, conversation_history(messages), stream=False, priority=priority, use_cache=use_cache, options=options),
+                "execute_team"
+            )
+        except ClientDisconnected:
+            return client_closed_response()
+        request_metrics.ok = result.ok
+        http_response.headers["X-Cache"] = result.cache_status if use_cache else "bypass"
         
         return {
             "team_id": team_id,
             "team_name": team_config["name"],
             "query": user_query,
-            "result": str(result),
+            "result": result.content,
+            "agents": result.agent_summaries(),
+            "usage": result.total_usage().to_openai(),
+            "context": result.context,
+            "latency_ms": round(result.latency_ms, 1),
+            "cache": result.cache_status if use_cache else "bypass",
             "conversation_length": len(messages),
             "timestamp": datetime.now().isoformat()
         }
 
+def batch_items(request_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Validated batch items with their ids, conversation and per-item options"""
+    items = request_data.get("items")
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="'items' must be a non-empty list")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+    
+    options = generation_options(request_data)
+    parsed = []
+    seen_ids = set()
+    for index, item in enumerate(items):
+        # A bare string is shorthand for {"query": ...}
+        if isinstance(item, str):
+            item = {"query": item}
+        if not isinstance(item, dict):
+            raise HTTPException(status_code=400, detail=f"Item {index}: must be a string or an object")
+        try:
+            messages = request_messages(item)
+            item_options = generation_options(item)
+        except HTTPException as e:
+            raise HTTPException(status_code=400, detail=f"Item {index}: {e.detail}")
+        item_id = str(item.get("id", index))
+        if item_id in seen_ids:
+            raise HTTPException(status_code=400, detail=f"Item {index}: duplicate id {item_id!r}")
+        seen_ids.add(item_id)
+        parsed.append({
+            "id": item_id,
+            "index": index,
+            "messages": messages,
+            "options": {**options, **item_options}
+        })
+    return parsed
+
+def batch_result_line(item: Dict[str, Any], result: TeamRunResult, use_cache: bool, duplicate_of: Optional[str] = None) -> Dict[str, Any]:
+    line = {
+        "id": item["id"],
+        "index": item["index"],
+        "ok": result.ok,
+        "result": result.content,
+        "agents": result.agent_summaries(),
+        # A duplicate reuses its original's answer without spending tokens of its own
+        "usage": (GenerationUsage() if duplicate_of else result.total_usage()).to_openai(),
+        "context": result.context,
+        "latency_ms": round(result.latency_ms, 1),
+        "cache": "duplicate" if duplicate_of else result.cache_status if use_cache else "bypass",
+    }
+    if duplicate_of:
+        line["duplicate_of"] = duplicate_of
+    return line
+
+@app.post("/teams/{team_id}/execute_batch")
+async def execute_team_batch(team_id: str, request_data: Dict[str, Any], http_request: Request):
+    """Run many queries or conversations through one team for n8n loops
+
+    Identical items are run once. Items go through the generation scheduler
+    with at most ``concurrency`` in flight, and with ``"stream": true`` (the
+    default) each result is sent as an NDJSON line as soon as it is ready,
+    followed by a final ``"done": true`` line.
+    """
+    team_config = AGENT_TEAMS.get(team_id)
+    if not team_config:
+        raise HTTPException(status_code=404, detail="Team not found")
+    
+    items = batch_items(request_data)
+    stream = bool(request_data.get("stream", True))
+    slots = BATCH_MAX_CONCURRENCY or scheduler.max_concurrency
+    concurrency = min(count_field(request_data, "concurrency", slots, 1), slots)
+    priority = parse_priority(request_data.get("priority"), PRIORITY_BATCH)
+    request_metrics = label_request(http_request, team_id, "execute_batch", stream)
+    # At most ``concurrency`` items have generations queued at once
+    admit_request(priority, min(len(items), concurrency) * run_generations(team_config))
+    use_cache = not cache_bypassed(http_request.headers)
+    
+    # Items that would render the same prompts share one run
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for item in items:
+        item["history"] = conversation_history(item["messages"])
+        key = completion_cache_key(team_id, team_config, item["history"], item["options"])
+        groups.setdefault(key, []).append(item)
+    
+    def job(item: Dict[str, Any]):
+        return lambda: create_agent_team(team_id, team_config, item["history"], stream=False, priority=priority, use_cache=use_cache, options=item["options"])
+    
+    jobs = {key: job(group[0]) for key, group in groups.items()}
+    logger.info(f"Executing batch of {len(items)} items ({len(jobs)} unique) for team {team_id} with concurrency {concurrency}")
+    
+    async def result_lines() -> AsyncGenerator[Dict[str, Any], None]:
+        started = time.perf_counter()
+        failed = 0
+        async with aclosing(run_bounded(jobs, concurrency)) as results:
+            async for key, result, error in results:
+                if error is not None:
+                    logger.error(f"Batch item failed: {error}")
+                    result = TeamRunResult(f"Error executing agent team: {str(error)}", [], ok=False)
+                original, *duplicates = groups[key]
+                failed += 0 if result.ok else 1 + len(duplicates)
+                yield batch_result_line(original, result, use_cache)
+                for duplicate in duplicates:
+                    yield batch_result_line(duplicate, result, use_cache, duplicate_of=original["id"])
+        request_metrics.ok = failed == 0
+        yield {
+            "done": True,
+            "team_id": team_id,
+            "items": len(items),
+            "unique": len(jobs),
+            "failed": failed,
+            "concurrency": concurrency,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+    
+    if stream:
+        async def ndjson() -> AsyncGenerator[str, None]:
+            async with aclosing(result_lines()) as lines:
+                async for line in lines:
+                    yield json.dumps(line) + "\n"
+        
+        return StreamingResponse(
+            stream_until_disconnect(http_request, ndjson(), "execute_batch"),
+            media_type="application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
+        )
+    
+    async def collect() -> List[Dict[str, Any]]:
+        async with aclosing(result_lines()) as lines:
+            return [line async for line in lines]
+    
+    try:
+        lines = await run_until_disconnect(http_request, collect(), "execute_batch")
+    except ClientDisconnected:
+        return client_closed_response()
+    summary = lines.pop()
+    return {
+        **summary,
+        "team_name": team_config["name"],
+        "results": sorted(lines, key=lambda line: line["index"]),
+        "timestamp": datetime.now().isoformat()
+    }
+
+# Background jobs: long team runs that callers poll or follow instead of holding a request open
+async def run_job(job: Job, publish: Callable[[Dict[str, Any]], None]) -> Dict[str, Any]:
+    """Run a job's team request, publishing each content delta to callers following its events"""
+    team_config = AGENT_TEAMS.get(job.team)
+    if not team_config:
+        raise ValueError(f"Team {job.team} no longer exists")
+    request = job.request
+    messages = [ChatMessage(**msg) for msg in request["messages"]]
+    token_stream = await create_agent_team(job.team, team_config, conversation_history(messages), stream=True, priority=request["priority"], use_cache=request["use_cache"], options=request["options"])
+    parts = []
+    try:
+        async for token in token_stream:
+            parts.append(token)
+            publish({"type": "delta", "content": token})
+    finally:
+        await token_stream.aclose()
+    return {"ok": token_stream.summary.completed, "result": "".join(parts), **token_stream.final_fields()}
+
+async def get_job_or_404(job_id: str) -> Job:
+    job = await job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs")
+async def job_stats():
+    """Background job counts, limits and outcomes"""
+    return job_store.stats()
+
+@app.post("/jobs", status_code=202)
+async def submit_job(request_data: Dict[str, Any], http_request: Request):
+    """Queue a team run and return its job id at once
+
+    The body is that of ``/teams/{team_id}/execute`` plus ``"team"``. Poll
+    ``/jobs/{job_id}`` (optionally with ``?wait=`` seconds) or follow
+    ``/jobs/{job_id}/events`` for the result.
+    """
+    team_id = request_data.get("team")
+    if team_id not in AGENT_TEAMS:
+        raise HTTPException(status_code=404, detail="Team not found")
+    messages = request_messages(request_data)
+    job_request = {
+        "messages": [{"role": msg.role, "content": msg.content} for msg in messages],
+        "options": generation_options(request_data),
+        "priority": parse_priority(request_data.get("priority"), PRIORITY_BATCH),
+        "use_cache": not cache_bypassed(http_request.headers),
+    }
+    try:
+        job = await job_store.submit(team_id, job_request)
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "30"})
+    logger.info(f"Queued job {job.id} for team {team_id}")
+    return {
+        **job.summary(),
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events",
+    }
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0):
+    """Status and, once finished, the result of a job; ``wait`` long-polls up to that many seconds for it to finish"""
+    if wait > 0:
+        job = await job_store.wait(job_id, wait)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return job.summary()
+    return (await get_job_or_404(job_id)).summary()
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, http_request: Request, after: int = 0):
+    """NDJSON status events after sequence number ``after``, then live content deltas until the job finishes"""
+    await get_job_or_404(job_id)
+    
+    async def ndjson() -> AsyncGenerator[str, None]:
+        async with aclosing(job_store.events(job_id, after)) as events:
+            async for event in events:
+                yield json.dumps(event) + "\n"
+    
+    return StreamingResponse(
+        stream_until_disconnect(http_request, ndjson(), "job_events"),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
+    )
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """Stop a queued or running job; a finished job is returned unchanged"""
+    job = await job_store.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.summary()
+
+@app.delete("/jobs/{job_id}")
+async def delete_job(job_id: str):
+    """Cancel a job if it is still running and forget it"""
+    if not await job_store.delete(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"deleted": job_id}
+
+# Conversation sessions: history stays on the server, clients send only the new turn
+SESSION_ROLES = ("system", "user", "assistant")
+
+async def get_session_or_404(session_id: str) -> Session:
+    session = await session_store.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return session
+
+def record_session_reply(session: Session, user_turn: Turn, token_stream: TokenStream) -> TokenStream:
+    """Pass a reply stream through, appending the exchange to the session once it completes"""
+    async def tokens() -> AsyncGenerator[str, None]:
+        parts: List[str] = []
+        try:
+            async for token in token_stream:
+                parts.append(token)
+                yield token
+            if token_stream.summary.completed:
+                await session_store.append(session, [user_turn, Turn("assistant", "".join(parts).strip())])
+        finally:
+            await token_stream.aclose()
+    
+    return TokenStream(tokens(), token_stream.summary)
+
+@app.get("/sessions")
+async def session_stats():
+    """Active session counts and store settings"""
+    return session_store.stats()
+
+@app.post("/sessions")
+async def create_session(request: SessionCreateRequest):
+    """Start a conversation with a team, optionally seeded with earlier messages"""
+    if request.team not in AGENT_TEAMS:
+        raise HTTPException(status_code=404, detail="Team not found")
+    if any(msg.role not in SESSION_ROLES for msg in request.messages):
+        raise HTTPException(status_code=400, detail=f"Message roles must be one of {', '.join(SESSION_ROLES)}")
+    session = await session_store.create(request.team, [Turn(msg.role, msg.content) for msg in request.messages])
+    return session.summary()
+
+@app.get("/sessions/{session_id}")
+async def get_session(session_id: str):
+    """Session metadata"""
+    return (await get_session_or_404(session_id)).summary()
+
+@app.post("/sessions/{session_id}/messages")
+async def append_session_message(session_id: str, message: ChatMessage):
+    """Add a turn to the history without generating a reply"""
+    if message.role not in SESSION_ROLES:
+        raise HTTPException(status_code=400, detail=f"Role must be one of {', '.join(SESSION_ROLES)}")
+    session = await get_session_or_404(session_id)
+    await session_store.append(session, [Turn(message.role, message.content)])
+    return session.summary()
+
+@app.post("/sessions/{session_id}/reply")
+async def session_reply(session_id: str, request: SessionReplyRequest, http_request: Request, http_response: Response):
+    """Send a new user message and get the team's reply, streamed as NDJSON or returned whole"""
+    session = await get_session_or_404(session_id)
+    if request.stream_mode not in (NDJSON_MODE_FULL, NDJSON_MODE_DELTA):
+        raise HTTPException(status_code=400, detail=f"Unknown stream_mode: {request.stream_mode}")
+    # Sessions serve chat UIs, so they default to the interactive class
+    priority = parse_priority(request.priority, PRIORITY_INTERACTIVE)
+    request_metrics = label_request(http_request, session.team, "session_reply", request.stream)
+    team_config = AGENT_TEAMS.get(session.team)
+    if not team_config:
+        # The team was removed from agents.yaml after the session started
+        raise HTTPException(status_code=404, detail="Team not found")
+    admit_request(priority, run_generations(team_config))
+    use_cache = not cache_bypassed(http_request.headers)
+    options = generation_options(request.model_dump(include={"temperature", "max_tokens", "top_p", "num_ctx", "stop", "seed"}))
+    
+    # The exchange is recorded only once the reply completes, so a failed or
+    # abandoned turn leaves the session unchanged
+    user_turn = Turn("user", request.content)
+    history = session.history.append(user_turn)
+    
+    if request.stream:
+        token_stream = await create_agent_team(session.team, team_config, history, stream=True, priority=priority, use_cache=use_cache, options=options)
+        request_metrics.summary = token_stream.summary
+        return StreamingResponse(
+            stream_until_disconnect(
+                http_request,
+                render_ndjson(record_session_reply(session, user_turn, token_stream), request.stream_mode, request.snapshot_every),
+                "session_reply"
+            ),
+            media_type="application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
+        )
+    
+    try:
+        result = await run_until_disconnect(
+            http_request,
+            create_agent_team(session.team, team_config, history, stream=False, priority=priority, use_cache=use_cache, options=options),
+            "session_reply"
+        )
+    except ClientDisconnected:
+        return client_closed_response()
+    request_metrics.ok = result.ok
+    if result.ok:
+        await session_store.append(session, [user_turn, Turn("assistant", result.content)])
+    http_response.headers["X-Cache"] = result.cache_status if use_cache else "bypass"
+    
+    return {
+        **session.summary(),
+        "result": result.content,
+        "agents": result.agent_summaries(),
+        "usage": result.total_usage().to_openai(),
+        "context": result.context,
+        "latency_ms": round(result.latency_ms, 1),
+        "cache": result.cache_status if use_cache else "bypass",
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """End a session and remove its stored history"""
+    await get_session_or_404(session_id)
+    await session_store.delete(session_id)
+    return {"session_id": session_id, "deleted": True}
+
 @app.get("/")
 async def root():
     """Root endpoint with API information"""
@@ -685,20 +1229,90 @@ async def root():
             "models": "/v1/models",
             "chat": "/v1/chat/completions", 
             "teams": "/teams",
+            "batch": "/teams/{team_id}/execute_batch",
+            "jobs": "/jobs",
+            "sessions": "/sessions",
+            "scheduler": "/scheduler/stats",
+            "cache": "/cache/stats",
+            "usage": "/usage/stats",
+            "metrics": "/metrics",
             "docs": "/docs"
         },
         "available_teams": list(AGENT_TEAMS.keys())
     }
 
+def circuit_stats() -> Dict[str, Dict[str, Any]]:
+    """State of every circuit breaker in front of an upstream dependency"""
+    circuits = {search_breaker.service: search_breaker.stats()}
+    for backend in backend_pool.backends:
+        circuits[backend.breaker.service] = backend.breaker.stats()
+    return circuits
+
+# Scrape-time figures from the scheduler, circuits, backends, caches and jobs
+register_collector(RuntimeCollector(
+    model_warmer, scheduler, backend_pool, circuit_stats,
+    (("search", search_cache), ("research", researcher.cache), ("pages", grounder), ("completions", completion_cache), ("kv_contexts", kv_contexts.cache)),
+    job_store
+).collect)
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus metrics"""
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
 @app.get("/health")
-async def health_check():
-    """Health check endpoint"""
+async def health_check(response: Response):
+    """Health check endpoint; answers 503 until every team model is loaded in Ollama"""
+    ready = model_warmer.ready
+    circuits = circuit_stats()
+    if not ready:
+        response.status_code = 503
+        status = "warming"
+    elif any(circuit["state"] != "closed" for circuit in circuits.values()):
+        # Still serving, with degraded answers from whatever dependency is failing fast
+        status = "degraded"
+    else:
+        status = "healthy"
     return {
-        "status": "healthy",
+        "status": status,
         "timestamp": datetime.now().isoformat(),
-        "available_teams": len(AGENT_TEAMS)
+        "available_teams": len(AGENT_TEAMS),
+        "team_registry": team_registry.stats(),
+        "models": model_warmer.stats(),
+        "circuits": circuits,
+        "backends": backend_pool.stats(),
+        "tracing": tracer.stats(),
+        "generation_queue": {
+            "running": scheduler.running,
+            "queue_depth": scheduler.waiting,
+            "max_concurrency": scheduler.max_concurrency
+        }
+    }
+
+@app.get("/scheduler/stats")
+async def scheduler_stats():
+    """Generation queue depth, wait times and abandoned work for capacity planning"""
+    return {
+        **scheduler.stats(),
+        "cancellations": {**cancellation_stats.stats(), "abandoned_shared_completions": completion_flight.abandoned}
+    }
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit/miss counters for the in-process caches"""
+    return {
+        "search": {**search_cache.stats(), "coalesced": search_flight.coalesced},
+        "research": researcher.stats(),
+        # Off the event loop: the first call scans the cache directory, later ones wait on its lock
+        "pages": await asyncio.to_thread(grounder.stats),
+        "completions": {**completion_cache.stats(), "coalesced": completion_flight.coalesced}
     }
 
+@app.get("/usage/stats")
+async def usage_statistics():
+    """Token totals and throughput per team, history trimmed to fit context budgets and KV context reuse"""
+    return {**usage_stats.stats(), "context": context_builder.stats(), "kv_reuse": kv_contexts.stats()}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
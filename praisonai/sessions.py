@@ -0,0 +1,213 @@
+# Server-side conversation sessions for the Keiken Teams API
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from context_builder import ConversationHistory, Turn
+
+logger = logging.getLogger(__name__)
+
+# Sessions kept in memory; least recently used ones are evicted past this bound
+SESSION_MAX_ACTIVE = int(os.getenv("SESSION_MAX_ACTIVE", "1000"))
+# Sessions idle for longer than this many seconds expire
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "3600"))
+# Persistence backend: "memory" (none) or "file" (append-only JSONL per session)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_DIR = os.getenv("SESSION_DIR", "/tmp/keiken-sessions")
+
+_SESSION_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+@dataclass
+class Session:
+    """A conversation with one team whose history lives on the server"""
+    id: str
+    team: str
+    history: ConversationHistory
+    created_at: float
+    last_used: float
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.id,
+            "team": self.team,
+            "turns": len(self.history),
+            "history_tokens": self.history.tokens,
+            "created_at": self.created_at,
+            "last_used": self.last_used,
+        }
+
+
+class SessionBackend:
+    """Persistence interface for sessions; this base class keeps nothing"""
+
+    async def create(self, session: Session) -> None:
+        pass
+
+    async def append(self, session: Session, turns: List[Turn]) -> None:
+        pass
+
+    async def load(self, session_id: str) -> Optional[Session]:
+        return None
+
+    async def delete(self, session_id: str) -> None:
+        pass
+
+
+class FileSessionBackend(SessionBackend):
+    """One append-only JSONL file per session, so each turn is a single small write
+
+    The first line records the team and creation time; every further line is
+    one turn. File access runs in a worker thread to keep the event loop free.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id: str) -> str:
+        return os.path.join(self.directory, f"{session_id}.jsonl")
+
+    def _write(self, session_id: str, lines: List[Dict[str, Any]], mode: str) -> None:
+        with open(self._path(session_id), mode, encoding="utf-8") as f:
+            f.write("".join(json.dumps(line) + "\n" for line in lines))
+
+    async def create(self, session: Session) -> None:
+        lines = [{"team": session.team, "created_at": session.created_at}]
+        lines += [{"role": turn.role, "content": turn.content} for turn in session.history.turns()]
+        await asyncio.to_thread(self._write, session.id, lines, "w")
+
+    async def append(self, session: Session, turns: List[Turn]) -> None:
+        lines = [{"role": turn.role, "content": turn.content} for turn in turns]
+        await asyncio.to_thread(self._write, session.id, lines, "a")
+
+    def _read(self, session_id: str) -> Optional[Session]:
+        path = self._path(session_id)
+        try:
+            last_used = os.path.getmtime(path)
+            with open(path, encoding="utf-8") as f:
+                header = json.loads(f.readline())
+                turns = [Turn(**json.loads(line)) for line in f if line.strip()]
+        except (OSError, ValueError, TypeError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.error(f"Could not load session {session_id}: {e}")
+            return None
+        history = ConversationHistory.from_turns(turns)
+        return Session(session_id, header["team"], history, header["created_at"], last_used)
+
+    async def load(self, session_id: str) -> Optional[Session]:
+        return await asyncio.to_thread(self._read, session_id)
+
+    async def delete(self, session_id: str) -> None:
+        try:
+            await asyncio.to_thread(os.remove, self._path(session_id))
+        except FileNotFoundError:
+            pass
+
+
+def make_session_backend(name: str) -> SessionBackend:
+    if name == "file":
+        return FileSessionBackend(SESSION_DIR)
+    if name != "memory":
+        logger.warning(f"Unknown SESSION_BACKEND {name!r}, keeping sessions in memory only")
+    return SessionBackend()
+
+
+class SessionStore:
+    """LRU of active sessions with idle expiry, backed by a persistence backend
+
+    Sessions evicted from memory are reloaded from the backend on next use;
+    with the in-memory backend an evicted session is gone.
+    """
+
+    def __init__(self, backend: SessionBackend, max_active: int, idle_ttl: float):
+        self.backend = backend
+        self.max_active = max(1, max_active)
+        self.idle_ttl = idle_ttl
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self.created = 0
+        self.evicted = 0
+        self.expired = 0
+        self.reloaded = 0
+
+    def _expired(self, session: Session) -> bool:
+        return time.time() - session.last_used > self.idle_ttl
+
+    def _remember(self, session: Session) -> None:
+        self._sessions[session.id] = session
+        self._sessions.move_to_end(session.id)
+        while len(self._sessions) > self.max_active:
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+
+    async def create(self, team: str, turns: List[Turn]) -> Session:
+        self.sweep()
+        now = time.time()
+        session = Session(uuid.uuid4().hex, team, ConversationHistory.from_turns(turns), now, now)
+        await self.backend.create(session)
+        self._remember(session)
+        self.created += 1
+        return session
+
+    async def get(self, session_id: str) -> Optional[Session]:
+        if not _SESSION_ID.match(session_id):
+            return None
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = await self.backend.load(session_id)
+            if session is not None:
+                self.reloaded += 1
+        if session is None:
+            return None
+        if self._expired(session):
+            await self.delete(session_id)
+            self.expired += 1
+            return None
+        session.last_used = time.time()
+        self._remember(session)
+        return session
+
+    async def append(self, session: Session, turns: List[Turn]) -> None:
+        """Add turns to the current history; earlier snapshots are left untouched"""
+        history = session.history
+        for turn in turns:
+            history = history.append(turn)
+        session.history = history
+        session.last_used = time.time()
+        await self.backend.append(session, turns)
+
+    async def delete(self, session_id: str) -> None:
+        if not _SESSION_ID.match(session_id):
+            return
+        self._sessions.pop(session_id, None)
+        await self.backend.delete(session_id)
+
+    def sweep(self) -> int:
+        """Drop idle sessions from memory; returns how many were dropped"""
+        idle = [session_id for session_id, session in self._sessions.items() if self._expired(session)]
+        for session_id in idle:
+            del self._sessions[session_id]
+        self.expired += len(idle)
+        return len(idle)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": len(self._sessions),
+            "max_active": self.max_active,
+            "idle_ttl_seconds": self.idle_ttl,
+            "backend": type(self.backend).__name__,
+            "created": self.created,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "reloaded": self.reloaded,
+        }
+
+
+session_store = SessionStore(make_session_backend(SESSION_BACKEND), SESSION_MAX_ACTIVE, SESSION_IDLE_TTL)
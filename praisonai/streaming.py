@@ -0,0 +1,308 @@
+# Streaming helpers for the Keiken Teams API
+import json
+import re
+import time
+import uuid
+from dataclasses import dataclass, field
+from json.encoder import encode_basestring_ascii
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+# Characters that can start markup the sanitizer removes
+_SPECIAL = re.compile(r"[<*]")
+
+# Longest tag or bold header held back before it is released as plain text
+MAX_PENDING_MARKUP = 256
+
+
+class StreamSanitizer:
+    """Incremental equivalent of stripping ``<[^>]+>`` tags and ``**...**:`` headers
+
+    Text is fed in arbitrary chunks and only markup that may still be completing
+    is carried over to the next chunk, so tags and headers split across token
+    boundaries are removed just like in the whole-text case. Each character is
+    examined at most once; chunks without ``<`` or ``*`` pass straight through.
+    """
+
+    def __init__(self):
+        self._tag = None    # "<..." while inside a possible tag
+        self._star = False  # a single "*" waiting to see if a second follows
+        self._bold = None   # "**..." while inside a possible bold header
+
+    def _idle(self) -> bool:
+        return self._tag is None and self._bold is None and not self._star
+
+    def feed(self, chunk: str) -> str:
+        """Return the part of ``chunk`` that is safe to emit now"""
+        if self._idle() and "<" not in chunk and "*" not in chunk:
+            return chunk
+
+        out: List[str] = []
+        i, n = 0, len(chunk)
+        while i < n:
+            if self._idle():
+                match = _SPECIAL.search(chunk, i)
+                if match is None:
+                    out.append(chunk[i:])
+                    break
+                if match.start() > i:
+                    out.append(chunk[i:match.start()])
+                    i = match.start()
+            self._tag_char(chunk[i], out)
+            i += 1
+        return "".join(out)
+
+    def flush(self) -> str:
+        """Release anything still held back at the end of the stream"""
+        out: List[str] = []
+        if self._tag is not None:
+            tag, self._tag = self._tag, None
+            self._text(tag, out)
+        if self._star:
+            self._star = False
+            out.append("*")
+        if self._bold is not None:
+            out.append(self._bold)
+            self._bold = None
+        return "".join(out)
+
+    def _tag_char(self, ch: str, out: List[str]) -> None:
+        if self._tag is None:
+            if ch == "<":
+                self._tag = ch
+            else:
+                self._bold_char(ch, out)
+            return
+
+        if ch == ">" and len(self._tag) > 1:
+            # Complete tag, drop it
+            self._tag = None
+            return
+        self._tag += ch
+        if ch == ">" or len(self._tag) > MAX_PENDING_MARKUP:
+            # "<>" or an unterminated "<" is ordinary text
+            tag, self._tag = self._tag, None
+            self._text(tag, out)
+
+    def _text(self, text: str, out: List[str]) -> None:
+        for ch in text:
+            self._bold_char(ch, out)
+
+    def _bold_char(self, ch: str, out: List[str]) -> None:
+        if self._bold is not None:
+            self._bold += ch
+            if ch == ":" and len(self._bold) >= 5 and self._bold.endswith("**:"):
+                # Complete "**...**:" header, drop it
+                self._bold = None
+            elif ch == "\n" or len(self._bold) > MAX_PENDING_MARKUP:
+                out.append(self._bold)
+                self._bold = None
+            return
+
+        if self._star:
+            self._star = False
+            if ch == "*":
+                self._bold = "**"
+                return
+            out.append("*")
+        if ch == "*":
+            self._star = True
+        else:
+            out.append(ch)
+
+
+def sanitize_text(text: str) -> str:
+    """Strip tags and bold headers from a complete response"""
+    sanitizer = StreamSanitizer()
+    return sanitizer.feed(text) + sanitizer.flush()
+
+
+async def sanitize_stream(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Strip markup from a token stream, skipping chunks that clean to nothing"""
+    sanitizer = StreamSanitizer()
+    async for chunk in chunks:
+        content = sanitizer.feed(chunk)
+        if content:
+            yield content
+    tail = sanitizer.flush()
+    if tail:
+        yield tail
+
+
+class SSEChunkEncoder:
+    """Encode OpenAI-compatible ``chat.completion.chunk`` SSE frames for one completion
+
+    The id and created timestamp are fixed once per completion, and the JSON
+    envelope around the delta is serialized up front, so each token costs one
+    string escape and a concatenation.
+    """
+
+    DONE = "data: [DONE]\n\n"
+
+    def __init__(self, model: str = "multi-agent-team", completion_id: Optional[str] = None,
+                 created: Optional[int] = None):
+        self.id = completion_id or f"chatcmpl-{uuid.uuid4()}"
+        self.created = created or int(time.time())
+        self.model = model
+        envelope = json.dumps({
+            "id": self.id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+        })
+        self._prefix = "data: " + envelope[:-1] + ', "choices": [{"index": 0, "delta": {"content": '
+        self._suffix = '}, "finish_reason": null}]}\n\n'
+
+    def content(self, text: str) -> str:
+        """Frame carrying a content delta"""
+        return self._prefix + encode_basestring_ascii(text) + self._suffix
+
+    def finish(self, finish_reason: str = "stop", **extra: Any) -> str:
+        """Final frame with an empty delta; extra keys are added to the envelope"""
+        chunk = {
+            "id": self.id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+            "choices": [{
+                "index": 0,
+                "delta": {},
+                "finish_reason": finish_reason
+            }],
+            **extra
+        }
+        return f"data: {json.dumps(chunk)}\n\n"
+
+
+async def coalesce_tokens(tokens: AsyncIterator[str], max_chars: int = 0,
+                          max_delay: float = 0.0) -> AsyncIterator[str]:
+    """Merge consecutive tokens into larger frames
+
+    A frame is emitted once it holds ``max_chars`` characters, or when a token
+    arrives more than ``max_delay`` seconds after the frame was started. With
+    both limits at zero tokens pass through unchanged.
+    """
+    if max_chars <= 0 and max_delay <= 0:
+        async for token in tokens:
+            yield token
+        return
+
+    buffer: List[str] = []
+    size = 0
+    started = 0.0
+    async for token in tokens:
+        if not buffer:
+            started = time.monotonic()
+        buffer.append(token)
+        size += len(token)
+        if (max_chars > 0 and size >= max_chars) or (
+            max_delay > 0 and time.monotonic() - started >= max_delay
+        ):
+            yield "".join(buffer)
+            buffer.clear()
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+@dataclass
+class StreamSummary:
+    """Metadata a token stream fills in while it runs, read by renderers at the end"""
+    agents: List[Dict[str, Any]] = field(default_factory=list)
+    cache_status: str = "miss"
+    usage: Optional[Dict[str, Any]] = None
+    context: Optional[Dict[str, Any]] = None
+    # True once the stream has delivered a complete answer rather than an error message
+    completed: bool = False
+    # Time the renderer spent encoding frames, reported as the serialization phase
+    serialize_seconds: float = 0.0
+
+
+class TokenStream:
+    """Content deltas of one team completion, independent of the wire format"""
+
+    def __init__(self, tokens: AsyncIterator[str], summary: Optional[StreamSummary] = None):
+        self.tokens = tokens
+        self.summary = summary or StreamSummary()
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self.tokens.__aiter__()
+
+    async def aclose(self) -> None:
+        """Stop the underlying generation, releasing its slot and upstream connection"""
+        aclose = getattr(self.tokens, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+    def final_fields(self) -> Dict[str, Any]:
+        fields: Dict[str, Any] = {"agents": self.summary.agents}
+        if self.summary.usage is not None:
+            fields["usage"] = self.summary.usage
+        if self.summary.context is not None:
+            fields["context"] = self.summary.context
+        if self.summary.cache_status != "miss":
+            fields["cache"] = self.summary.cache_status
+        return fields
+
+
+async def render_sse(stream: TokenStream, encoder: Optional[SSEChunkEncoder] = None) -> AsyncIterator[str]:
+    """OpenAI-compatible SSE body for OpenWebUI"""
+    encoder = encoder or SSEChunkEncoder()
+    summary = stream.summary
+    clock = time.perf_counter
+    try:
+        async for token in stream:
+            started = clock()
+            frame = encoder.content(token)
+            summary.serialize_seconds += clock() - started
+            yield frame
+        yield encoder.finish("stop", **stream.final_fields())
+        yield encoder.DONE
+    finally:
+        await stream.aclose()
+
+
+# NDJSON stream modes for /teams/{team_id}/execute
+NDJSON_MODE_FULL = "full"
+NDJSON_MODE_DELTA = "delta"
+
+
+async def render_ndjson(stream: TokenStream, mode: str = NDJSON_MODE_FULL,
+                        snapshot_every: int = 0) -> AsyncIterator[str]:
+    """Newline-delimited JSON body for n8n
+
+    ``full`` mode repeats the whole response so far on every line, as older
+    workflows expect, ending on a ``done`` line with the same ``full_result``.
+    ``delta`` mode sends only the new text per line, with a ``full_result``
+    snapshot every ``snapshot_every`` lines (0 for none) and always on the
+    final ``done`` line.
+    """
+    summary = stream.summary
+    clock = time.perf_counter
+    try:
+        parts: List[str] = []
+        if mode == NDJSON_MODE_DELTA:
+            count = 0
+            async for token in stream:
+                started = clock()
+                parts.append(token)
+                count += 1
+                line: Dict[str, Any] = {"partial_result": token}
+                if snapshot_every > 0 and count % snapshot_every == 0:
+                    line["full_result"] = "".join(parts)
+                frame = json.dumps(line) + "\n"
+                summary.serialize_seconds += clock() - started
+                yield frame
+            yield json.dumps({"full_result": "".join(parts), "done": True, **stream.final_fields()}) + "\n"
+            return
+
+        full_response = ""
+        async for token in stream:
+            started = clock()
+            full_response += token
+            frame = json.dumps({"partial_result": token, "full_result": full_response}) + "\n"
+            summary.serialize_seconds += clock() - started
+            yield frame
+        # The last line still carries full_result, which full-mode workflows read from it
+        yield json.dumps({"full_result": full_response, "done": True, **stream.final_fields()}) + "\n"
+    finally:
+        await stream.aclose()
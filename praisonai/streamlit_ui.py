@@ -175,7 +175,7 @@ if prompt:
         with st.spinner("AI is thinking..."):
             response = requests.post(
                 f"http://keiken-teams-api:8000/teams/{selected_team}/execute",
-                json={"messages": api_messages},
+                json={"messages": api_messages, "priority": "interactive"},
                 timeout=60
             )
             
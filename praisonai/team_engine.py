@@ -0,0 +1,291 @@
+# Multi-agent execution engine for Keiken agent teams
+import asyncio
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional
+
+from context_builder import ConversationHistory, Turn, render_turns
+from disconnect import cancellation_stats
+from backends import backend_pool
+from generation import note_options
+from http_client import UpstreamError
+from kv_reuse import kv_contexts
+from metrics import PHASE_AGENT_GENERATION, timed_phase
+from scheduler import PRIORITY_INTERACTIVE, scheduler
+from tracing import generation_span, span
+from usage import GenerationUsage, usage_stats
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on agent generations running at once for a single request
+TEAM_MAX_PARALLEL_AGENTS = int(os.getenv("TEAM_MAX_PARALLEL_AGENTS", "3"))
+TEAM_MODEL = os.getenv("TEAM_MODEL", "llama3.1:8b")
+# Model overrides per team or agent: "Research=qwen2.5:14b,Research/Data Analyst=llama3.1:8b"
+TEAM_MODEL_OVERRIDES = os.getenv("TEAM_MODEL_OVERRIDES", "")
+
+
+def parse_model_overrides(spec: str) -> Dict[str, str]:
+    """Parse "team=model,team/agent=model" into a lookup table"""
+    overrides: Dict[str, str] = {}
+    for item in spec.split(","):
+        target, _, model = item.strip().partition("=")
+        if target and model:
+            overrides[target.strip()] = model.strip()
+    return overrides
+
+
+_overrides = parse_model_overrides(TEAM_MODEL_OVERRIDES)
+
+
+def team_model(team_id: str, team_config: Dict) -> str:
+    """Model for the team's merge call; the default for its agents"""
+    return _overrides.get(team_id) or team_config.get("model") or TEAM_MODEL
+
+
+def agent_model(team_id: str, team_config: Dict, agent: Dict) -> str:
+    return _overrides.get(f"{team_id}/{agent['name']}") or agent.get("model") or team_model(team_id, team_config)
+
+
+@dataclass
+class AgentResult:
+    """Output and timing of a single agent contribution"""
+    name: str
+    role: str
+    content: str
+    latency_ms: float
+    status: str = "ok"
+    queue_ms: float = 0.0
+    usage: GenerationUsage = field(default_factory=GenerationUsage)
+
+    def summary(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data.pop("content")
+        data["latency_ms"] = round(self.latency_ms, 1)
+        data["queue_ms"] = round(self.queue_ms, 1)
+        data["usage"] = self.usage.summary()
+        return data
+
+
+@dataclass
+class TeamRunResult:
+    """Final aggregated answer plus the per-agent contributions behind it"""
+    content: str
+    agents: List[AgentResult]
+    latency_ms: float = 0.0
+    ok: bool = True
+    cache_status: str = "miss"
+    # Usage of the aggregation call; agent usage is kept on each AgentResult
+    usage: GenerationUsage = field(default_factory=GenerationUsage)
+    # Usage of writing the research sub-queries
+    research_usage: GenerationUsage = field(default_factory=GenerationUsage)
+    # How the conversation history was fitted into the context budget
+    context: Optional[Dict[str, Any]] = None
+
+    def agent_summaries(self) -> List[Dict[str, Any]]:
+        return [agent.summary() for agent in self.agents]
+
+    def total_usage(self) -> GenerationUsage:
+        """Tokens and model time across the research, every agent call and the aggregation"""
+        total = self.usage + self.research_usage
+        for agent in self.agents:
+            total = total + agent.usage
+        return total
+
+
+@dataclass(frozen=True)
+class TeamPrompts:
+    """Static parts of a team's prompts, rendered once when the team is loaded"""
+    # Agent name -> everything in its prompt before the conversation
+    agents: Dict[str, str]
+    # The lead's merge prompt before the contributions
+    aggregation: str
+
+
+def compile_prompts(team_config: Dict, team_instructions: str) -> TeamPrompts:
+    return TeamPrompts(
+        {agent["name"]: agent_prompt_prefix(team_config, agent, team_instructions) for agent in team_config["agents"]},
+        aggregation_prompt_prefix(team_config, team_instructions)
+    )
+
+
+def agent_prompt_prefix(team_config: Dict, agent: Dict, team_instructions: str) -> str:
+    return f"""You are {agent['name']}, a {agent['role']} on the {team_config['name']}.
+
+Your goal: {agent['goal']}
+Your background: {agent['backstory']}
+
+TEAM WORKFLOW INSTRUCTIONS:
+{team_instructions}
+
+Other specialists on your team are working on the same question in parallel, and a team lead will merge everyone's notes into the final answer. Contribute only what your role is best placed to add. Be concise and concrete; do not write an introduction or a closing summary."""
+
+
+def build_agent_prompt(prefix: str, agent: Dict, conversation_context: str, current_query: str,
+                       search_results: Optional[str] = None) -> str:
+    """Prompt for one team member working on its own slice of the question"""
+    prompt = f"""{prefix}
+
+Conversation history:
+{conversation_context}
+
+Current question: {current_query}"""
+
+    return prompt + research_section(agent, search_results)
+
+
+def research_section(agent: Dict, search_results: Optional[str]) -> str:
+    if search_results is None or "internet_search" not in agent.get("tools", []):
+        return ""
+    return f"\n\nAvailable research data:\n{search_results}\n\nUse this research to inform your contribution."
+
+
+def build_agent_continuation(agent: Dict, new_turns: List[Turn], current_query: str,
+                             search_results: Optional[str] = None) -> str:
+    """Prompt that resumes an agent from the KV context of its previous contribution"""
+    prompt = f"""The conversation has continued since your last contribution:
+{render_turns(new_turns)}
+Current question: {current_query}
+
+As before, contribute only what your role as {agent['role']} is best placed to add. Be concise and concrete."""
+
+    return prompt + research_section(agent, search_results)
+
+
+def format_contributions(agent_results: List[AgentResult]) -> str:
+    return "\n\n".join(
+        f"### {result.name} ({result.role})\n{result.content}"
+        for result in agent_results
+        if result.status == "ok"
+    ) or "No team member contributions are available; answer from your own expertise."
+
+
+def aggregation_prompt_prefix(team_config: Dict, team_instructions: str) -> str:
+    lead = team_config["agents"][0]
+    return f"""You are {lead['name']}, a {lead['role']} leading the {team_config['name']}.
+
+TEAM WORKFLOW INSTRUCTIONS:
+{team_instructions}
+
+Your team members have each worked on the current question. Merge their contributions into one comprehensive response that represents the collective expertise of the entire team following your team's specific workflow. Resolve disagreements explicitly and do not repeat the same point twice."""
+
+
+AGGREGATION_FORMAT = """IMPORTANT: Structure your response with your reasoning process wrapped in <thinking> tags, followed by your final answer:
+
+<thinking>
+[Your analysis process here - follow your team's workflow instructions, weigh the team members' contributions, evaluate options, research findings if applicable]
+</thinking>
+
+[Your final comprehensive response here]
+
+Please provide a detailed, professional response to the current question, taking into account the conversation history. Show your reasoning process in the thinking section, then provide a clear final answer following your team's specific workflow approach."""
+
+
+def build_aggregation_prompt(prefix: str, conversation_context: str, current_query: str,
+                             agent_results: List[AgentResult]) -> str:
+    """Prompt for the final call that merges all agent contributions"""
+    return f"""{prefix}
+
+Team member contributions:
+{format_contributions(agent_results)}
+
+Conversation history:
+{conversation_context}
+
+Current question: {current_query}
+
+{AGGREGATION_FORMAT}"""
+
+
+def build_aggregation_continuation(new_turns: List[Turn], current_query: str,
+                                   agent_results: List[AgentResult]) -> str:
+    """Prompt that resumes the lead from the KV context of its previous answer"""
+    return f"""{render_turns(new_turns)}
+Your team members have each worked on the current question. Merge their contributions into one response following your team's workflow, as before.
+
+Team member contributions:
+{format_contributions(agent_results)}
+
+Current question: {current_query}
+
+Structure your response as before: your reasoning wrapped in <thinking> tags, followed by your final answer."""
+
+
+async def run_agent(team_id: str, team_config: Dict, agent: Dict, prompts: TeamPrompts,
+                    conversation_context: str, current_query: str,
+                    search_results: Optional[str], semaphore: asyncio.Semaphore,
+                    priority: int = PRIORITY_INTERACTIVE,
+                    history: Optional[ConversationHistory] = None,
+                    options: Optional[Dict[str, Any]] = None) -> AgentResult:
+    """Run one agent's generation, never raising so siblings are unaffected"""
+    async with semaphore:
+        with span(f"agent:{agent['name']}", agent=agent["name"], role=agent["role"]) as agent_span:
+            result = await _run_agent(team_id, team_config, agent, prompts, conversation_context,
+                                      current_query, search_results, priority, history, options)
+            agent_span.set(status=result.status)
+
+    logger.info(f"Agent {agent['name']} finished with status {result.status} in {result.latency_ms:.0f} ms")
+    return result
+
+
+async def _run_agent(team_id: str, team_config: Dict, agent: Dict, prompts: TeamPrompts,
+                     conversation_context: str, current_query: str, search_results: Optional[str],
+                     priority: int, history: Optional[ConversationHistory],
+                     options: Optional[Dict[str, Any]]) -> AgentResult:
+    """Prompt and generation of one agent, timed under its span by run_agent"""
+    started = time.perf_counter()
+    model = agent_model(team_id, team_config, agent)
+    # Notes only feed the aggregation, so the caller's stop sequences do not apply
+    payload = {"model": model, "options": note_options(options)}
+    # Continue from this agent's previous turn in the conversation when Ollama still has it
+    resumption = kv_contexts.find(team_id, f"agent:{agent['name']}", model, history)
+    if resumption is not None:
+        prompt = build_agent_continuation(agent, resumption.new_turns, current_query, search_results)
+        if kv_contexts.fits(resumption, prompt, payload["options"].get("num_ctx")):
+            payload["context"] = resumption.context
+    if "context" not in payload:
+        prompt = build_agent_prompt(prompts.agents[agent["name"]], agent, conversation_context,
+                                    current_query, search_results)
+    payload["prompt"] = prompt
+    queue_ms = 0.0
+    usage = GenerationUsage()
+    try:
+        async with scheduler.slot(team_id, priority) as waited:
+            queue_ms = waited * 1000
+            with timed_phase(team_id, PHASE_AGENT_GENERATION), \
+                    generation_span(model, resumed="context" in payload) as generation:
+                response = await backend_pool.generate(payload)
+                usage = GenerationUsage.from_ollama(response)
+                generation.set(**usage.span_attributes())
+        content = response.get("response", "").strip()
+        status = "ok" if content else "empty"
+        kv_contexts.remember(team_id, f"agent:{agent['name']}", model, history, response.get("context"))
+        usage_stats.record(team_id, "agent", usage)
+        cancellation_stats.record_completed("agent", usage.completion_tokens)
+    except asyncio.CancelledError:
+        # The caller went away; the aborted request stops Ollama generating
+        cancellation_stats.record_cancelled("agent")
+        raise
+    except UpstreamError as e:
+        logger.error(f"Agent {agent['name']} failed: {e}")
+        content, status = "", "unavailable"
+    except Exception as e:
+        logger.error(f"Agent {agent['name']} failed: {e}")
+        content, status = "", "error"
+    latency_ms = (time.perf_counter() - started) * 1000
+    return AgentResult(agent["name"], agent["role"], content, latency_ms, status, queue_ms, usage)
+
+
+async def run_agents(team_id: str, team_config: Dict, prompts: TeamPrompts, conversation_context: str,
+                     current_query: str, search_results: Optional[str] = None,
+                     priority: int = PRIORITY_INTERACTIVE,
+                     history: Optional[ConversationHistory] = None,
+                     options: Optional[Dict[str, Any]] = None) -> List[AgentResult]:
+    """Run every agent in the team concurrently with bounded fan-out"""
+    semaphore = asyncio.Semaphore(max(1, TEAM_MAX_PARALLEL_AGENTS))
+    return await asyncio.gather(*[
+        run_agent(team_id, team_config, agent, prompts, conversation_context,
+                  current_query, search_results, semaphore, priority, history, options)
+        for agent in team_config["agents"]
+    ])
@@ -0,0 +1,232 @@
+# Agent teams declared in agents.yaml, validated and compiled once per change of the file
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import yaml
+
+from context_builder import estimate_tokens
+from generation import GenerationOptionsError, team_options
+from pipeline import PipelineError, compile_pipeline
+from team_engine import agent_model, compile_prompts, team_model
+
+logger = logging.getLogger(__name__)
+
+# Team definitions; edits are picked up by a running worker
+TEAMS_FILE = os.getenv("TEAMS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "agents.yaml"))
+# Seconds between checks of the file for changes; 0 reads it only at startup
+TEAMS_RELOAD_INTERVAL = float(os.getenv("TEAMS_RELOAD_INTERVAL", "2"))
+
+# Tools the server can give an agent
+TOOLS = ("internet_search",)
+DEFAULT_INSTRUCTIONS = "Follow standard workflow procedures for your team."
+
+_TEAM_FIELDS = {"name": str, "description": str, "framework": str, "instructions": str, "model": str,
+                "agents": list, "pipeline": list, "options": dict, "max_output_tokens": int}
+_AGENT_FIELDS = {"name": str, "role": str, "goal": str, "backstory": str, "tools": list, "model": str}
+_REQUIRED_TEAM = ("name", "description", "agents")
+_REQUIRED_AGENT = ("name", "role", "goal", "backstory")
+
+
+class TeamConfigError(ValueError):
+    """Raised when the team definitions file does not describe valid teams"""
+
+
+def _check_fields(where: str, data: Any, fields: Dict[str, type], required: Tuple[str, ...]) -> None:
+    if not isinstance(data, dict):
+        raise TeamConfigError(f"{where}: must be a mapping")
+    for key, value in data.items():
+        if key not in fields:
+            raise TeamConfigError(f"{where}: unknown field {key!r}")
+        if not isinstance(value, fields[key]):
+            raise TeamConfigError(f"{where}.{key}: must be a {fields[key].__name__}")
+    for key in required:
+        if not data.get(key):
+            raise TeamConfigError(f"{where}: {key!r} is required")
+
+
+def validate_team(team_id: str, data: Any) -> Dict[str, Any]:
+    """The team definition with defaults filled in; raises TeamConfigError naming the bad field"""
+    where = f"teams.{team_id}"
+    _check_fields(where, data, _TEAM_FIELDS, _REQUIRED_TEAM)
+    agents = []
+    names = set()
+    for index, agent in enumerate(data["agents"]):
+        agent_where = f"{where}.agents[{index}]"
+        _check_fields(agent_where, agent, _AGENT_FIELDS, _REQUIRED_AGENT)
+        if agent["name"] in names:
+            raise TeamConfigError(f"{agent_where}: duplicate agent name {agent['name']!r}")
+        names.add(agent["name"])
+        for tool in agent.get("tools", []):
+            if tool not in TOOLS:
+                raise TeamConfigError(f"{agent_where}.tools: unknown tool {tool!r} (available: {', '.join(TOOLS)})")
+        agents.append({**agent, "tools": list(agent.get("tools", []))})
+    try:
+        options = team_options(data.get("options", {}))
+    except GenerationOptionsError as e:
+        raise TeamConfigError(f"{where}.options: {e}")
+    if data.get("max_output_tokens", 1) <= 0:
+        raise TeamConfigError(f"{where}.max_output_tokens: must be positive")
+    return {
+        **data,
+        "options": options,
+        "framework": data.get("framework", "praisonai"),
+        "instructions": data.get("instructions", DEFAULT_INSTRUCTIONS).strip(),
+        "agents": agents,
+    }
+
+
+class TeamConfig(dict):
+    """A validated team definition plus everything derived from it that requests would otherwise recompute
+
+    It is still the plain dict that endpoints list and hash; the compiled
+    parts are attributes so they stay out of both.
+    """
+
+    def __init__(self, team_id: str, definition: Dict[str, Any]):
+        super().__init__(definition)
+        self.id = team_id
+        self.instructions: str = definition["instructions"]
+        self.instruction_tokens = estimate_tokens(self.instructions)
+        self.prompts = compile_prompts(self, self.instructions)
+        self.needs_search = any("internet_search" in agent["tools"] for agent in self["agents"])
+        self.model = team_model(team_id, self)
+        self.agent_models = [agent_model(team_id, self, agent) for agent in self["agents"]]
+        # Staged teams run their pipeline instead of parallel agents and a merge
+        self.pipeline = compile_pipeline(team_id, self, self.instructions) if "pipeline" in self else None
+        self.stage_models = sorted({stage.model for stage in self.pipeline or ()})
+        self.uses_small_model = any(stage.small for stage in self.pipeline or ())
+        # Generations one run makes at most: every stage, or every agent plus the merge
+        self.generations = len(self.pipeline) if self.pipeline else len(self["agents"]) + 1
+        # Changes whenever anything that shapes the team's prompts or models changes
+        self.digest = hashlib.sha256(json.dumps({
+            "team": team_id,
+            "definition": definition,
+            "model": self.model,
+            "agent_models": self.agent_models,
+            "stage_models": self.stage_models,
+        }, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+def parse_teams(text: str) -> Dict[str, TeamConfig]:
+    document = yaml.safe_load(text) or {}
+    if not isinstance(document, dict) or not isinstance(document.get("teams"), dict) or not document["teams"]:
+        raise TeamConfigError("teams: a non-empty mapping of team id to team is required")
+    try:
+        return {str(team_id): TeamConfig(str(team_id), validate_team(str(team_id), data))
+                for team_id, data in document["teams"].items()}
+    except PipelineError as e:
+        raise TeamConfigError(str(e))
+
+
+class TeamRegistry(Mapping):
+    """Read-only mapping of team id to TeamConfig, reloaded when the file changes
+
+    A reload swaps the whole mapping at once; requests already running keep
+    the TeamConfig they started with. A file that fails validation is logged
+    and the previous teams stay in service.
+    """
+
+    def __init__(self, path: str = TEAMS_FILE, reload_interval: float = TEAMS_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._teams: Dict[str, TeamConfig] = {}
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._listeners: List[Callable[[Set[str]], None]] = []
+        self._task: Optional[asyncio.Task] = None
+        self.loads = 0
+        self.failures = 0
+        self.loaded_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def __getitem__(self, team_id: str) -> TeamConfig:
+        return self._teams[team_id]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._teams)
+
+    def __len__(self) -> int:
+        return len(self._teams)
+
+    def subscribe(self, listener: Callable[[Set[str]], None]) -> None:
+        """Call ``listener`` with the ids of added, changed and removed teams after each reload"""
+        self._listeners.append(listener)
+
+    def _file_stamp(self) -> Tuple[int, int]:
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self) -> Set[str]:
+        """Read and swap in the teams; raises TeamConfigError or OSError and keeps the old teams on failure"""
+        stamp = self._file_stamp()
+        with open(self.path, encoding="utf-8") as f:
+            teams = parse_teams(f.read())
+        changed = {team_id for team_id in set(teams) | set(self._teams)
+                   if team_id not in teams or team_id not in self._teams
+                   or teams[team_id].digest != self._teams[team_id].digest}
+        self._teams = teams
+        self._stamp = stamp
+        self.loads += 1
+        self.loaded_at = time.time()
+        self.last_error = None
+        return changed
+
+    def reload(self) -> Set[str]:
+        """Load the file if it changed since the last load; returns the changed team ids"""
+        stamp = None
+        try:
+            stamp = self._file_stamp()
+            if stamp == self._stamp:
+                return set()
+            changed = self.load()
+        except (OSError, TeamConfigError, yaml.YAMLError) as e:
+            if self.last_error != str(e):
+                logger.error(f"Keeping the current teams, {self.path} is invalid: {e}")
+                self.failures += 1
+            self.last_error = str(e)
+            # The broken file is not read again until it changes
+            self._stamp = stamp
+            return set()
+        if changed:
+            logger.info(f"Reloaded teams from {self.path}; changed: {', '.join(sorted(changed))}")
+            for listener in self._listeners:
+                listener(changed)
+        return changed
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            self.reload()
+
+    def start(self) -> None:
+        if self.reload_interval > 0 and self._task is None:
+            self._task = asyncio.ensure_future(self._watch())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "teams": len(self._teams),
+            "reload_interval": self.reload_interval,
+            "loaded_at": self.loaded_at,
+            "loads": self.loads,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+team_registry = TeamRegistry()
+team_registry.load()
@@ -0,0 +1,111 @@
+# Backend pool routing against fake backends: selection, retries, ejection and circuits
+import asyncio
+import time
+
+import pytest
+
+import backends
+from backends import Backend, BackendPool
+from circuit import OPEN, CircuitBreaker, CircuitOpenError
+from http_client import UpstreamError
+
+MODEL = "llama3.1:8b"
+
+
+class FakeBackend(Backend):
+    """Answers after ``delay`` seconds, or fails with ``error`` when one is set"""
+    kind = "fake"
+
+    def __init__(self, name: str, delay: float = 0.0, error: Exception = None):
+        super().__init__(name, f"http://{name}")
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    async def probe(self, timeout: float):
+        return [MODEL]
+
+    async def generate(self, payload):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return {"model": payload["model"], "response": self.name, "done": True, "eval_count": 10}
+
+    async def generate_stream(self, payload):
+        yield await self.generate(payload)
+
+
+def generate(pool: BackendPool, count: int = 1):
+    """Run ``count`` generations at once; returns the names of the backends that answered"""
+    async def run():
+        responses = await asyncio.gather(*(pool.generate({"model": MODEL, "prompt": "hi"}) for _ in range(count)))
+        return [response["response"] for response in responses]
+    return asyncio.run(run())
+
+
+def test_least_outstanding_backend_is_picked():
+    a, b, c = FakeBackend("a"), FakeBackend("b"), FakeBackend("c")
+    pool = BackendPool([a, b, c])
+    a.outstanding, b.outstanding = 2, 1
+    assert pool.pick(MODEL) is c
+    c.outstanding = 3
+    assert pool.pick(MODEL) is b
+
+
+def test_concurrent_requests_spread_over_backends():
+    pool = BackendPool([FakeBackend("a", 0.01), FakeBackend("b", 0.01), FakeBackend("c", 0.01)])
+    assert sorted(generate(pool, 3)) == ["a", "b", "c"]
+    assert all(backend.outstanding == 0 for backend in pool.backends)
+
+
+def test_upstream_error_is_retried_on_another_backend():
+    broken = FakeBackend("broken", error=UpstreamError("Ollama", 500))
+    working = FakeBackend("working", delay=0.01)
+    pool = BackendPool([broken, working])
+    # Ties go to the first backend, so the broken one is tried first
+    assert generate(pool) == ["working"]
+    assert broken.calls == 1 and broken.failures == 1 and pool.retries == 1
+
+
+def test_request_error_is_not_retried():
+    bad_request = FakeBackend("a", error=UpstreamError("Ollama", 400))
+    pool = BackendPool([bad_request, FakeBackend("b", delay=0.01)])
+    with pytest.raises(UpstreamError):
+        generate(pool)
+    assert pool.retries == 0
+
+
+def test_slow_backend_is_ejected_and_readmitted(monkeypatch):
+    monkeypatch.setattr(backends, "BACKEND_EJECT_SECONDS", 0.2)
+    fast, slow = FakeBackend("fast"), FakeBackend("slow", delay=0.05)
+    pool = BackendPool([fast, slow])
+    for _ in range(backends.BACKEND_MIN_SAMPLES):
+        generate(pool, 2)
+    assert slow.ejected and not fast.ejected
+    assert slow.ejections == 1
+    assert generate(pool, 2) == ["fast", "fast"]
+
+    time.sleep(0.25)
+    assert slow.available and slow.latency == {}
+    fast.outstanding = 1
+    assert pool.pick(MODEL) is slow
+
+
+def test_failing_backend_circuit_opens():
+    broken = FakeBackend("broken", error=UpstreamError("Ollama", 503))
+    broken.breaker = CircuitBreaker("fake backend broken", window=4, min_calls=2, open_seconds=60)
+    working = FakeBackend("working", delay=0.01)
+    pool = BackendPool([broken, working])
+    # With no latency recorded the broken backend keeps winning ties until its circuit opens
+    assert generate(pool) == ["working"]
+    assert generate(pool) == ["working"]
+    assert broken.breaker.state == OPEN
+    assert generate(pool) == ["working"]
+    assert broken.calls == 2
+    assert pool.candidates(MODEL) == [working]
+
+    alone = BackendPool([broken])
+    with pytest.raises(CircuitOpenError):
+        generate(alone)
+    assert broken.calls == 2 and alone.fast_failed == 1
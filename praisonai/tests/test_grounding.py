@@ -0,0 +1,142 @@
+# Grounding against a local HTTP server: fetches, revalidation, redirects, limits and cache failures
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+import grounding
+from grounding import Grounder, PageCache
+
+ARTICLE = "<html><body><nav>Home About</nav><article><p>" + "Grounded page text about the topic. " * 20 + "</p></article></body></html>"
+LAST_MODIFIED = "Wed, 01 Oct 2025 00:00:00 GMT"
+
+
+class Handler(BaseHTTPRequestHandler):
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", **headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name.replace("_", "-"), value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        Handler.requests.append((self.path, dict(self.headers)))
+        if self.path == "/etag":
+            if self.headers.get("If-None-Match") == '"v1"':
+                return self._send(304)
+            return self._send(200, ARTICLE.encode(), Content_Type="text/html; charset=utf-8", ETag='"v1"')
+        if self.path == "/modified":
+            if self.headers.get("If-Modified-Since") == LAST_MODIFIED:
+                return self._send(304)
+            return self._send(200, ARTICLE.encode(), Content_Type="text/html", Last_Modified=LAST_MODIFIED)
+        if self.path == "/moved":
+            return self._send(302, Location="/etag")
+        if self.path == "/loop":
+            return self._send(302, Location="/loop")
+        if self.path == "/big":
+            return self._send(200, ("word " * 100_000).encode(), Content_Type="text/plain")
+        if self.path == "/bogus-charset":
+            return self._send(200, "Café menus with several long sentences".encode(),
+                              Content_Type="text/plain; charset=x-bogus")
+        if self.path == "/image":
+            return self._send(200, b"\x89PNG", Content_Type="image/png")
+        self._send(404)
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def local(monkeypatch):
+    monkeypatch.setattr(grounding, "GROUNDING_ALLOW_PRIVATE", True)
+    Handler.requests.clear()
+
+
+def run(cache_dir, *urls):
+    """Fetch ``urls`` in turn with one grounder; returns the grounder and the texts"""
+    async def fetch():
+        async with httpx.AsyncClient() as client:
+            grounder = Grounder(PageCache(str(cache_dir)), client=lambda: client)
+            return grounder, [await grounder.page_text(url) for url in urls]
+    return asyncio.run(fetch())
+
+
+def test_fetch_extracts_article_and_caches(server, tmp_path):
+    grounder, (first, second) = run(tmp_path, f"{server}/etag", f"{server}/etag")
+    assert first == second
+    assert first.startswith("Grounded page text") and "Home About" not in first
+    assert (grounder.misses, grounder.hits) == (1, 1)
+    assert len(Handler.requests) == 1
+
+
+@pytest.mark.parametrize("path, validator", [("/etag", "If-None-Match"), ("/modified", "If-Modified-Since")])
+def test_stale_page_is_revalidated(server, tmp_path, monkeypatch, path, validator):
+    monkeypatch.setattr(grounding, "GROUNDING_FRESH_SECONDS", 0)
+    grounder, (first, second) = run(tmp_path, server + path, server + path)
+    assert first == second
+    assert (grounder.misses, grounder.revalidations) == (1, 1)
+    assert validator in Handler.requests[1][1]
+
+
+def test_redirects_are_followed_and_bounded(server, tmp_path):
+    grounder, (moved, looping) = run(tmp_path, f"{server}/moved", f"{server}/loop")
+    assert moved.startswith("Grounded page text")
+    assert looping is None and grounder.failures == 1
+
+
+def test_body_is_capped(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(grounding, "GROUNDING_MAX_BYTES", 1000)
+    grounder, (text,) = run(tmp_path, f"{server}/big")
+    assert grounder.truncated == 1
+    assert len(text) <= 1000
+
+
+def test_unknown_charset_falls_back_to_utf8(server, tmp_path):
+    grounder, (text,) = run(tmp_path, f"{server}/bogus-charset")
+    assert text == "Café menus with several long sentences"
+    assert grounder.failures == 0
+
+
+def test_unsupported_content_type_is_left_out(server, tmp_path):
+    grounder, (text,) = run(tmp_path, f"{server}/image")
+    assert text is None and grounder.failures == 1
+
+
+def test_unwritable_cache_still_returns_text(server, tmp_path):
+    blocker = tmp_path / "file"
+    blocker.write_text("not a directory")
+    grounder, (first, second) = run(blocker / "pages", f"{server}/etag", f"{server}/etag")
+    assert first is not None and first == second
+    assert grounder.failures == 0 and grounder.cache_errors >= 1
+    assert grounder.stats()["cache"]["entries"] == 0
+
+
+def test_private_addresses_are_refused(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(grounding, "GROUNDING_ALLOW_PRIVATE", False)
+    grounder, (text,) = run(tmp_path, f"{server}/etag")
+    assert text is None and grounder.failures == 1
+    assert Handler.requests == []
+
+
+def test_connection_is_pinned_to_the_checked_address(server, tmp_path, monkeypatch):
+    async def resolve(url):
+        return "127.0.0.1"
+    monkeypatch.setattr(grounding, "resolve_public", resolve)
+    port = server.rsplit(":", 1)[1]
+    grounder, (text,) = run(tmp_path, f"http://rebinding.invalid:{port}/etag")
+    assert text.startswith("Grounded page text")
+    assert Handler.requests[0][1]["Host"] == f"rebinding.invalid:{port}"
@@ -0,0 +1,67 @@
+# Admission control: queue capacity is reserved per request for the generations it fans out into
+import asyncio
+
+import pytest
+
+from scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, GenerationScheduler, QueueFullError
+
+
+def test_request_reserves_its_generations():
+    scheduler = GenerationScheduler(max_concurrency=1, max_queue=4)
+
+    async def run():
+        # Nothing is ahead, so even a request larger than the queue is admitted
+        scheduler.admit(PRIORITY_BATCH, 6)
+        assert scheduler.backlog_ahead(PRIORITY_BATCH) == 6
+        with pytest.raises(QueueFullError) as rejected:
+            scheduler.admit(PRIORITY_BATCH, 1)
+        assert rejected.value.retry_after >= 1
+        assert (scheduler.admitted, scheduler.rejected) == (1, 1)
+
+    asyncio.run(run())
+
+
+def test_generations_move_from_reserved_to_waiting_and_leftovers_are_released():
+    scheduler = GenerationScheduler(max_concurrency=1, max_queue=2)
+
+    async def request(generations, started, done):
+        scheduler.admit(PRIORITY_BATCH, 3)
+
+        async def generate():
+            async with scheduler.slot("team", PRIORITY_BATCH):
+                started.set()
+                await done.wait()
+
+        # Only two of the three reserved generations are made, as after a cache hit
+        await asyncio.gather(*(generate() for _ in range(generations)))
+
+    async def run():
+        started, done = asyncio.Event(), asyncio.Event()
+        task = asyncio.ensure_future(request(2, started, done))
+        await started.wait()
+        # One generation runs, one waits, one is still reserved
+        assert (scheduler.running, scheduler.waiting) == (1, 1)
+        assert scheduler.stats()["reserved_by_priority"]["batch"] == 1
+        with pytest.raises(QueueFullError):
+            scheduler.admit(PRIORITY_BATCH, 2)
+        done.set()
+        await task
+        await asyncio.sleep(0)
+        assert scheduler.backlog_ahead(PRIORITY_BATCH) == 0
+        assert scheduler.stats()["reserved_by_priority"]["batch"] == 0
+
+    asyncio.run(run())
+
+
+def test_batch_backlog_does_not_shed_interactive_requests():
+    scheduler = GenerationScheduler(max_concurrency=1, max_queue=2)
+
+    async def run():
+        scheduler.admit(PRIORITY_BATCH, 10)
+        scheduler.admit(PRIORITY_INTERACTIVE, 2)
+        with pytest.raises(QueueFullError):
+            scheduler.admit(PRIORITY_INTERACTIVE, 2)
+        assert scheduler.backlog_ahead(PRIORITY_INTERACTIVE) == 2
+        assert scheduler.backlog_ahead(PRIORITY_BATCH) == 12
+
+    asyncio.run(run())
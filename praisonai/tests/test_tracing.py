@@ -0,0 +1,176 @@
+# Tracing middleware with the file exporter: span trees, Server-Timing and a queue that never blocks
+import asyncio
+import json
+import os
+import time
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from scheduler import GenerationScheduler
+from tracing import FileExporter, Tracer, TracingMiddleware, generation_span, span
+
+
+def read_spans(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def traced_app(tracer: Tracer) -> FastAPI:
+    """An endpoint timed like a team run: prompt assembly, then a queued generation"""
+    scheduler = GenerationScheduler(max_concurrency=1, max_queue=8)
+    app = FastAPI()
+
+    @app.get("/run")
+    async def run():
+        with span("prompt_assembly"):
+            pass
+        async with scheduler.slot("team"):
+            with generation_span("llama3.1:8b") as generation:
+                await asyncio.sleep(0.01)
+                generation.set(**{"gen_ai.usage.output_tokens": 3})
+        return {"ok": True}
+
+    @app.get("/health")
+    async def health():
+        return {"ok": True}
+
+    app.add_middleware(TracingMiddleware, tracer=tracer)
+    return app
+
+
+async def call(app, *paths, headers=None):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        return [await client.get(path, headers=headers) for path in paths]
+
+
+def test_spans_are_exported_as_one_tree(tmp_path):
+    tracer = Tracer(FileExporter(str(tmp_path / "traces.jsonl")), enabled=True)
+
+    async def run():
+        responses = await call(traced_app(tracer), "/run", "/health")
+        await tracer.flush()
+        return responses
+
+    response, health = asyncio.run(run())
+    spans = {s["name"]: s for s in read_spans(tmp_path / "traces.jsonl")}
+    assert set(spans) == {"GET run", "prompt_assembly", "queue_wait", "generation"}
+    root = spans["GET run"]
+    assert root["parent_id"] is None and root["attributes"]["http.status_code"] == 200
+    assert all(s["parent_id"] == root["span_id"] for name, s in spans.items() if name != "GET run")
+    assert len({s["trace_id"] for s in spans.values()}) == 1
+    assert spans["generation"]["attributes"] == {"gen_ai.request.model": "llama3.1:8b", "gen_ai.usage.output_tokens": 3}
+    assert spans["generation"]["duration_ms"] >= 10
+    # Excluded paths are neither traced nor timed
+    assert "server-timing" not in health.headers
+
+
+def test_server_timing_header(tmp_path):
+    tracer = Tracer(FileExporter(str(tmp_path / "traces.jsonl")), enabled=True)
+    trace_id = "0af7651916cd43dd8448eb211c80319c"
+    (response,) = asyncio.run(call(traced_app(tracer), "/run",
+                                   headers={"traceparent": f"00-{trace_id}-b7ad6b7169203331-01"}))
+    entries = [entry.strip() for entry in response.headers["server-timing"].split(",")]
+    names = [entry.split(";")[0] for entry in entries]
+    assert names == ["prompt_assembly", "queue_wait", "generation", "total", "traceparent"]
+    assert all(";dur=" in entry for entry in entries[:-1])
+    # The caller's trace is continued
+    assert f"00-{trace_id}-" in entries[-1]
+    assert response.headers["timing-allow-origin"] == "*"
+
+
+class StuckExporter:
+    """An exporter whose collector never answers"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def export(self, spans):
+        self.calls += 1
+        await asyncio.Event().wait()
+
+    async def close(self):
+        pass
+
+
+def test_full_or_slow_exporter_never_blocks_requests():
+    exporter = StuckExporter()
+    tracer = Tracer(exporter, enabled=True, batch_size=1, interval=60, max_queue=2)
+
+    async def run():
+        tracer.start()
+        app = traced_app(tracer)
+        started = time.perf_counter()
+        responses = await call(app, *["/run"] * 20)
+        elapsed = time.perf_counter() - started
+        return responses, elapsed
+
+    responses, elapsed = asyncio.run(run())
+    assert all(response.status_code == 200 for response in responses)
+    # 20 requests of about 10 ms each; a blocked exporter would hang them instead
+    assert elapsed < 5
+    assert exporter.calls == 1
+    assert tracer.dropped > 0
+    assert tracer.traces == 20
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    """The API app with a fake model backend, a fake SearxNG and the file exporter"""
+    praisonai = pytest.importorskip("praisonai", reason="server.py needs the praisonai package")
+    if not hasattr(praisonai, "PraisonAI"):
+        pytest.skip("server.py needs the praisonai package")
+    monkeypatch.setenv("JOB_BACKEND", "memory")
+    import server
+    from backends import Backend
+
+    class FakeBackend(Backend):
+        kind = "fake"
+
+        async def probe(self, timeout):
+            return []
+
+        async def generate(self, payload):
+            text = "1. market size\n2. competitors" if "search queries" in payload.get("prompt", "") else "An answer."
+            return {"model": payload["model"], "response": text, "done": True, "eval_count": 5, "prompt_eval_count": 7}
+
+        async def generate_stream(self, payload):
+            yield {"model": payload["model"], "response": "An answer.", "done": False}
+            yield {"model": payload["model"], "response": "", "done": True, "eval_count": 3}
+
+    async def searxng_search(query):
+        return {"results": [{"title": query, "url": f"https://example.com/{query.replace(' ', '-')}",
+                             "content": f"A snippet about {query}"}]}
+
+    monkeypatch.setattr(server.backend_pool, "backends", [FakeBackend("fake", "http://fake")])
+    monkeypatch.setattr(server, "searxng_search", searxng_search)
+    monkeypatch.setattr(server.tracer, "exporter", FileExporter(str(tmp_path / "traces.jsonl")))
+    return server
+
+
+def test_team_run_spans(server, tmp_path):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as client:
+            response = await client.post("/teams/Research/execute", headers={"Cache-Control": "no-cache"},
+                                         json={"query": f"EV charging market {os.getpid()}"})
+        await server.tracer.flush()
+        return response
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    spans = read_spans(tmp_path / "traces.jsonl")
+    names = [s["name"] for s in spans]
+    root = next(s for s in spans if s["parent_id"] is None)
+    assert root["name"] == "POST execute_team"
+    assert {"prompt_assembly", "research", "search", "queue_wait", "generation", "aggregation"} <= set(names)
+    assert {"agent:Researcher", "agent:Analyst", "agent:Writer"} <= set(names)
+    by_id = {s["span_id"]: s for s in spans}
+    # Every generation of an agent sits under that agent's span
+    for agent in (s for s in spans if s["name"].startswith("agent:")):
+        children = [s["name"] for s in spans if s["parent_id"] == agent["span_id"]]
+        assert children == ["queue_wait", "generation"]
+    assert all(by_id[s["parent_id"]]["name"] == "research" for s in spans if s["name"] == "search")
+    timing = response.headers["server-timing"]
+    for name in ("prompt_assembly", "search", "queue_wait", "generation", "agent-Researcher", "total"):
+        assert f"{name};dur=" in timing
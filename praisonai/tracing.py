@@ -0,0 +1,421 @@
+# Request-scoped tracing with Server-Timing headers and batched OTLP/Langfuse export
+import asyncio
+import base64
+import json
+import logging
+import os
+import re
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Set to false to skip creating spans and the Server-Timing header
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
+# Where finished spans go: none, otlp, langfuse or file
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+# OTLP/HTTP JSON traces endpoint and extra headers ("key=value,key2=value2")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_OTLP_HEADERS = os.getenv("TRACE_OTLP_HEADERS", "")
+# Langfuse project keys; its OTLP endpoint is derived from LANGFUSE_HOST
+LANGFUSE_HOST = os.getenv("LANGFUSE_HOST", "http://langfuse-web:3000")
+LANGFUSE_PUBLIC_KEY = os.getenv("LANGFUSE_PUBLIC_KEY", "")
+LANGFUSE_SECRET_KEY = os.getenv("LANGFUSE_SECRET_KEY", "")
+# JSON-lines file written by the file exporter, one span per line
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+# Spans sent per export call, seconds between exports, and spans held before new ones are dropped
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "256"))
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "5"))
+TRACE_MAX_QUEUE = int(os.getenv("TRACE_MAX_QUEUE", "4096"))
+TRACE_EXPORT_TIMEOUT = float(os.getenv("TRACE_EXPORT_TIMEOUT", "10"))
+# Paths that are not traced (probes and scrapes)
+TRACE_EXCLUDE_PATHS = os.getenv("TRACE_EXCLUDE_PATHS", "/health,/metrics")
+
+SERVICE_NAME = "keiken-teams-api"
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+# Characters not allowed in a Server-Timing metric name
+_NOT_TOKEN = re.compile(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]")
+
+
+class Span:
+    """One timed operation within a trace"""
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1_000_000
+
+    def end(self) -> None:
+        self.end_ns = time.time_ns()
+        self.trace.finished(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _NoSpan:
+    """Stands in for a span when nothing is being traced"""
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Trace:
+    """Spans of one request, with per-name totals for the Server-Timing header"""
+
+    def __init__(self, tracer: "Tracer", trace_id: Optional[str] = None):
+        self.tracer = tracer
+        self.trace_id = trace_id or os.urandom(16).hex()
+        # Span name -> (total ms, count), in order of first completion
+        self.timings: Dict[str, Tuple[float, int]] = {}
+
+    def finished(self, span: Span) -> None:
+        total, count = self.timings.get(span.name, (0.0, 0))
+        self.timings[span.name] = (total + span.duration_ms, count + 1)
+        self.tracer.export(span)
+
+    def server_timing(self, root: Span) -> str:
+        """Server-Timing value for the spans finished so far"""
+        entries = []
+        for name, (total, count) in self.timings.items():
+            entry = f"{_NOT_TOKEN.sub('-', name)};dur={total:.1f}"
+            if count > 1:
+                entry += f';desc="{count} spans"'
+            entries.append(entry)
+        entries.append(f"total;dur={root.duration_ms:.1f}")
+        entries.append(f'traceparent;desc="00-{self.trace_id}-{root.span_id}-01"')
+        return ", ".join(entries)
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Any]:
+    """Time the body as a child of the current span; a no-op outside a traced request"""
+    parent = _current_span.get()
+    if parent is None:
+        yield NO_SPAN
+        return
+    child = Span(parent.trace, name, parent.span_id, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except asyncio.CancelledError:
+        child.error = "cancelled"
+        raise
+    except GeneratorExit:
+        child.error = "closed"
+        raise
+    except Exception as e:
+        child.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # Finalized from another context, e.g. a stream closed by a different task
+            pass
+        child.end()
+
+
+def generation_span(model: str, **attributes: Any):
+    """Span for one model call, tagged so Langfuse shows it as a generation"""
+    return span("generation", **{"gen_ai.request.model": model}, **attributes)
+
+
+def _attribute_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans: List[Span]) -> Dict[str, Any]:
+    """OTLP/HTTP JSON body for a batch of spans"""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [{
+                    "traceId": s.trace.trace_id,
+                    "spanId": s.span_id,
+                    **({"parentSpanId": s.parent_id} if s.parent_id else {}),
+                    "name": s.name,
+                    # SERVER for the request span, INTERNAL for everything under it
+                    "kind": 2 if "http.method" in s.attributes else 1,
+                    "startTimeUnixNano": str(s.start_ns),
+                    "endTimeUnixNano": str(s.end_ns),
+                    "attributes": [
+                        {"key": key, "value": _attribute_value(value)}
+                        for key, value in s.attributes.items() if value is not None
+                    ],
+                    "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+                } for s in spans],
+            }],
+        }],
+    }
+
+
+class OTLPExporter:
+    """Posts span batches to an OTLP/HTTP collector as JSON"""
+
+    def __init__(self, endpoint: str, headers: Optional[Dict[str, str]] = None, timeout: float = TRACE_EXPORT_TIMEOUT):
+        self.endpoint = endpoint
+        self.headers = {"Content-Type": "application/json", **(headers or {})}
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def export(self, spans: List[Span]) -> None:
+        if self._client is None:
+            # Separate from the shared upstream pool so exports never compete with generations
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+        response = await self._client.post(self.endpoint, content=json.dumps(to_otlp(spans)), headers=self.headers)
+        response.raise_for_status()
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class FileExporter:
+    """Appends spans to a JSON-lines file, for tests and local inspection"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _write(self, lines: List[str]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+
+    async def export(self, spans: List[Span]) -> None:
+        lines = [json.dumps(s.to_dict(), default=str) + "\n" for s in spans]
+        await asyncio.to_thread(self._write, lines)
+
+    async def close(self) -> None:
+        pass
+
+
+def parse_headers(spec: str) -> Dict[str, str]:
+    headers: Dict[str, str] = {}
+    for item in spec.split(","):
+        key, _, value = item.partition("=")
+        if key.strip() and value.strip():
+            headers[key.strip()] = value.strip()
+    return headers
+
+
+def make_exporter(kind: str = TRACE_EXPORTER):
+    if kind == "otlp":
+        return OTLPExporter(TRACE_OTLP_ENDPOINT, parse_headers(TRACE_OTLP_HEADERS))
+    if kind == "langfuse":
+        credentials = base64.b64encode(f"{LANGFUSE_PUBLIC_KEY}:{LANGFUSE_SECRET_KEY}".encode()).decode()
+        return OTLPExporter(
+            LANGFUSE_HOST.rstrip("/") + "/api/public/otel/v1/traces",
+            {"Authorization": f"Basic {credentials}"}
+        )
+    if kind == "file":
+        return FileExporter(TRACE_FILE)
+    if kind not in ("", "none"):
+        logger.warning(f"Unknown TRACE_EXPORTER {kind!r}; spans are not exported")
+    return None
+
+
+class Tracer:
+    """Collects finished spans and exports them in batches from a background task
+
+    ``export`` only appends to a bounded queue, so the request path never waits
+    on the collector; when the queue is full new spans are dropped and
+    counted. The background task sends a batch every ``interval`` seconds or
+    as soon as ``batch_size`` spans are waiting.
+    """
+
+    def __init__(self, exporter=None, enabled: bool = TRACING_ENABLED, batch_size: int = TRACE_BATCH_SIZE,
+                 interval: float = TRACE_EXPORT_INTERVAL, max_queue: int = TRACE_MAX_QUEUE):
+        self.exporter = exporter
+        self.enabled = enabled
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.max_queue = max_queue
+        self._queue: Deque[Span] = deque()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.traces = 0
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_error: Optional[str] = None
+
+    def start_trace(self, name: str, traceparent: Optional[str] = None, **attributes: Any) -> Span:
+        """Root span of a new trace, continuing the caller's trace when it sent a traceparent"""
+        self.traces += 1
+        match = _TRACEPARENT.match(traceparent or "")
+        trace = Trace(self, match.group(1) if match else None)
+        return Span(trace, name, match.group(2) if match else None, attributes)
+
+    def export(self, span: Span) -> None:
+        if self.exporter is None:
+            return
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self._queue.append(span)
+        if len(self._queue) >= self.batch_size:
+            self._wake.set()
+
+    async def flush(self) -> None:
+        while self._queue:
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            try:
+                await self.exporter.export(batch)
+                self.exported += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                self.last_error = str(e) or type(e).__name__
+                logger.warning(f"Span export failed, {len(batch)} spans lost: {self.last_error}")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def start(self) -> None:
+        if self.enabled and self.exporter is not None and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.exporter is not None:
+            await self.flush()
+            await self.exporter.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "exporter": type(self.exporter).__name__ if self.exporter is not None else None,
+            "traces": self.traces,
+            "queued": len(self._queue),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "last_error": self.last_error,
+        }
+
+
+class TracingMiddleware:
+    """ASGI middleware opening a root span per request and adding the Server-Timing header
+
+    The header is written when the response starts, so for streamed
+    responses it covers the phases finished before the first byte.
+    """
+
+    def __init__(self, app, tracer: Tracer, exclude_paths: str = TRACE_EXCLUDE_PATHS):
+        self.app = app
+        self.tracer = tracer
+        self.exclude = {path.strip() for path in exclude_paths.split(",") if path.strip()}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.tracer.enabled or scope["path"] in self.exclude:
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for key, value in scope.get("headers", ()):
+            if key == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+        root = self.tracer.start_trace(
+            f"{scope['method']} {scope['path']}",
+            traceparent,
+            **{"http.method": scope["method"], "http.target": scope["path"]}
+        )
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                root.set(**{"http.status_code": message["status"]})
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", root.trace.server_timing(root).encode("latin-1")))
+                headers.append((b"timing-allow-origin", b"*"))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = _current_span.set(root)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            root.error = f"{type(e).__name__}: {e}" if isinstance(e, Exception) else "cancelled"
+            raise
+        finally:
+            _current_span.reset(token)
+            self._name(root, scope)
+            root.end()
+
+    @staticmethod
+    def _name(root: Span, scope) -> None:
+        # Name by endpoint rather than path so session ids do not split traces into one name each
+        endpoint = scope.get("endpoint")
+        if endpoint is not None:
+            root.name = f"{scope['method']} {getattr(endpoint, '__name__', root.name)}"
+        labels = scope.get("state", {}).get("metrics")
+        if labels is not None:
+            root.set(**{
+                "team": labels.team,
+                "endpoint": labels.endpoint,
+                "stream": labels.stream,
+                "langfuse.trace.name": f"{labels.team} {labels.endpoint}",
+            })
+
+
+tracer = Tracer(make_exporter())
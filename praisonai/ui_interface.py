@@ -292,7 +292,8 @@ async def call_keiken_backend(team_name: str, user_message: str) -> str:
         payload = {
             "messages": [
                 {"role": "user", "content": user_message}
-            ]
+            ],
+            "priority": "interactive"
         }
         
         # Use synchronous request in async context
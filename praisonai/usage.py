@@ -0,0 +1,126 @@
+# Token accounting from the eval counters Ollama reports with each generation
+from dataclasses import dataclass
+from typing import Any, Dict, Tuple
+
+from metrics import observe_usage
+
+# Ollama reports durations in nanoseconds
+_NS_PER_MS = 1_000_000
+
+
+@dataclass
+class GenerationUsage:
+    """Token counts and model time of one generation, or a sum of several
+
+    ``prompt_tokens`` counts the whole prompt; ``cached_tokens`` of it were
+    already in Ollama's KV cache and skipped prompt evaluation.
+    """
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    prompt_eval_ms: float = 0.0
+    eval_ms: float = 0.0
+    cached_tokens: int = 0
+    prompt_eval_ms_saved: float = 0.0
+
+    @classmethod
+    def from_ollama(cls, body: Dict[str, Any]) -> "GenerationUsage":
+        """Read the counters from a non-streaming response or the final ``done`` chunk"""
+        evaluated = body.get("prompt_eval_count", 0) or 0
+        completion_tokens = body.get("eval_count", 0) or 0
+        prompt_eval_ms = (body.get("prompt_eval_duration", 0) or 0) / _NS_PER_MS
+        # The returned context holds the whole prompt and the response, so the
+        # prompt tokens Ollama did not evaluate were served from its KV cache
+        prompt_tokens = max(evaluated, len(body.get("context") or ()) - completion_tokens)
+        cached_tokens = prompt_tokens - evaluated
+        return cls(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            prompt_eval_ms=prompt_eval_ms,
+            eval_ms=(body.get("eval_duration", 0) or 0) / _NS_PER_MS,
+            cached_tokens=cached_tokens,
+            # Priced at this generation's own prompt-eval rate
+            prompt_eval_ms_saved=cached_tokens * prompt_eval_ms / evaluated if evaluated else 0.0,
+        )
+
+    def __add__(self, other: "GenerationUsage") -> "GenerationUsage":
+        return GenerationUsage(
+            self.prompt_tokens + other.prompt_tokens,
+            self.completion_tokens + other.completion_tokens,
+            self.prompt_eval_ms + other.prompt_eval_ms,
+            self.eval_ms + other.eval_ms,
+            self.cached_tokens + other.cached_tokens,
+            self.prompt_eval_ms_saved + other.prompt_eval_ms_saved,
+        )
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def tokens_per_second(self) -> float:
+        return self.completion_tokens / (self.eval_ms / 1000) if self.eval_ms else 0.0
+
+    def to_openai(self) -> Dict[str, Any]:
+        """OpenAI ``usage`` block, with Ollama's timings alongside the standard keys"""
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "prompt_tokens_details": {"cached_tokens": self.cached_tokens},
+            "prompt_eval_ms": round(self.prompt_eval_ms),
+            "prompt_eval_ms_saved": round(self.prompt_eval_ms_saved),
+            "eval_ms": round(self.eval_ms),
+        }
+
+    def span_attributes(self) -> Dict[str, Any]:
+        """OpenTelemetry GenAI attributes, which Langfuse shows as generation usage"""
+        return {
+            "gen_ai.usage.input_tokens": self.prompt_tokens,
+            "gen_ai.usage.output_tokens": self.completion_tokens,
+            "gen_ai.usage.cached_tokens": self.cached_tokens,
+            "prompt_eval_ms": round(self.prompt_eval_ms, 1),
+            "eval_ms": round(self.eval_ms, 1),
+        }
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "prompt_eval_ms": round(self.prompt_eval_ms, 1),
+            "prompt_eval_ms_saved": round(self.prompt_eval_ms_saved, 1),
+            "eval_ms": round(self.eval_ms, 1),
+            "tokens_per_second": round(self.tokens_per_second(), 1),
+        }
+
+
+class UsageStats:
+    """Running token and model-time totals per team and generation kind"""
+
+    def __init__(self):
+        self._totals: Dict[Tuple[str, str], GenerationUsage] = {}
+        self._counts: Dict[Tuple[str, str], int] = {}
+
+    def record(self, team: str, kind: str, usage: GenerationUsage) -> None:
+        key = (team, kind)
+        self._totals[key] = self._totals.get(key, GenerationUsage()) + usage
+        self._counts[key] = self._counts.get(key, 0) + 1
+        observe_usage(team, kind, usage)
+
+    def stats(self) -> Dict[str, Any]:
+        teams: Dict[str, Dict[str, Any]] = {}
+        for (team, kind), usage in sorted(self._totals.items()):
+            prompt_s = usage.prompt_eval_ms / 1000
+            teams.setdefault(team, {})[kind] = {
+                "generations": self._counts[(team, kind)],
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "cached_prompt_tokens": usage.cached_tokens,
+                "prompt_eval_ms_saved": round(usage.prompt_eval_ms_saved, 1),
+                # Only evaluated tokens took prompt time
+                "prompt_tokens_per_second": round((usage.prompt_tokens - usage.cached_tokens) / prompt_s, 1) if prompt_s else 0.0,
+                "completion_tokens_per_second": round(usage.tokens_per_second(), 1),
+            }
+        return {"teams": teams}
+
+
+usage_stats = UsageStats()
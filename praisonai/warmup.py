@@ -0,0 +1,146 @@
+# Preload team models into Ollama and keep them resident
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from backends import BackendPool
+from http_client import OLLAMA_KEEP_ALIVE
+
+logger = logging.getLogger(__name__)
+
+# Set to false to skip preloading; /health then reports ready immediately
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+# Seconds between residency checks; models that were unloaded or lost to an Ollama restart are reloaded
+WARMUP_INTERVAL = float(os.getenv("WARMUP_INTERVAL", "30"))
+# Seconds to wait before retrying after Ollama was unreachable
+WARMUP_RETRY_INTERVAL = float(os.getenv("WARMUP_RETRY_INTERVAL", "5"))
+
+
+class ModelWarmer:
+    """Background task that loads every team model and reloads any that go missing
+
+    Each pass asks every backend serving a model whether it is resident and
+    loads the rest one at a time, so a restarted or idle-unloaded Ollama is
+    warmed again before the next user request pays the load time.
+    """
+
+    def __init__(self, pool: BackendPool, models: Iterable[str] = (), enabled: bool = WARMUP_ENABLED,
+                 interval: float = WARMUP_INTERVAL, retry_interval: float = WARMUP_RETRY_INTERVAL,
+                 optional: Iterable[str] = ()):
+        self.pool = pool
+        self.models: List[str] = sorted(set(models))
+        # Kept loaded on the backends that have them, but not needed for readiness
+        self.optional: List[str] = sorted(set(optional) - set(self.models))
+        self.enabled = enabled
+        self.interval = interval
+        self.retry_interval = retry_interval
+        # Model -> names of the backends holding it in memory
+        self.resident: Dict[str, Set[str]] = {model: set() for model in self.models + self.optional}
+        self._task: Optional[asyncio.Task] = None
+        self.checks = 0
+        self.loads = 0
+        self.reloads = 0
+        self.failures = 0
+        self.last_check: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.ready_since: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        """Every model is loaded on at least one backend"""
+        return not self.enabled or all(self.resident[model] for model in self.models)
+
+    async def check(self) -> bool:
+        """Load whatever is not resident; returns whether every model is now loaded somewhere"""
+        self.checks += 1
+        self.last_check = time.time()
+        had_been_ready = self.ready_since is not None
+        wanted = self.models + self.optional
+        for backend in self.pool.backends:
+            serving = [model for model in wanted if backend.serves(model)]
+            for model in wanted:
+                if model not in serving:
+                    self.resident[model].discard(backend.name)
+            if not serving:
+                continue
+            try:
+                loaded = await backend.resident(serving)
+            except Exception as e:
+                for model in serving:
+                    self.resident[model].discard(backend.name)
+                self._fail(f"Could not list models loaded on {backend.name}: {e}")
+                continue
+            for model in serving:
+                if model in loaded:
+                    self.resident[model].add(backend.name)
+                    continue
+                self.resident[model].discard(backend.name)
+                started = time.perf_counter()
+                try:
+                    await backend.load(model)
+                except Exception as e:
+                    self._fail(f"Could not load {model} on {backend.name}: {e}")
+                    continue
+                self.resident[model].add(backend.name)
+                self.loads += 1
+                if had_been_ready:
+                    self.reloads += 1
+                logger.info(f"Loaded {model} on {backend.name} (keep_alive={OLLAMA_KEEP_ALIVE}) in {time.perf_counter() - started:.1f} s")
+        if self.ready:
+            self.last_error = None
+            if self.ready_since is None:
+                self.ready_since = time.time()
+                logger.info(f"Models resident: {', '.join(self.models)}")
+            return True
+        self.ready_since = None
+        return False
+
+    def set_models(self, models: Iterable[str], optional: Iterable[str] = ()) -> None:
+        """Replace the models to keep loaded; new ones are loaded on the next check"""
+        self.models = sorted(set(models))
+        self.optional = sorted(set(optional) - set(self.models))
+        for model in self.models + self.optional:
+            self.resident.setdefault(model, set())
+        if self.ready_since is not None and not self.ready:
+            self.ready_since = None
+
+    def _fail(self, message: str) -> None:
+        self.failures += 1
+        self.last_error = message
+        logger.warning(message)
+
+    async def _run(self) -> None:
+        while True:
+            ready = await self.check()
+            await asyncio.sleep(self.interval if ready else self.retry_interval)
+
+    def start(self) -> None:
+        if self.enabled and (self.models or self.optional) and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "ready": self.ready,
+            "models": {model: sorted(self.resident[model]) for model in self.models},
+            "optional_models": {model: sorted(self.resident[model]) for model in self.optional},
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            "ready_since": self.ready_since,
+            "last_check": self.last_check,
+            "last_error": self.last_error,
+            "checks": self.checks,
+            "loads": self.loads,
+            "reloads": self.reloads,
+            "failures": self.failures,
+        }